@@ -0,0 +1,400 @@
+# bench.py
+# Load-test / benchmark harness for bot.py.
+#
+# Drives the real handlers (start, handle_buttons, handle_payment_proof,
+# approve/decline, broadcast, income) against an in-process fake Bot that
+# records every call and can inject latency and RetryAfter errors.  N
+# simulated users run the full start -> plan -> method -> proof -> approve
+# funnel concurrently, then the report shows updates/sec, handler latency
+# percentiles, state size on disk, write amplification and peak RSS.
+#
+#   python bench.py --users 500 --concurrency 50 --latency-ms 30
+#   python bench.py --backend sqlite --history 100000 --broadcast --json
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from copy import deepcopy
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+ADMIN_ID = 999_000_001
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark bot.py handlers against a fake Bot.")
+    p.add_argument("--users", type=int, default=200, help="simulated users going through the funnel")
+    p.add_argument("--concurrency", type=int, default=50, help="users in flight at once")
+    p.add_argument("--latency-ms", type=float, default=20.0, help="fake Bot API latency per call")
+    p.add_argument("--jitter-ms", type=float, default=10.0, help="uniform extra latency per call")
+    p.add_argument("--retry-after-rate", type=float, default=0.0,
+                   help="probability that a Bot API call raises RetryAfter")
+    p.add_argument("--retry-after", type=int, default=1, help="seconds carried by injected RetryAfter")
+    p.add_argument("--decline-rate", type=float, default=0.1, help="share of proofs the admin declines")
+    p.add_argument("--double-click-rate", type=float, default=0.1,
+                   help="share of reviews where the admin's button press arrives twice at once")
+    p.add_argument("--history", type=int, default=0, help="purchases to pre-load before the run")
+    p.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    p.add_argument("--serial", action="store_true",
+                   help="process one update at a time (PTB's default without concurrent updates)")
+    p.add_argument("--digest-window", type=float, default=0.0,
+                   help="batch proofs for the admin for this many seconds (bot's DIGEST_WINDOW)")
+    p.add_argument("--outbound-rate", type=float, default=0.0,
+                   help="bot's OUTBOUND_RATE (msg/s); 0 leaves the outbound scheduler off")
+    p.add_argument("--per-chat-rate", type=float, default=1.0, help="bot's OUTBOUND_PER_CHAT_RATE")
+    p.add_argument("--broadcast", action="store_true",
+                   help="run a /broadcast to the pre-loaded users while the funnel runs")
+    p.add_argument("--data-dir", default=None, help="state directory (default: fresh temp dir)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    p.add_argument("--verbose", action="store_true", help="keep the bot's own error logging")
+    return p.parse_args(argv)
+
+# ----------------- FAKE TELEGRAM -----------------
+class FakeBot:
+    """Stand-in for telegram.Bot: any Bot API method is accepted and recorded.
+
+    Every call sleeps for the configured latency and may raise RetryAfter.
+    Return values carry the attributes the handlers read (message_id,
+    chat_id, photo file ids, invite_link).  With `outbound` set (the bot
+    module) chat-bound calls queue in its outbound scheduler and injected
+    flood waits are retried the way ScheduledRequest does.
+    """
+    defaults = None  # read by TelegramObject.de_json
+
+    def __init__(self, latency: float, jitter: float, retry_after_rate: float, retry_after: int, rng):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.rng = rng
+        self.calls = Counter()
+        self.retry_afters = 0
+        self.call_log = []
+        self._next_id = 1000
+        self.outbound = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def api_call(*args, **kwargs):
+            return await self._call(name, kwargs)
+        return api_call
+
+    async def _call(self, name: str, kwargs: dict):
+        from telegram.error import RetryAfter
+
+        self.calls[name] += 1
+        endpoint = name.split("_")[0] + "".join(w.title() for w in name.split("_")[1:])
+        scheduled = self.outbound is not None and self.outbound.is_scheduled_call(endpoint)
+        attempt = 0
+        while True:
+            if scheduled:
+                await self.outbound.outbound_turn(endpoint, kwargs.get("chat_id"))
+            await asyncio.sleep(self.latency + self.rng.random() * self.jitter)
+            if not (self.retry_after_rate and self.rng.random() < self.retry_after_rate):
+                break
+            self.retry_afters += 1
+            if not scheduled or attempt == self.outbound.OUTBOUND_MAX_RETRIES:
+                raise RetryAfter(self.retry_after)
+            self.outbound.OUTBOUND.pause(self.retry_after)
+            attempt += 1
+        self._next_id += 1
+        self.call_log.append((name, kwargs.get("chat_id")))
+        return SimpleNamespace(
+            message_id=self._next_id,
+            chat_id=kwargs.get("chat_id"),
+            chat=SimpleNamespace(id=kwargs.get("chat_id")),
+            photo=[SimpleNamespace(file_id=f"file_{self._next_id}", file_unique_id=f"u_{self._next_id}")],
+            invite_link=f"https://t.me/+fake{self._next_id}",
+        )
+
+class FakeApplication:
+    """The parts of telegram.ext.Application the bot touches outside handlers."""
+
+    def __init__(self, bot, persistence=None):
+        self.bot = bot
+        self.user_data = defaultdict(dict)
+        self.persistence = persistence
+        self._touched = set()
+
+    def mark_data_for_update_persistence(self, chat_ids=None, user_ids=None):
+        if user_ids:
+            self._touched.update([user_ids] if isinstance(user_ids, int) else user_ids)
+
+    async def update_persistence(self):
+        # what Application.update_persistence does for user_data
+        touched, self._touched = self._touched, set()
+        for uid in touched:
+            await self.persistence.update_user_data(uid, deepcopy(self.user_data[uid]))
+
+    def create_task(self, coro, update=None, **kwargs):
+        return asyncio.create_task(coro)
+
+class FakeContext:
+    def __init__(self, application, user_id: int, args=None):
+        self.application = application
+        self.bot = application.bot
+        self.user_data = application.user_data[user_id]
+        self.args = args
+
+# ----------------- UPDATE BUILDERS -----------------
+_update_ids = iter(range(1, 10 ** 12))
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+def _message(uid: int, message_id: int, **extra) -> dict:
+    return {"message_id": message_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+            "from": _user(uid), **extra}
+
+def command_update(bot_mod, fake_bot, uid: int, text: str):
+    cmd = text.split()[0]
+    msg = _message(uid, next(_update_ids), text=text,
+                   entities=[{"type": "bot_command", "offset": 0, "length": len(cmd)}])
+    return bot_mod.Update.de_json({"update_id": next(_update_ids), "message": msg}, fake_bot)
+
+def callback_update(bot_mod, fake_bot, uid: int, data: str):
+    query = {"id": str(next(_update_ids)), "chat_instance": "bench", "data": data, "from": _user(uid),
+             "message": _message(uid, next(_update_ids), text="menu")}
+    return bot_mod.Update.de_json({"update_id": next(_update_ids), "callback_query": query}, fake_bot)
+
+def photo_update(bot_mod, fake_bot, uid: int, caption: str = None):
+    n = next(_update_ids)
+    extra = {"photo": [{"file_id": f"proof_{uid}_{n}", "file_unique_id": f"uq_{uid}_{n}", "width": 800, "height": 600}]}
+    if caption:
+        extra["caption"] = caption
+    return bot_mod.Update.de_json({"update_id": next(_update_ids), "message": _message(uid, n, **extra)}, fake_bot)
+
+# ----------------- HARNESS -----------------
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _io_written() -> int:
+    """Bytes this process has passed to write() so far (Linux), else -1."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return -1
+
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+class Harness:
+    def __init__(self, bot_mod, args):
+        self.bot = bot_mod
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.fake = FakeBot(args.latency_ms / 1000, args.jitter_ms / 1000,
+                            args.retry_after_rate, args.retry_after, self.rng)
+        self.fake.outbound = bot_mod
+        self.app = FakeApplication(self.fake, bot_mod.SessionPersistence())
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.updates = 0
+        self.serial = asyncio.Lock() if args.serial else None
+
+    async def dispatch(self, name: str, handler, update, uid: int, args=None):
+        context = FakeContext(self.app, uid, args)
+        self.app.mark_data_for_update_persistence(user_ids=uid)
+        started = time.perf_counter()
+        try:
+            if self.serial is not None:
+                async with self.serial:
+                    await handler(update, context)
+            else:
+                await handler(update, context)
+        except Exception as e:
+            self.errors[f"{name}: {type(e).__name__}"] += 1
+        finally:
+            self.latencies[name].append(time.perf_counter() - started)
+            self.updates += 1
+
+    async def funnel(self, uid: int):
+        b, f = self.bot, self.fake
+        plan = self.rng.choice(("vip", "dark", "both"))
+        method = self.rng.choice(("upi", "upi", "crypto", "remitly"))
+        # wrapped the way main() registers them
+        await self.dispatch("start", b.per_user(b.start), command_update(b, f, uid, "/start"), uid)
+        await self.dispatch("plan", b.handle_buttons, callback_update(b, f, uid, f"plan_{plan}"), uid)
+        await self.dispatch("method", b.handle_buttons, callback_update(b, f, uid, f"pay_{method}"), uid)
+        await self.dispatch("proof", b.per_user(b.handle_payment_proof),
+                            photo_update(b, f, uid, caption=f"UTR: {uid:012d}"), uid)
+        if self.args.digest_window:
+            # the admin only sees the proof once its digest went out
+            await asyncio.sleep(self.args.digest_window)
+        payment_ids = [pid for pid, p in b.PENDING_PAYMENTS.items() if p.get("user_id") == uid]
+        for pid in payment_ids:
+            action = "decline" if self.rng.random() < self.args.decline_rate else "approve"
+            clicks = 2 if self.rng.random() < self.args.double_click_rate else 1
+            await asyncio.gather(*(
+                self.dispatch(action, b.handle_buttons, callback_update(b, f, ADMIN_ID, f"{action}:{pid}"), ADMIN_ID)
+                for _ in range(clicks)
+            ))
+
+    async def run(self) -> dict:
+        b, args = self.bot, self.args
+        await b.post_init(self.app)
+        sem = asyncio.Semaphore(args.concurrency)
+        first_uid = 10_000_000
+
+        async def one(uid):
+            async with sem:
+                await self.funnel(uid)
+
+        broadcast_seconds = None
+        if args.broadcast:
+            # goes to the users known before the run (see --history), and
+            # competes with the funnel for the outbound budget
+            t0 = time.perf_counter()
+            await self.dispatch("broadcast", b.per_user(b.broadcast), command_update(b, self.fake, ADMIN_ID, "/broadcast hello"),
+                                ADMIN_ID, args=["hello", "everyone"])
+
+        async def persist_sessions():
+            while True:
+                await asyncio.sleep(b.SESSION_FLUSH_INTERVAL)
+                await self.app.update_persistence()
+
+        written_before = _io_written()
+        started = time.perf_counter()
+        persister = asyncio.create_task(persist_sessions())
+        await asyncio.gather(*(one(first_uid + i) for i in range(args.users)))
+        funnel_seconds = time.perf_counter() - started
+        if args.broadcast:
+            while b._BROADCAST_TASKS:
+                await asyncio.sleep(0.05)
+            broadcast_seconds = time.perf_counter() - t0
+
+        # every approved payment must have produced exactly one purchase
+        await b.flush_state()
+        per_payment = Counter(p["payment_id"] for p in b.STORE.iter_purchases()
+                              if not str(p.get("payment_id")).startswith("hist_"))
+        duplicate_purchases = sum(n - 1 for n in per_payment.values())
+
+        for mode in (["today"], ["30d", "plan"]):
+            await self.dispatch("income", b.per_user(b.income), command_update(b, self.fake, ADMIN_ID, "/income"), ADMIN_ID, args=mode)
+
+        persister.cancel()
+        await self.app.update_persistence()
+        await b.post_shutdown(self.app)
+        written = _io_written() - written_before if written_before >= 0 else -1
+        state_bytes = _dir_size(b.DATA_DIR)
+        return {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "serial": args.serial,
+            "backend": args.backend,
+            "history": args.history,
+            "updates": self.updates,
+            "funnel_seconds": round(funnel_seconds, 3),
+            "updates_per_sec": round(self.updates / funnel_seconds, 1) if funnel_seconds else None,
+            "broadcast_seconds": round(broadcast_seconds, 3) if broadcast_seconds is not None else None,
+            "latency_ms": {
+                name: {
+                    "n": len(v),
+                    "p50": round(_percentile(v, 0.50) * 1000, 2),
+                    "p99": round(_percentile(v, 0.99) * 1000, 2),
+                    "max": round(max(v) * 1000, 2),
+                }
+                for name, v in self.latencies.items()
+            },
+            "outbound_queue_ms": {
+                name: {"n": s.count, "p50": s.quantile(0.5) * 1000, "p99": s.quantile(0.99) * 1000}
+                for (kind, name), s in b.METRICS.items() if kind == "outbound_queue"
+            },
+            "errors": dict(self.errors),
+            "purchases": len(per_payment),
+            "duplicate_purchases": duplicate_purchases,
+            "api_calls": dict(self.fake.calls),
+            "retry_after_injected": self.fake.retry_afters,
+            "admin_chat_calls": sum(1 for _, chat_id in self.fake.call_log if chat_id == ADMIN_ID),
+            "state_bytes": state_bytes,
+            "bytes_written": written,
+            "write_amplification": round(written / state_bytes, 2) if written > 0 and state_bytes else None,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+def seed_history(bot_mod, n: int, rng):
+    """Pre-load n purchases (and their users) so persistence cost at scale shows up."""
+    now = bot_mod.now_ist()
+    for i in range(n):
+        uid = 1_000_000 + i
+        bot_mod.KNOWN_USERS.add(uid)
+        bot_mod.journal_event("user_seen", user_id=uid)
+        bot_mod.add_purchase({
+            "time": now - bot_mod.timedelta(minutes=rng.randrange(0, 60 * 24 * 365)),
+            "user_id": uid,
+            "username": f"hist{i}",
+            "plan": rng.choice(("vip", "dark", "both")),
+            "method": "upi",
+            "amount": 499,
+            "currency": "INR",
+            "payment_id": f"hist_{i}",
+        })
+    bot_mod.save_state()
+
+def print_report(r: dict):
+    mode = "serial" if r["serial"] else "concurrent"
+    print(f"users={r['users']} concurrency={r['concurrency']} ({mode}) backend={r['backend']} history={r['history']}")
+    print(f"updates: {r['updates']} in {r['funnel_seconds']}s -> {r['updates_per_sec']} updates/sec")
+    if r["broadcast_seconds"] is not None:
+        print(f"broadcast: {r['broadcast_seconds']}s")
+    print(f"{'handler':<10}{'n':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, s in r["latency_ms"].items():
+        print(f"{name:<10}{s['n']:>8}{s['p50']:>10}{s['p99']:>10}{s['max']:>10}")
+    for name, q in r["outbound_queue_ms"].items():
+        print(f"outbound queue wait {name}: n={q['n']} p50<={q['p50']:g}ms p99<={q['p99']:g}ms")
+    print(f"state on disk: {r['state_bytes']} bytes | written during run: {r['bytes_written']} bytes "
+          f"| write amplification: {r['write_amplification']}")
+    print(f"peak RSS: {r['peak_rss_mb']} MB")
+    print(f"api calls: {r['api_calls']} | RetryAfter injected: {r['retry_after_injected']}")
+    print(f"admin chat calls: {r['admin_chat_calls']}")
+    print(f"purchases: {r['purchases']} | duplicate purchases: {r['duplicate_purchases']}")
+    if r["errors"]:
+        print(f"handler errors: {r['errors']}")
+
+def main(argv=None):
+    args = parse_args(argv)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="paymentbot-bench-")
+    # bot.py reads its configuration at import time
+    os.environ.update({
+        "DATA_DIR": data_dir,
+        "STORAGE_BACKEND": args.backend,
+        "ADMIN_CHAT_ID": str(ADMIN_ID),
+        "VIP_CHANNEL_ID": "-1001",
+        "DARK_CHANNEL_ID": "-1002",
+        "BROADCAST_PROGRESS_INTERVAL": "5",
+        "DIGEST_WINDOW": str(args.digest_window),
+        "OUTBOUND_RATE": str(args.outbound_rate),
+        "OUTBOUND_PER_CHAT_RATE": str(args.per_chat_rate),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as bot_mod
+    # injected RetryAfters are counted in the report, not logged per call
+    logging.getLogger().setLevel(logging.WARNING if args.verbose else logging.CRITICAL)
+
+    bot_mod.load_state()
+    if args.history:
+        seed_history(bot_mod, args.history, random.Random(args.seed))
+    report = asyncio.run(Harness(bot_mod, args).run())
+    report["data_dir"] = data_dir
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
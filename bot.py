@@ -5,17 +5,49 @@ import json
 import tempfile
 import shutil
 import logging
-from datetime import datetime, timedelta, timezone
+import secrets
+import sqlite3
+import threading
+import time
+import asyncio
+import atexit
+import base64
+import csv
+import gzip
+import hashlib
+import io
+import mmap
+import struct
+import sys
+import contextlib
+import contextvars
+import functools
+import heapq
+import signal
+import subprocess
+from array import array
+from bisect import bisect_left, bisect_right
+import re
+import httpx
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict, deque
 from pathlib import Path
 from typing import Any, Dict
 
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaDocument,
+    InputMediaPhoto,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -48,16 +80,159 @@ CRYPTO_ADDRESS = os.getenv(
     "CRYPTO_ADDRESS", "0xfc14846229f375124d8fed5cd9a789a271a303f5"
 )
 CRYPTO_NETWORK = os.getenv("CRYPTO_NETWORK", "BEP20")
+# Automatic crypto verification.  With CRYPTO_VERIFIER=evm the TXID in a
+# crypto proof's caption is looked up on the Ethereum-style JSON-RPC node at
+# CRYPTO_RPC_URL (a BSC node for BEP20, or chain_stub.py offline): a
+# CRYPTO_TOKEN_CONTRACT transfer to CRYPTO_ADDRESS of at least the plan price
+# (less CRYPTO_AMOUNT_TOLERANCE) with CRYPTO_MIN_CONFIRMATIONS, made within
+# the payment's own PROOF_WINDOW_MINUTES, is approved without the admin.
+# A TXID that was declined once always goes to the admin.  Empty leaves
+# every crypto proof to the admin.
+CRYPTO_VERIFIER = os.getenv("CRYPTO_VERIFIER", "").lower()
+CRYPTO_RPC_URL = os.getenv("CRYPTO_RPC_URL", "http://127.0.0.1:8545")
+CRYPTO_TOKEN_CONTRACT = os.getenv("CRYPTO_TOKEN_CONTRACT", "0x55d398326f99059ff775485246999027b3197955")  # USDT (BSC)
+CRYPTO_TOKEN_DECIMALS = int(os.getenv("CRYPTO_TOKEN_DECIMALS", "18"))
+CRYPTO_MIN_CONFIRMATIONS = int(os.getenv("CRYPTO_MIN_CONFIRMATIONS", "15"))
+CRYPTO_AMOUNT_TOLERANCE = float(os.getenv("CRYPTO_AMOUNT_TOLERANCE", "0.01"))
+# an unconfirmed TXID is checked again every CRYPTO_VERIFY_INTERVAL seconds
+# for up to CRYPTO_VERIFY_TIMEOUT_MINUTES
+CRYPTO_VERIFY_INTERVAL = float(os.getenv("CRYPTO_VERIFY_INTERVAL", "20"))
+CRYPTO_VERIFY_TIMEOUT_MINUTES = float(os.getenv("CRYPTO_VERIFY_TIMEOUT_MINUTES", "30"))
+# chain lookups are kept in an LRU of CRYPTO_CACHE_SIZE TXIDs; settled ones
+# for CRYPTO_CACHE_TTL seconds, unconfirmed ones for half a check interval
+CRYPTO_CACHE_SIZE = int(os.getenv("CRYPTO_CACHE_SIZE", "1024"))
+CRYPTO_CACHE_TTL = float(os.getenv("CRYPTO_CACHE_TTL", "600"))
 
 REMITLY_INFO = os.getenv("REMITLY_INFO", "Send via Remitly")
 REMITLY_HOW_TO_PAY_LINK = os.getenv("REMITLY_HOW_TO_PAY_LINK", "https://t.me/+8jECICY--sU2MjIx")
 
+# Serving mode: "polling" (default) or "webhook"
+RUN_MODE = os.getenv("RUN_MODE", "polling").lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+HEALTH_PATH = "/" + os.getenv("HEALTH_PATH", "healthz").strip("/")
+# public https base URL Telegram should call; leave unset to skip setWebhook
+# (e.g. when POSTing recorded updates locally)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# TLS is assumed to be terminated by the platform's proxy; set both to serve
+# HTTPS directly
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT", "")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY", "")
+# point the bot at a different Bot API server (local stub, self-hosted API)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+
+# Instrumentation: handler / Bot API / persistence latency, shown by /metrics
+# and served in Prometheus text format on METRICS_PATH (webhook server) or on
+# METRICS_PORT (polling mode, optional)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+METRICS_PATH = "/" + os.getenv("METRICS_PATH", "metrics").strip("/")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
 HELP_BOT_USERNAME = os.getenv("HELP_BOT_USERNAME", "@Dark123222_bot")
 HELP_BOT_USERNAME_MD = HELP_BOT_USERNAME.replace("_", "\\_")
 
 # Persistent data location (mounted disk)
 DATA_DIR = os.getenv("DATA_DIR", "/data")   # default to /data (Render disk mount)
 DATA_FILE = os.path.join(DATA_DIR, "paymentbot.json")
+SNAPSHOT_FILE = os.path.join(DATA_DIR, "paymentbot.snap")
+JOURNAL_FILE = os.path.join(DATA_DIR, "paymentbot.journal")
+DB_FILE = os.path.join(DATA_DIR, "paymentbot.db")
+# unresolved payments that age out are appended here (json backend)
+EXPIRED_FILE = os.path.join(DATA_DIR, "paymentbot.expired.jsonl")
+# "json" (snapshot + journal files) or "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+# journal is compacted once it exceeds this size (or, with json snapshots,
+# the snapshot size if larger)
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(1024 * 1024)))
+# json backend snapshot format: "binary" (SNAPSHOT_FILE, memory-mapped at
+# startup) or "json" (DATA_FILE).  Whichever file is newer is loaded.
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "binary").lower()
+# background writer: flush at most every PERSIST_INTERVAL seconds, or as soon
+# as PERSIST_MAX_PENDING mutations are queued
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "2"))
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", "200"))
+# users' open payment windows (their user_data) survive restarts; changed
+# entries are handed to the journal at most every SESSION_FLUSH_INTERVAL seconds
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+
+# Multi-worker mode (RUN_MODE=webhook with WORKERS > 1): the process Telegram
+# calls only routes each update, by user id, to one of WORKERS child
+# processes (RUN_MODE=worker) listening on 127.0.0.1:WORKER_BASE_PORT+n.
+# Workers share the SQLite store and pick up each other's writes every
+# SYNC_INTERVAL seconds.
+WORKERS = max(int(os.getenv("WORKERS", "1")), 1)
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8600"))
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "0.5"))
+MULTI_WORKER = WORKERS > 1 and RUN_MODE in ("webhook", "worker")
+if MULTI_WORKER and STORAGE_BACKEND != "sqlite":
+    logger.warning("WORKERS=%d needs shared state; using STORAGE_BACKEND=sqlite", WORKERS)
+    STORAGE_BACKEND = "sqlite"
+
+# Outbound scheduler: every message the bot sends shares one global and one
+# per-chat budget (Telegram allows ~30 msg/s overall and ~1 msg/s per chat,
+# with short bursts).  Flood waits are retried up to OUTBOUND_MAX_RETRIES
+# times.  OUTBOUND_RATE=0 sends everything straight away.
+# BROADCAST_RATE / BROADCAST_PER_CHAT_RATE are still honoured as fallbacks.
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", os.getenv("BROADCAST_RATE", "30")))
+OUTBOUND_PER_CHAT_RATE = float(os.getenv("OUTBOUND_PER_CHAT_RATE", os.getenv("BROADCAST_PER_CHAT_RATE", "1")))
+OUTBOUND_PER_CHAT_BURST = float(os.getenv("OUTBOUND_PER_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+if MULTI_WORKER:
+    # the global budget belongs to the bot token, so workers split it
+    OUTBOUND_RATE /= WORKERS
+
+# Broadcast engine
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+
+# Expiry: how long a user has to send proof after choosing a method, how long
+# an unreviewed proof stays pending, and a hard cap on the pending set
+PROOF_WINDOW_MINUTES = int(os.getenv("PROOF_WINDOW_MINUTES", "30"))
+PENDING_TTL_HOURS = float(os.getenv("PENDING_TTL_HOURS", "48"))
+PENDING_MAX = int(os.getenv("PENDING_MAX", "5000"))
+# proof files of resolved payments stay in the duplicate-proof index this
+# long; UTRs/TXIDs are remembered for good
+PROOF_FILE_KEY_DAYS = float(os.getenv("PROOF_FILE_KEY_DAYS", "30"))
+
+# Pre-created single-use invite links kept ready per channel (0 disables)
+INVITE_POOL_SIZE = int(os.getenv("INVITE_POOL_SIZE", "5"))
+INVITE_POOL_REFILL_INTERVAL = float(os.getenv("INVITE_POOL_REFILL_INTERVAL", "60"))
+
+# Per-user anti-flood limits as "<messages>/<seconds>" (empty disables):
+# proof photos/documents and plain-text messages.  Buckets of users idle for
+# THROTTLE_IDLE_SECONDS are forgotten; at most THROTTLE_MAX_USERS are kept.
+THROTTLE_PROOF = os.getenv("THROTTLE_PROOF", "5/60")
+THROTTLE_TEXT = os.getenv("THROTTLE_TEXT", "3/60")
+THROTTLE_IDLE_SECONDS = float(os.getenv("THROTTLE_IDLE_SECONDS", "600"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "10000"))
+
+# Updates processed at the same time (1 = one by one, PTB's default).  Each
+# user's own updates still run in order; see "Concurrency" below.
+CONCURRENT_UPDATES = max(1, int(os.getenv("CONCURRENT_UPDATES", "64")))
+
+# /pending review queue: payments per page, and how many bulk approvals /
+# declines run at once
+PENDING_PAGE_SIZE = int(os.getenv("PENDING_PAGE_SIZE", "8"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "10"))
+
+# Digest mode: collect proofs for up to DIGEST_WINDOW seconds (or
+# DIGEST_MAX_ITEMS proofs, at most 10) and send them to the admin as one
+# album plus one keyboard message.  0 sends every proof on its own.
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "0"))
+DIGEST_MAX_ITEMS = min(10, max(1, int(os.getenv("DIGEST_MAX_ITEMS", "10"))))
+
+# /reconcile: a statement credit can belong to a pending UPI/Remitly payment
+# if it is dated at most RECONCILE_WINDOW_HOURS before the proof arrived (or
+# RECONCILE_SLACK_MINUTES after it, for clock skew).  Credits that match on
+# amount and time but carry no UTR from the proof caption are only approved
+# automatically with RECONCILE_TRUST_AMOUNT=1; otherwise they go to review.
+RECONCILE_WINDOW_HOURS = float(os.getenv("RECONCILE_WINDOW_HOURS", "24"))
+RECONCILE_SLACK_MINUTES = float(os.getenv("RECONCILE_SLACK_MINUTES", "15"))
+RECONCILE_TRUST_AMOUNT = os.getenv("RECONCILE_TRUST_AMOUNT", "0").lower() in ("1", "true", "yes")
 
 # ----------------- CONSTANTS -----------------
 IST = timezone(timedelta(hours=5, minutes=30))
@@ -73,11 +248,301 @@ PLAN_LABELS = {
     "both": "VIP + Dark (Combo 30% OFF)",
 }
 
+# Purchase history -----------------------------------------------------------
+# Approved sales are stored column-wise in typed arrays instead of one dict
+# per sale:
+#   time     epoch microseconds (int64)     user_id   int64
+#   amount   1/100 units (int64)            plan, method, currency  1-byte codes
+#   username index into an interned table   payment_id  one shared UTF-8 blob
+# Rows come back as plain dicts on demand; range scans bisect the time
+# column, which is kept sorted.  Binary snapshots store the same columns
+# verbatim, so a restart maps them instead of decoding old sales.
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_US_PER_DAY = 86_400_000_000
+
+class _Codes:
+    """Interning table mapping values to small int codes and back."""
+
+    def __init__(self, values=()):
+        self.values: list = []
+        self.index: dict = {}
+        for v in values:
+            self.code(v)
+
+    def code(self, value) -> int:
+        c = self.index.get(value)
+        if c is None:
+            c = self.index[value] = len(self.values)
+            self.values.append(value)
+        return c
+
+def _le_bytes(arr: array) -> bytes:
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+def _unpack(typecode: str, data: str) -> array:
+    arr = array(typecode)
+    arr.frombytes(base64.b64decode(data))
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+class PurchaseLog:
+    """Append-only columnar purchase history with a dict-per-row read view.
+
+    History loaded from a binary snapshot stays behind as a read-only
+    MappedPurchaseLog base; new sales go to the log's own columns and the
+    base is only copied in once history is first read or re-snapshotted.
+    """
+
+    COLUMNS = (("times", "q"), ("user_ids", "q"), ("amounts", "q"), ("plans", "B"),
+               ("methods", "B"), ("currencies", "B"), ("names", "I"), ("pid_ends", "I"))
+    CODE_TABLES = ("plan_codes", "method_codes", "currency_codes", "usernames")
+    _base = None
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.pid_blob = bytearray()
+        self.plan_codes = _Codes(PRICE_CONFIG)
+        self.method_codes = _Codes(("upi", "crypto", "remitly"))
+        self.currency_codes = _Codes(("INR", "USD"))
+        self.name_codes = _Codes(("",))
+        self._sorted = True
+        self._base = None
+
+    def attach(self, base: "PurchaseLog"):
+        """Start over with `base` as the (older) history below this log."""
+        self.clear()
+        self._base = base
+
+    def __len__(self):
+        return len(self.times) + (len(self._base) if self._base is not None else 0)
+
+    def append(self, p: dict):
+        t = p.get("time")
+        if isinstance(t, str):
+            t = _deserialize_purchase(p).get("time")
+        us = round(t.timestamp() * 1_000_000) if isinstance(t, datetime) else 0
+        if self.times and us < self.times[-1]:
+            self._sorted = False
+        self.times.append(us)
+        self.user_ids.append(int(p.get("user_id") or 0))
+        self.amounts.append(round(float(p.get("amount") or 0) * 100))
+        self.plans.append(self.plan_codes.code(p.get("plan")))
+        self.methods.append(self.method_codes.code(p.get("method")))
+        self.currencies.append(self.currency_codes.code(p.get("currency")))
+        self.names.append(self.name_codes.code(p.get("username") or ""))
+        self.pid_blob += str(p.get("payment_id") or "").encode()
+        self.pid_ends.append(len(self.pid_blob))
+
+    @staticmethod
+    def _amount(minor: int):
+        return minor // 100 if minor % 100 == 0 else minor / 100
+
+    def row(self, i: int) -> dict:
+        start = self.pid_ends[i - 1] if i else 0
+        return {
+            "time": datetime.fromtimestamp(self.times[i] / 1_000_000, IST),
+            "user_id": self.user_ids[i],
+            "username": self.name_codes.values[self.names[i]],
+            "plan": self.plan_codes.values[self.plans[i]],
+            "method": self.method_codes.values[self.methods[i]],
+            "amount": self._amount(self.amounts[i]),
+            "currency": self.currency_codes.values[self.currencies[i]],
+            "payment_id": bytes(self.pid_blob[start:self.pid_ends[i]]).decode(),
+        }
+
+    def _ensure_sorted(self):
+        if self._sorted:
+            return
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        ends = self.pid_ends
+        pids = [self.pid_blob[ends[i - 1] if i else 0:ends[i]] for i in order]
+        for name, typecode in self.COLUMNS[:-1]:
+            column = getattr(self, name)
+            setattr(self, name, array(typecode, (column[i] for i in order)))
+        self.pid_blob = bytearray()
+        self.pid_ends = array("I")
+        for pid in pids:
+            self.pid_blob += pid
+            self.pid_ends.append(len(self.pid_blob))
+        self._sorted = True
+
+    def __iter__(self):
+        return self.scan()
+
+    def scan(self, start: datetime = None, end: datetime = None):
+        """Iterate rows with start <= time < end (either bound may be None), oldest first.
+
+        The row range is fixed by the call itself, so the iterator can be
+        drained from a worker thread while sales keep being appended.
+        """
+        self._fold_base()
+        self._ensure_sorted()
+        lo = 0 if start is None else bisect_left(self.times, round(start.timestamp() * 1_000_000))
+        hi = len(self.times) if end is None else bisect_left(self.times, round(end.timestamp() * 1_000_000))
+        return map(self.row, range(lo, hi))
+
+    def daily_totals(self):
+        """Yield (ist_day, currency, plan, method, count, amount) straight off the columns."""
+        self._fold_base()
+        offset = round(IST.utcoffset(None).total_seconds() * 1_000_000)
+        totals: Dict[tuple, list] = {}
+        for t, c, p, m, a in zip(self.times, self.currencies, self.plans, self.methods, self.amounts):
+            key = ((t + offset) // _US_PER_DAY, c, p, m)
+            row = totals.get(key)
+            if row is None:
+                totals[key] = [1, a]
+            else:
+                row[0] += 1
+                row[1] += a
+        for (day, c, p, m), (count, amount) in totals.items():
+            yield (date.fromordinal(_EPOCH_ORDINAL + day), self.currency_codes.values[c],
+                   self.plan_codes.values[p], self.method_codes.values[m], count, self._amount(amount))
+
+    def _fold_base(self):
+        """Copy the mapped base into owned columns, ahead of the rows added since."""
+        base = self._base
+        if base is None:
+            return
+        added = [self.row(i) for i in range(len(self.times))]
+        for name, typecode in self.COLUMNS:
+            column = array(typecode)
+            column.frombytes(memoryview(getattr(base, name)).cast("B"))
+            setattr(self, name, column)
+        self.pid_blob = bytearray(base.pid_blob)
+        self.plan_codes = base.plan_codes
+        self.method_codes = base.method_codes
+        self.currency_codes = base.currency_codes
+        self.name_codes = base.name_codes
+        self._base = None
+        self._sorted = True
+        for p in added:
+            self.append(p)
+
+    def export(self) -> dict:
+        """Copy of the columns as little-endian bytes, plus the code tables."""
+        self._fold_base()
+        self._ensure_sorted()
+        data = {name: _le_bytes(getattr(self, name)) for name, _ in self.COLUMNS}
+        data.update(
+            payment_ids=bytes(self.pid_blob),
+            plan_codes=list(self.plan_codes.values),
+            method_codes=list(self.method_codes.values),
+            currency_codes=list(self.currency_codes.values),
+            usernames=list(self.name_codes.values),
+        )
+        return data
+
+    @staticmethod
+    def export_json(data: dict) -> dict:
+        """JSON snapshot form of an export() (see load_json): byte fields base64-encoded."""
+        return {k: base64.b64encode(v).decode("ascii") if isinstance(v, bytes) else v for k, v in data.items()}
+
+    def load_json(self, data: dict):
+        self.clear()
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, _unpack(typecode, data[name]))
+        self.pid_blob = bytearray(base64.b64decode(data["payment_ids"]))
+        self.plan_codes = _Codes(data["plan_codes"])
+        self.method_codes = _Codes(data["method_codes"])
+        self.currency_codes = _Codes(data["currency_codes"])
+        self.name_codes = _Codes(data["usernames"])
+        self._sorted = all(a <= b for a, b in zip(self.times, self.times[1:]))
+
+class MappedPurchaseLog(PurchaseLog):
+    """Read-only PurchaseLog whose columns are views into a binary snapshot.
+
+    Nothing is copied or decoded at load time; PurchaseLog._fold_base()
+    copies the columns out and parses the code tables on first use.
+    """
+
+    def __init__(self, buf: memoryview, count: int, offset: int, pid_len: int, meta: memoryview):
+        self._meta = meta
+        self._sorted = True
+        for name, typecode in self.COLUMNS:
+            size = count * array(typecode).itemsize
+            column = buf[offset:offset + size].cast(typecode)
+            if sys.byteorder != "little":
+                column = array(typecode, column)
+                column.byteswap()
+            setattr(self, name, column)
+            offset = _align8(offset + size)
+        self.pid_blob = buf[offset:offset + pid_len]
+
+    def __getattr__(self, name):
+        if name not in ("plan_codes", "method_codes", "currency_codes", "name_codes"):
+            raise AttributeError(name)
+        meta = json.loads(bytes(self._meta))
+        self.plan_codes = _Codes(meta["plan_codes"])
+        self.method_codes = _Codes(meta["method_codes"])
+        self.currency_codes = _Codes(meta["currency_codes"])
+        self.name_codes = _Codes(meta["usernames"])
+        return getattr(self, name)
+
+# Binary snapshot layout (SNAPSHOT_FORMAT=binary), little-endian:
+#   header   magic, hot_len, meta_len, purchase count, payment_id blob length
+#   hot      JSON of everything except purchase history (pending payments,
+#            users, invites, the income rollup, ...)
+#   meta     JSON of the purchase code tables and usernames
+#   columns  PurchaseLog.COLUMNS, fixed width, each starting on an 8-byte boundary
+#   blob     payment_ids
+_SNAP_MAGIC = b"PBSNAP01"
+_SNAP_HEADER = struct.Struct("<8sQQQQ")
+
+def _align8(n: int) -> int:
+    return n + (-n % 8)
+
+def write_binary_snapshot(f, payload: dict):
+    """Write a _serialize_state() payload to the binary file object `f`."""
+    purchases = payload["purchases"]
+    hot = {k: v for k, v in payload.items() if k != "purchases"}
+    hot = json.dumps(hot, ensure_ascii=False, separators=(",", ":")).encode()
+    meta = {k: purchases[k] for k in PurchaseLog.CODE_TABLES}
+    meta = json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode()
+    count = len(purchases["times"]) // 8
+    f.write(_SNAP_HEADER.pack(_SNAP_MAGIC, len(hot), len(meta), count, len(purchases["payment_ids"])))
+    f.write(hot)
+    f.write(meta)
+    pos = _SNAP_HEADER.size + len(hot) + len(meta)
+    for name, _ in PurchaseLog.COLUMNS:
+        f.write(b"\0" * (_align8(pos) - pos))
+        f.write(purchases[name])
+        pos = _align8(pos) + len(purchases[name])
+    f.write(b"\0" * (_align8(pos) - pos))
+    f.write(purchases["payment_ids"])
+
+def read_binary_snapshot(path: str):
+    """Map a binary snapshot; returns (hot state dict, MappedPurchaseLog, file size)."""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mm)
+    magic, hot_len, meta_len, count, pid_len = _SNAP_HEADER.unpack_from(buf)
+    if magic != _SNAP_MAGIC:
+        raise ValueError(f"{path} is not a paymentbot snapshot")
+    pos = _SNAP_HEADER.size
+    data = json.loads(bytes(buf[pos:pos + hot_len]))
+    pos += hot_len
+    meta = buf[pos:pos + meta_len]
+    history = MappedPurchaseLog(buf, count, _align8(pos + meta_len), pid_len, meta)
+    return data, history, len(mm)
+
 # ----------------- RUNTIME STORAGE (in-memory) -----------------
 PENDING_PAYMENTS: Dict[str, Dict[str, Any]] = {}
-PURCHASE_LOG: list = []
+PURCHASE_LOG = PurchaseLog()  # approved sales (json backend); see "Purchase history"
 KNOWN_USERS: set = set()
 SENT_INVITES: dict = {}
+BROADCAST_JOBS: Dict[str, Dict[str, Any]] = {}  # unfinished broadcasts by job id
+INVITE_POOL: Dict[int, list] = {}  # channel_id -> unused single-use invite links
+MEDIA_CACHE: Dict[str, str] = {}  # media key ("url:<source>" or a slot name) -> Telegram file_id
+PROOF_INDEX: Dict[str, dict] = {}  # "file:<file_unique_id>" / "ref:<UTR or TXID>" -> first submission
+USER_SESSIONS: Dict[int, dict] = {}  # user_id -> stored user_data (see SessionPersistence)
 
 # ----------------- HELPERS -----------------
 def now_ist() -> datetime:
@@ -86,45 +551,227 @@ def now_ist() -> datetime:
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_CHAT_ID
 
+# Metrics -------------------------------------------------------------------
+# Fixed-bucket latency histograms keyed by (kind, name).  kind is "handler",
+# "telegram_api" or "persistence".  With METRICS_ENABLED off nothing is
+# wrapped, so the only cost left is one flag check per persistence flush.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_MAX_SERIES = 500
+METRICS_STARTED = time.time()
+
+class LatencyStat:
+    __slots__ = ("count", "errors", "total", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds: float, error: bool = False):
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (inf past the last bucket)."""
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+METRICS: Dict[tuple, LatencyStat] = {}
+
+def observe(kind: str, name: str, seconds: float, error: bool = False):
+    stat = METRICS.get((kind, name))
+    if stat is None:
+        if len(METRICS) >= METRICS_MAX_SERIES:
+            name = "other"
+        stat = METRICS.setdefault((kind, name), LatencyStat())
+    stat.observe(seconds, error)
+
+def _callback_route(data: str) -> str:
+    # "approve:<payment_id>" -> "approve"; plain button data is its own route
+    return (data or "").split(":", 1)[0]
+
+def timed(callback):
+    """Wrap a PTB handler callback so its latency and failures are recorded."""
+    if not METRICS_ENABLED:
+        return callback
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        route = name
+        if isinstance(update, Update) and update.callback_query:
+            route = f"{name}:{_callback_route(update.callback_query.data)}"
+        started = time.perf_counter()
+        error = False
+        try:
+            return await callback(update, context)
+        except Exception:
+            error = True
+            raise
+        finally:
+            observe("handler", route, time.perf_counter() - started, error)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call by method name."""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        if not METRICS_ENABLED:
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        error = True
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            error = code != 200
+            return code, payload
+        finally:
+            observe("telegram_api", endpoint, time.perf_counter() - started, error)
+
+def _fmt_seconds(s: float) -> str:
+    if s == float("inf"):
+        return f">{LATENCY_BUCKETS[-1]:g}s"
+    return f"{s * 1000:.0f}ms" if s < 1 else f"{s:.1f}s"
+
+def metrics_summary() -> str:
+    """Human-readable summary for the /metrics command."""
+    uptime = int(time.time() - METRICS_STARTED)
+    lines = [f"📈 Metrics (up {uptime // 3600}h {uptime % 3600 // 60}m)"]
+    titles = {
+        "handler": "Handlers",
+        "telegram_api": "Telegram API",
+        "outbound_queue": "Outbound queue wait",
+        "persistence": "Persistence",
+    }
+    for kind, title in titles.items():
+        rows = sorted(((n, s) for (k, n), s in METRICS.items() if k == kind), key=lambda r: -r[1].total)
+        if not rows:
+            continue
+        lines.append(f"\n{title}:")
+        for name, s in rows:
+            lines.append(
+                f"{name}: n={s.count} err={s.errors} avg={_fmt_seconds(s.total / s.count)} "
+                f"p50≤{_fmt_seconds(s.quantile(0.5))} p99≤{_fmt_seconds(s.quantile(0.99))}"
+            )
+    lines.append(f"\nPending payments: {len(PENDING_PAYMENTS)} | Known users: {len(KNOWN_USERS)}")
+    return "\n".join(lines)
+
+def metrics_text() -> str:
+    """Prometheus text exposition of METRICS plus a few state gauges."""
+    out = [
+        "# HELP paymentbot_latency_seconds Latency of handlers, Bot API calls and persistence flushes.",
+        "# TYPE paymentbot_latency_seconds histogram",
+    ]
+    errors = []
+    for (kind, name), s in sorted(METRICS.items()):
+        labels = f'kind="{kind}",name="{name}"'
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, s.buckets):
+            cumulative += n
+            out.append(f'paymentbot_latency_seconds_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+        out.append(f'paymentbot_latency_seconds_bucket{{{labels},le="+Inf"}} {s.count}')
+        out.append(f"paymentbot_latency_seconds_sum{{{labels}}} {s.total:.6f}")
+        out.append(f"paymentbot_latency_seconds_count{{{labels}}} {s.count}")
+        errors.append(f"paymentbot_errors_total{{{labels}}} {s.errors}")
+    out.append("# HELP paymentbot_errors_total Failed handler runs, Bot API calls and flushes.")
+    out.append("# TYPE paymentbot_errors_total counter")
+    out.extend(errors)
+    if THROTTLES:
+        out.append("# HELP paymentbot_throttled_total Updates dropped by the per-user anti-flood limits.")
+        out.append("# TYPE paymentbot_throttled_total counter")
+        for t in THROTTLES.values():
+            out.append(f'paymentbot_throttled_total{{handler="{t.name}"}} {t.dropped}')
+    for name, value, help_text in (
+        ("pending_payments", len(PENDING_PAYMENTS), "Payments waiting for review."),
+        ("known_users", len(KNOWN_USERS), "Users who started the bot."),
+        ("journal_buffer", len(_JOURNAL_BUFFER), "Mutations queued for the next flush."),
+    ):
+        out.append(f"# HELP paymentbot_{name} {help_text}")
+        out.append(f"# TYPE paymentbot_{name} gauge")
+        out.append(f"paymentbot_{name} {value}")
+    return "\n".join(out) + "\n"
+
 # Persistence helpers -------------------------------------------------------
+# Every mutation is described by one journal record (user_seen,
+# payment_pending, payment_resolved, purchase, invite_created, ...).  Handlers
+# update the in-memory state and queue the record with journal_event(); a
+# background task hands queued records to the storage backend (STORE) through
+# a thread executor, so handlers never block on disk I/O.
+_JOURNAL_SEQ = 0          # seq of the last record applied/queued
+_JOURNAL_BUFFER: list = []  # records queued but not yet written
+_FLUSH_LOCK = asyncio.Lock()
+_PERSIST_WAKEUP = None    # asyncio.Event, created by persistence_loop
+_PERSIST_TASK = None
+STORE = None              # StateStore, created by load_state()
+
 def _ensure_data_dir():
     try:
         Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
     except Exception as e:
         logger.exception("Could not ensure data dir: %s", e)
 
+def _serialize_purchase(p: dict) -> dict:
+    return {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in p.items()}
+
+def _deserialize_purchase(p: dict) -> dict:
+    p_copy = dict(p)
+    t = p_copy.get("time")
+    if isinstance(t, str):
+        try:
+            p_copy["time"] = datetime.fromisoformat(t)
+        except Exception:
+            # fallback: leave as string
+            pass
+    return p_copy
+
 def _serialize_state() -> dict:
-    """Return a JSON-serializable snapshot of runtime state."""
+    """Return a snapshot of runtime state.
+
+    Containers are copied so the result can be dumped from another thread
+    while handlers keep mutating the live state.  Purchase history is in
+    PurchaseLog.export() form (raw column bytes); everything else is
+    JSON-serializable.
+    """
     return {
-        "pending_payments": PENDING_PAYMENTS,
-        # convert datetimes in purchase log to ISO strings
-        "purchase_log": [
-            {**{k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in p.items()}}
-            for p in PURCHASE_LOG
-        ],
+        "journal_seq": _JOURNAL_SEQ,
+        "pending_payments": dict(PENDING_PAYMENTS),
+        "purchases": PURCHASE_LOG.export(),
+        "income_by_day": income_rollup_state(),
         "known_users": list(KNOWN_USERS),
         # SENT_INVITES: convert keys to strings for JSON
-        "sent_invites": {str(k): v for k, v in SENT_INVITES.items()},
+        "sent_invites": {str(k): dict(v) for k, v in SENT_INVITES.items()},
+        "broadcast_jobs": {k: dict(v) for k, v in BROADCAST_JOBS.items()},
+        "invite_pool": {str(k): list(v) for k, v in INVITE_POOL.items()},
+        "media_cache": dict(MEDIA_CACHE),
+        "proof_index": {k: dict(v) for k, v in PROOF_INDEX.items()},
+        "user_sessions": {str(k): dict(v) for k, v in USER_SESSIONS.items()},
+        "config": {"version": RUNTIME_CONFIG["version"], "values": dict(RUNTIME_CONFIG["values"])},
     }
 
 def _deserialize_state(data: dict):
     """Load JSON data into the runtime variables."""
-    global PENDING_PAYMENTS, PURCHASE_LOG, KNOWN_USERS, SENT_INVITES
+    global PENDING_PAYMENTS, KNOWN_USERS, SENT_INVITES, BROADCAST_JOBS, INVITE_POOL, MEDIA_CACHE
+    global PROOF_INDEX, USER_SESSIONS, _JOURNAL_SEQ
     if not data:
         return
+    _JOURNAL_SEQ = int(data.get("journal_seq", 0) or 0)
     PENDING_PAYMENTS = data.get("pending_payments", {}) or {}
-    PURCHASE_LOG = []
-    for p in data.get("purchase_log", []) or []:
-        # parse 'time' field back to datetime if present
-        p_copy = dict(p)
-        t = p_copy.get("time")
-        if isinstance(t, str):
-            try:
-                p_copy["time"] = datetime.fromisoformat(t)
-            except Exception:
-                # fallback: leave as string
-                pass
-        PURCHASE_LOG.append(p_copy)
+    if data.get("purchases"):
+        PURCHASE_LOG.load_json(data["purchases"])
+    else:
+        # snapshots written before the columnar store kept a list of dicts
+        PURCHASE_LOG.clear()
+        for p in data.get("purchase_log", []) or []:
+            PURCHASE_LOG.append(_deserialize_purchase(p))
     KNOWN_USERS = set(data.get("known_users", []) or [])
     sent = data.get("sent_invites", {}) or {}
     # convert keys back to int if possible
@@ -135,93 +782,1957 @@ def _deserialize_state(data: dict):
         except Exception:
             new_sent[k] = v
     SENT_INVITES = new_sent
+    BROADCAST_JOBS = data.get("broadcast_jobs", {}) or {}
+    INVITE_POOL = {int(k): v for k, v in (data.get("invite_pool", {}) or {}).items()}
+    MEDIA_CACHE = data.get("media_cache", {}) or {}
+    PROOF_INDEX = data.get("proof_index", {}) or {}
+    USER_SESSIONS = {int(k): v for k, v in (data.get("user_sessions", {}) or {}).items()}
+    if data.get("config"):
+        load_runtime_config(data["config"])
 
-def save_state():
-    """Atomically save runtime state to disk file."""
-    try:
+def _apply_event(rec: dict):
+    """Replay one journal record onto the runtime variables."""
+    event = rec.get("event")
+    if event == "user_seen":
+        KNOWN_USERS.add(rec["user_id"])
+    elif event == "user_removed":
+        KNOWN_USERS.discard(rec["user_id"])
+    elif event == "payment_pending":
+        PENDING_PAYMENTS[rec["payment_id"]] = rec["payment"]
+    elif event in ("payment_resolved", "payment_expired"):
+        PENDING_PAYMENTS.pop(rec["payment_id"], None)
+    elif event == "payment_contested":
+        if rec["payment_id"] in PENDING_PAYMENTS:
+            PENDING_PAYMENTS[rec["payment_id"]]["contested"] = True
+    elif event == "purchase":
+        PURCHASE_LOG.append(rec["purchase"])
+    elif event == "invite_created":
+        SENT_INVITES.setdefault(rec["user_id"], {})[rec["kind"]] = rec["link"]
+    elif event == "broadcast_saved":
+        BROADCAST_JOBS[rec["job"]["id"]] = rec["job"]
+    elif event == "broadcast_finished":
+        BROADCAST_JOBS.pop(rec["job_id"], None)
+    elif event == "invite_pooled":
+        INVITE_POOL.setdefault(rec["channel_id"], []).append(rec["link"])
+    elif event == "invite_taken":
+        pool = INVITE_POOL.get(rec["channel_id"], [])
+        if rec["link"] in pool:
+            pool.remove(rec["link"])
+    elif event == "invite_pool_reset":
+        INVITE_POOL.pop(rec["channel_id"], None)
+    elif event == "media_cached":
+        MEDIA_CACHE[rec["key"]] = rec["file_id"]
+    elif event == "media_dropped":
+        MEDIA_CACHE.pop(rec["key"], None)
+    elif event == "proof_indexed":
+        for key in rec["keys"]:
+            PROOF_INDEX[key] = rec["entry"]
+    elif event == "proof_released":
+        for key in rec["keys"]:
+            PROOF_INDEX.pop(key, None)
+    elif event == "session_saved":
+        USER_SESSIONS[rec["user_id"]] = rec["session"]
+    elif event == "session_dropped":
+        USER_SESSIONS.pop(rec["user_id"], None)
+    elif event == "config_set":
+        apply_config(rec["key"], rec["value"])
+    else:
+        logger.warning("Unknown journal event %r (seq %s) ignored", event, rec.get("seq"))
+
+class StateStore:
+    """Storage backend interface.
+
+    load() fills the runtime variables at startup; write() persists a batch of
+    journal records and is always called from a worker thread, one batch at a
+    time.  Purchase history is read back through iter_purchases() so backends
+    are free to keep it out of memory.
+    """
+    # whether PURCHASE_LOG holds the full history for this backend
+    purchases_in_memory = True
+    # set by load() when the snapshot carried INCOME_BY_DAY, sparing a rebuild
+    rollup_restored = False
+
+    def load(self):
+        raise NotImplementedError
+
+    def write(self, records: list):
+        raise NotImplementedError
+
+    def compaction_due(self) -> bool:
+        return False
+
+    def compact(self, payload: dict):
+        """Fold everything written so far into `payload` (a _serialize_state() snapshot)."""
+
+    def iter_purchases(self, start=None, end=None):
+        """Yield purchases with start <= time < end (either bound may be None)."""
+        return PURCHASE_LOG.scan(start, end)
+
+    def iter_daily_totals(self):
+        """Yield (ist_day, currency, plan, method, count, amount) for all history."""
+        return PURCHASE_LOG.daily_totals()
+
+    def iter_purchases_threaded(self, start=None, end=None):
+        """iter_purchases() for draining in a worker thread (see /export)."""
+        return self.iter_purchases(start, end)
+
+    def close(self):
+        pass
+
+class JsonStore(StateStore):
+    """Snapshot (SNAPSHOT_FILE or DATA_FILE) plus append-only journal (JOURNAL_FILE).
+
+    The journal is folded into a new snapshot once it is larger than
+    JOURNAL_COMPACT_BYTES.  A json snapshot is rewritten at parse speed, so
+    there the journal may also grow to the snapshot's size first, which keeps
+    the amortized cost per mutation constant; a binary snapshot is written
+    with bulk array copies, and a fixed threshold keeps the startup replay
+    (and so the time to first update) bounded however long history gets.  Snapshots remember the last seq they contain,
+    so replaying a journal that was not truncated yet is harmless.
+
+    Binary snapshots are memory-mapped: startup parses only the small hot
+    section (which carries the income rollup), and old purchases are copied
+    out of the mapping only when history is first read or re-snapshotted.
+    """
+
+    def __init__(self, data_file: str = None, journal_file: str = None, snapshot_file: str = None):
+        self.data_file = data_file or DATA_FILE
+        self.snapshot_file = snapshot_file or SNAPSHOT_FILE
+        self.journal_file = journal_file or JOURNAL_FILE
+        self.expired_file = EXPIRED_FILE
+        self.binary = SNAPSHOT_FORMAT != "json"
+        self.snapshot_bytes = 0
+        self._fh = None
+        self._lock = threading.Lock()
+
+    def _latest_snapshot(self):
+        # after a SNAPSHOT_FORMAT switch both files can exist; the newer one wins
+        found = [p for p in (self.snapshot_file, self.data_file) if os.path.exists(p)]
+        return max(found, key=os.path.getmtime) if found else None
+
+    def load(self):
+        path = self._latest_snapshot()
+        data = None
+        if path == self.snapshot_file:
+            data, history, self.snapshot_bytes = read_binary_snapshot(path)
+            _deserialize_state(data)
+            PURCHASE_LOG.attach(history)
+        elif path is not None:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+                self.snapshot_bytes = f.tell()
+            _deserialize_state(data)
+        if data is not None:
+            self.rollup_restored = restore_income_rollup(data.get("income_by_day"))
+            logger.info("Loaded state from %s", path)
+        else:
+            logger.info("No data file found at %s — starting fresh", self.snapshot_file if self.binary else self.data_file)
+        applied = self._replay()
+        if applied:
+            logger.info("Replayed %d journal records from %s", applied, self.journal_file)
+
+    def _replay(self) -> int:
+        """Apply journal records newer than the snapshot. Returns records applied."""
+        global _JOURNAL_SEQ
+        if not os.path.exists(self.journal_file):
+            return 0
+        base_seq = _JOURNAL_SEQ
+        applied = 0
+        with open(self.journal_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # torn write at the tail after a crash
+                    logger.warning("Skipping unreadable journal line")
+                    continue
+                seq = rec.get("seq", 0)
+                if seq <= base_seq:
+                    continue
+                _apply_event(rec)
+                if self.rollup_restored and rec.get("event") == "purchase":
+                    rollup_purchase(_deserialize_purchase(rec["purchase"]))
+                _JOURNAL_SEQ = max(_JOURNAL_SEQ, seq)
+                applied += 1
+        return applied
+
+    def write(self, records: list):
+        lines = "".join(
+            json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n" for rec in records
+        )
+        with self._lock:
+            if self._fh is None:
+                _ensure_data_dir()
+                self._fh = open(self.journal_file, "a", encoding="utf-8")
+            self._fh.write(lines)
+            self._fh.flush()
+        expired = [rec for rec in records if rec["event"] == "payment_expired"]
+        if expired:
+            # keep aged-out payments for auditing; they leave the snapshot
+            with open(self.expired_file, "a", encoding="utf-8") as f:
+                for rec in expired:
+                    f.write(json.dumps({"payment_id": rec["payment_id"], "expired_at": rec["expired_at"], **rec["payment"]},
+                                       ensure_ascii=False) + "\n")
+
+    def _journal_size(self) -> int:
+        try:
+            return os.path.getsize(self.journal_file)
+        except OSError:
+            return 0
+
+    def compaction_due(self) -> bool:
+        if self.binary:
+            return self._journal_size() >= JOURNAL_COMPACT_BYTES
+        return self._journal_size() >= max(JOURNAL_COMPACT_BYTES, self.snapshot_bytes)
+
+    def compact(self, payload: dict):
+        with self._lock:
+            offset = self._journal_size()
+        path = self.snapshot_file if self.binary else self.data_file
+        self.snapshot_bytes = self._write_snapshot(path, payload)
+        with self._lock:
+            self._truncate_journal(offset)
+        # the other format's snapshot (if any) is superseded now
+        stale = self.data_file if self.binary else self.snapshot_file
+        if os.path.exists(stale):
+            os.replace(stale, stale + ".old")
+        logger.info("Compacted journal into %s (seq %s)", path, payload["journal_seq"])
+
+    def _write_snapshot(self, path: str, payload: dict) -> int:
+        """Atomically write a snapshot and return its size in bytes."""
         _ensure_data_dir()
-        payload = _serialize_state()
-        tmp_fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR)
-        with os.fdopen(tmp_fd, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        if self.binary:
+            with os.fdopen(tmp_fd, "wb") as f:
+                write_binary_snapshot(f, payload)
+                size = f.tell()
+        else:
+            payload = dict(payload, purchases=PurchaseLog.export_json(payload["purchases"]))
+            with os.fdopen(tmp_fd, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+                size = f.tell()
         # atomic replace
-        shutil.move(tmp_path, DATA_FILE)
-        logger.info("State saved to %s", DATA_FILE)
+        shutil.move(tmp_path, path)
+        return size
+
+    def _truncate_journal(self, offset: int):
+        """Drop the first `offset` bytes of the journal. Caller holds self._lock."""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if not os.path.exists(self.journal_file):
+            return
+        with open(self.journal_file, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.journal_file))
+        with os.fdopen(tmp_fd, "wb") as f:
+            f.write(tail)
+        shutil.move(tmp_path, self.journal_file)
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+class SqliteStore(StateStore):
+    """Indexed SQLite database (DB_FILE) in WAL mode.
+
+    Users, pending payments, invites and small keyed records (the kv table,
+    e.g. broadcast jobs) are loaded at startup; purchase
+    history stays on disk and is queried by time range through the
+    purchases(time) index.  Statements are fixed parameterized strings, so
+    sqlite3's statement cache prepares each one once per connection.
+
+    In multi-worker mode every batch is also appended to the changes table,
+    which the other workers tail (see changes()), and each worker keeps its
+    own journal seq.
+    """
+    purchases_in_memory = False
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS pending_payments (
+        payment_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_pending_user ON pending_payments(user_id);
+    CREATE TABLE IF NOT EXISTS expired_payments (
+        payment_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        expired_at REAL,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS purchases (
+        id INTEGER PRIMARY KEY,
+        time REAL NOT NULL,
+        user_id INTEGER,
+        username TEXT,
+        plan TEXT,
+        method TEXT,
+        amount NUMERIC,
+        currency TEXT,
+        payment_id TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_purchases_time ON purchases(time);
+    CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id);
+    CREATE INDEX IF NOT EXISTS idx_purchases_payment ON purchases(payment_id);
+    CREATE TABLE IF NOT EXISTS invites (
+        user_id INTEGER,
+        kind TEXT,
+        link TEXT,
+        PRIMARY KEY (user_id, kind)
+    );
+    CREATE TABLE IF NOT EXISTS invite_pool (link TEXT PRIMARY KEY, channel_id INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        worker INTEGER NOT NULL,
+        at REAL NOT NULL,
+        record TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS claims (payment_id TEXT PRIMARY KEY, at REAL NOT NULL);
+    """
+    SQL_USER = "INSERT OR IGNORE INTO users (user_id) VALUES (?)"
+    SQL_USER_DEL = "DELETE FROM users WHERE user_id = ?"
+    SQL_PENDING = "INSERT OR REPLACE INTO pending_payments (payment_id, user_id, data) VALUES (?, ?, ?)"
+    SQL_RESOLVED = "DELETE FROM pending_payments WHERE payment_id = ?"
+    SQL_CONTESTED = "UPDATE pending_payments SET data = json_set(data, '$.contested', json('true')) WHERE payment_id = ?"
+    SQL_EXPIRED = (
+        "INSERT OR REPLACE INTO expired_payments (payment_id, user_id, expired_at, data) VALUES (?, ?, ?, ?)"
+    )
+    SQL_PURCHASE = (
+        "INSERT INTO purchases (time, user_id, username, plan, method, amount, currency, payment_id)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    SQL_INVITE = "INSERT OR REPLACE INTO invites (user_id, kind, link) VALUES (?, ?, ?)"
+    SQL_POOL_ADD = "INSERT OR IGNORE INTO invite_pool (link, channel_id) VALUES (?, ?)"
+    SQL_POOL_TAKE = "DELETE FROM invite_pool WHERE link = ?"
+    SQL_POOL_RESET = "DELETE FROM invite_pool WHERE channel_id = ?"
+    SQL_KV_SET = "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)"
+    SQL_KV_DEL = "DELETE FROM kv WHERE key = ?"
+    SQL_GET_SEQ = "SELECT value FROM meta WHERE key = ?"
+    SQL_SET_SEQ = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+    SQL_CHANGE = "INSERT INTO changes (worker, at, record) VALUES (?, ?, ?)"
+    SQL_CHANGES_SINCE = "SELECT seq, record FROM changes WHERE seq > ? AND worker != ? ORDER BY seq"
+    SQL_CLAIM = "INSERT OR IGNORE INTO claims (payment_id, at) VALUES (?, ?)"
+    SQL_PURCHASES_RANGE = (
+        "SELECT time, user_id, username, plan, method, amount, currency, payment_id"
+        " FROM purchases WHERE time >= ? AND time < ? ORDER BY time"
+    )
+    SQL_DAILY_TOTALS = (
+        "SELECT date(time + ?, 'unixepoch') AS day, currency, plan, method, COUNT(*), SUM(amount)"
+        " FROM purchases GROUP BY day, currency, plan, method"
+    )
+
+    def __init__(self, db_file: str = None):
+        self.db_file = db_file or DB_FILE
+        _ensure_data_dir()
+        # writer is used from executor threads (one batch at a time), reader
+        # from the event loop; WAL lets them run concurrently
+        self._wconn = self._connect()
+        self._wconn.executescript(self.SCHEMA)
+        self._rconn = self._connect()
+        self._lock = threading.Lock()
+        self.worker = WORKER_ID if RUN_MODE == "worker" else None
+        self.seq_key = "journal_seq" if self.worker is None else f"journal_seq:{self.worker}"
+        self.change_seq = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _is_empty(self) -> bool:
+        return self._rconn.execute("SELECT 1 FROM meta WHERE key = 'journal_seq'").fetchone() is None
+
+    def load(self):
+        global PENDING_PAYMENTS, KNOWN_USERS, SENT_INVITES, BROADCAST_JOBS, INVITE_POOL, MEDIA_CACHE
+        global PROOF_INDEX, USER_SESSIONS, _JOURNAL_SEQ
+        if self._is_empty() and any(os.path.exists(p) for p in (SNAPSHOT_FILE, DATA_FILE, JOURNAL_FILE)):
+            migrate_json_to_sqlite(self)
+        conn = self._rconn
+        # one read transaction, so change_seq matches what was loaded
+        conn.execute("BEGIN")
+        row = conn.execute(self.SQL_GET_SEQ, (self.seq_key,)).fetchone()
+        _JOURNAL_SEQ = int(row[0]) if row else 0
+        self.change_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        KNOWN_USERS = {r[0] for r in conn.execute("SELECT user_id FROM users")}
+        PENDING_PAYMENTS = {
+            pid: json.loads(data) for pid, data in conn.execute("SELECT payment_id, data FROM pending_payments")
+        }
+        SENT_INVITES = {}
+        for uid, kind, link in conn.execute("SELECT user_id, kind, link FROM invites"):
+            SENT_INVITES.setdefault(uid, {})[kind] = link
+        INVITE_POOL = {}
+        for link, channel_id in conn.execute("SELECT link, channel_id FROM invite_pool ORDER BY rowid"):
+            INVITE_POOL.setdefault(channel_id, []).append(link)
+        BROADCAST_JOBS = {}
+        MEDIA_CACHE = {}
+        PROOF_INDEX = {}
+        USER_SESSIONS = {}
+        for key, value in conn.execute("SELECT key, value FROM kv"):
+            kind, _, ident = key.partition(":")
+            if kind == "broadcast":
+                BROADCAST_JOBS[ident] = json.loads(value)
+            elif kind == "media":
+                MEDIA_CACHE[ident] = json.loads(value)
+            elif kind == "proof":
+                PROOF_INDEX[ident] = json.loads(value)
+            elif kind == "session":
+                USER_SESSIONS[int(ident)] = json.loads(value)
+            elif kind == "config":
+                load_runtime_config(json.loads(value))
+        conn.execute("COMMIT")
+        logger.info(
+            "Loaded state from %s (%d users, %d pending)", self.db_file, len(KNOWN_USERS), len(PENDING_PAYMENTS)
+        )
+
+    def write(self, records: list):
+        with self._lock:
+            conn = self._wconn
+            row = conn.execute(self.SQL_GET_SEQ, (self.seq_key,)).fetchone()
+            last_seq = int(row[0]) if row else 0
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for rec in records:
+                    if rec["seq"] <= last_seq:
+                        continue
+                    self._apply(conn, rec)
+                    if self.worker is not None:
+                        conn.execute(self.SQL_CHANGE, (self.worker, time.time(), json.dumps(rec)))
+                    last_seq = rec["seq"]
+                conn.execute(self.SQL_SET_SEQ, (self.seq_key, str(last_seq)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _apply(self, conn, rec: dict):
+        event = rec.get("event")
+        if event == "user_seen":
+            conn.execute(self.SQL_USER, (rec["user_id"],))
+        elif event == "user_removed":
+            conn.execute(self.SQL_USER_DEL, (rec["user_id"],))
+        elif event == "payment_pending":
+            payment = rec["payment"]
+            conn.execute(self.SQL_PENDING, (rec["payment_id"], payment.get("user_id"), json.dumps(payment)))
+        elif event == "payment_resolved":
+            conn.execute(self.SQL_RESOLVED, (rec["payment_id"],))
+        elif event == "payment_contested":
+            conn.execute(self.SQL_CONTESTED, (rec["payment_id"],))
+        elif event == "payment_expired":
+            payment = rec["payment"]
+            conn.execute(self.SQL_RESOLVED, (rec["payment_id"],))
+            conn.execute(self.SQL_EXPIRED, (rec["payment_id"], payment.get("user_id"), rec["expired_at"], json.dumps(payment)))
+        elif event == "purchase":
+            p = _deserialize_purchase(rec["purchase"])
+            t = p.get("time")
+            conn.execute(self.SQL_PURCHASE, (
+                t.timestamp() if isinstance(t, datetime) else 0,
+                p.get("user_id"), p.get("username"), p.get("plan"), p.get("method"),
+                p.get("amount"), p.get("currency"), p.get("payment_id"),
+            ))
+        elif event == "invite_created":
+            conn.execute(self.SQL_INVITE, (rec["user_id"], rec["kind"], rec["link"]))
+        elif event == "broadcast_saved":
+            conn.execute(self.SQL_KV_SET, ("broadcast:" + rec["job"]["id"], json.dumps(rec["job"])))
+        elif event == "broadcast_finished":
+            conn.execute(self.SQL_KV_DEL, ("broadcast:" + rec["job_id"],))
+        elif event == "media_cached":
+            conn.execute(self.SQL_KV_SET, ("media:" + rec["key"], json.dumps(rec["file_id"])))
+        elif event == "media_dropped":
+            conn.execute(self.SQL_KV_DEL, ("media:" + rec["key"],))
+        elif event == "proof_indexed":
+            value = json.dumps(rec["entry"])
+            conn.executemany(self.SQL_KV_SET, [("proof:" + key, value) for key in rec["keys"]])
+        elif event == "proof_released":
+            conn.executemany(self.SQL_KV_DEL, [("proof:" + key,) for key in rec["keys"]])
+        elif event == "session_saved":
+            conn.execute(self.SQL_KV_SET, (f"session:{rec['user_id']}", json.dumps(rec["session"])))
+        elif event == "session_dropped":
+            conn.execute(self.SQL_KV_DEL, (f"session:{rec['user_id']}",))
+        elif event == "config_set":
+            row = conn.execute("SELECT value FROM kv WHERE key = 'config'").fetchone()
+            config = json.loads(row[0]) if row else {"version": 0, "values": {}}
+            config["values"][rec["key"]] = rec["value"]
+            config["version"] += 1
+            conn.execute(self.SQL_KV_SET, ("config", json.dumps(config)))
+        elif event == "invite_pooled":
+            conn.execute(self.SQL_POOL_ADD, (rec["link"], rec["channel_id"]))
+        elif event == "invite_taken":
+            conn.execute(self.SQL_POOL_TAKE, (rec["link"],))
+        elif event == "invite_pool_reset":
+            conn.execute(self.SQL_POOL_RESET, (rec["channel_id"],))
+        else:
+            logger.warning("Unknown journal event %r (seq %s) ignored", event, rec.get("seq"))
+
+    def compact(self, payload: dict):
+        with self._lock:
+            self._wconn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def claim_pending(self, payment_id: str) -> bool:
+        """Take a pending payment for resolving; False if another worker already has.
+
+        Claims have a table of their own so they don't depend on the
+        payment_pending record having been flushed yet.
+        """
+        with self._lock:
+            return self._wconn.execute(self.SQL_CLAIM, (payment_id, time.time())).rowcount > 0
+
+    def claim_txid(self, txid: str) -> bool:
+        """Take a TXID for one auto-approval; False if another payment already has.
+
+        TXID claims share the claims table (keyed "txid:<txid>") and are never pruned.
+        """
+        return self.claim_pending("txid:" + txid)
+
+    def changes(self) -> list:
+        """Records other workers committed since the last call (or since load()).
+
+        Called from an executor thread, so it reads through the writer
+        connection under its lock rather than the event loop's reader.
+        """
+        with self._lock:
+            rows = self._wconn.execute(self.SQL_CHANGES_SINCE, (self.change_seq, self.worker)).fetchall()
+        if rows:
+            self.change_seq = rows[-1][0]
+        return [json.loads(record) for _, record in rows]
+
+    def prune_changes(self, before: float):
+        with self._lock:
+            self._wconn.execute("DELETE FROM changes WHERE at < ?", (before,))
+            self._wconn.execute("DELETE FROM claims WHERE at < ? AND payment_id NOT LIKE 'txid:%'", (before,))
+
+    def iter_purchases(self, start=None, end=None):
+        return self._iter_purchases(self._rconn, start, end)
+
+    def iter_purchases_threaded(self, start=None, end=None):
+        # a connection of its own, so a long export never shares a cursor
+        # with the event loop's reads
+        conn = sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True)
+        try:
+            yield from self._iter_purchases(conn, start, end)
+        finally:
+            conn.close()
+
+    def _iter_purchases(self, conn, start, end):
+        lo = start.timestamp() if start is not None else float("-inf")
+        hi = end.timestamp() if end is not None else float("inf")
+        cur = conn.execute(self.SQL_PURCHASES_RANGE, (lo, hi))
+        cols = ("time", "user_id", "username", "plan", "method", "amount", "currency", "payment_id")
+        while True:
+            rows = cur.fetchmany(500)
+            if not rows:
+                break
+            for row in rows:
+                p = dict(zip(cols, row))
+                p["time"] = datetime.fromtimestamp(p["time"], IST)
+                yield p
+
+    def iter_daily_totals(self):
+        offset = IST.utcoffset(None).total_seconds()
+        for day, currency, plan, method, count, amount in self._rconn.execute(self.SQL_DAILY_TOTALS, (offset,)):
+            yield date.fromisoformat(day), currency, plan, method, count, amount
+
+    def close(self):
+        with self._lock:
+            self._wconn.close()
+        self._rconn.close()
+
+def migrate_json_to_sqlite(store: "SqliteStore"):
+    """One-shot import of an existing json-backend snapshot (+ journal) into SQLite.
+
+    The old files are renamed with a .migrated suffix afterwards so the
+    import never runs twice.
+    """
+    logger.info("Migrating %s into %s", DATA_DIR, store.db_file)
+    JsonStore().load()
+    records = []
+    seq = 0
+    for uid in KNOWN_USERS:
+        seq += 1
+        records.append({"seq": seq, "event": "user_seen", "user_id": uid})
+    for pid, payment in PENDING_PAYMENTS.items():
+        seq += 1
+        records.append({"seq": seq, "event": "payment_pending", "payment_id": pid, "payment": payment})
+    for p in PURCHASE_LOG:
+        seq += 1
+        records.append({"seq": seq, "event": "purchase", "purchase": _serialize_purchase(p)})
+    for uid, links in SENT_INVITES.items():
+        for kind, link in links.items():
+            seq += 1
+            records.append({"seq": seq, "event": "invite_created", "user_id": uid, "kind": kind, "link": link})
+    for job in BROADCAST_JOBS.values():
+        seq += 1
+        records.append({"seq": seq, "event": "broadcast_saved", "job": job})
+    for channel_id, links in INVITE_POOL.items():
+        for link in links:
+            seq += 1
+            records.append({"seq": seq, "event": "invite_pooled", "channel_id": channel_id, "link": link})
+    for key, file_id in MEDIA_CACHE.items():
+        seq += 1
+        records.append({"seq": seq, "event": "media_cached", "key": key, "file_id": file_id})
+    for key, entry in PROOF_INDEX.items():
+        seq += 1
+        records.append({"seq": seq, "event": "proof_indexed", "keys": [key], "entry": entry})
+    for uid, session in USER_SESSIONS.items():
+        seq += 1
+        records.append({"seq": seq, "event": "session_saved", "user_id": uid, "session": session})
+    for key, value in RUNTIME_CONFIG["values"].items():
+        seq += 1
+        records.append({"seq": seq, "event": "config_set", "key": key, "value": value})
+    store.write(records)
+    PURCHASE_LOG.clear()
+    for path in (SNAPSHOT_FILE, DATA_FILE, JOURNAL_FILE):
+        if os.path.exists(path):
+            os.replace(path, path + ".migrated")
+    logger.info("Migrated %d records into %s", len(records), store.db_file)
+
+def make_store() -> StateStore:
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore()
+    if STORAGE_BACKEND != "json":
+        logger.warning("Unknown STORAGE_BACKEND %r, using json", STORAGE_BACKEND)
+    return JsonStore()
+
+def journal_event(event: str, **fields):
+    """Queue one mutation record for the storage backend.
+
+    Nothing touches the disk here; the persistence task flushes the buffer
+    in a thread executor (see persistence_loop).
+    """
+    global _JOURNAL_SEQ
+    _JOURNAL_SEQ += 1
+    _JOURNAL_BUFFER.append({"seq": _JOURNAL_SEQ, "event": event, **fields})
+    urgent = MULTI_WORKER and event in SHARED_URGENT_EVENTS
+    if (urgent or len(_JOURNAL_BUFFER) >= PERSIST_MAX_PENDING) and _PERSIST_WAKEUP is not None:
+        _PERSIST_WAKEUP.set()
+
+def add_purchase(purchase: dict):
+    """Record an approved sale."""
+    if STORE is None or STORE.purchases_in_memory:
+        PURCHASE_LOG.append(purchase)
+    rollup_purchase(purchase)
+    journal_event("purchase", purchase=_serialize_purchase(purchase))
+
+# Runtime config --------------------------------------------------------------
+# Settings admins change from chat (/set_price, /set_upi, ...) are journaled
+# as config_set records.  The store keeps them in one versioned record that
+# is applied over the env defaults at load, and in multi-worker mode the
+# records reach every worker through the change feed.
+CONFIG_KEYS = ("PRICE_CONFIG", "UPI_ID", "CRYPTO_ADDRESS", "REMITLY_INFO", "VIP_CHANNEL_ID", "DARK_CHANNEL_ID")
+RUNTIME_CONFIG: Dict[str, Any] = {"version": 0, "values": {}}
+
+def apply_config(key: str, value):
+    if key not in CONFIG_KEYS:
+        logger.warning("Ignoring unknown config key %r", key)
+        return
+    globals()[key] = value
+    RUNTIME_CONFIG["values"][key] = value
+    RUNTIME_CONFIG["version"] += 1
+
+def load_runtime_config(config: dict):
+    """Apply a stored config record (see RUNTIME_CONFIG) over the env defaults."""
+    for key, value in config.get("values", {}).items():
+        apply_config(key, value)
+    RUNTIME_CONFIG["version"] = config.get("version", 0)
+
+def set_config(key: str, value):
+    """Change a setting here, in the store, and (multi-worker) in every worker."""
+    value = json.loads(json.dumps(value))  # detached copy; PRICE_CONFIG is edited in place
+    apply_config(key, value)
+    journal_event("config_set", key=key, value=value)
+    logger.info("Config v%d: %s updated", RUNTIME_CONFIG["version"], key)
+
+async def flush_state():
+    """Write buffered records and, if due, compact — all off the event loop."""
+    global _JOURNAL_BUFFER
+    loop = asyncio.get_running_loop()
+    async with _FLUSH_LOCK:
+        if _JOURNAL_BUFFER:
+            records, _JOURNAL_BUFFER = _JOURNAL_BUFFER, []
+            started = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, STORE.write, records)
+                if METRICS_ENABLED:
+                    observe("persistence", "write", time.perf_counter() - started)
+            except Exception as e:
+                if METRICS_ENABLED:
+                    observe("persistence", "write", time.perf_counter() - started, error=True)
+                logger.exception("Failed to persist %d records: %s", len(records), e)
+                # keep them for the next attempt, ahead of anything queued meanwhile
+                _JOURNAL_BUFFER = records + _JOURNAL_BUFFER
+                return
+        if not STORE.compaction_due():
+            return
+        # capture state and seq together on the loop thread; records queued
+        # from here on have a higher seq and are skipped on replay if they
+        # also end up in the next journal
+        started = time.perf_counter()
+        payload = _serialize_state()
+        try:
+            await loop.run_in_executor(None, STORE.compact, payload)
+            if METRICS_ENABLED:
+                observe("persistence", "compact", time.perf_counter() - started)
+        except Exception as e:
+            if METRICS_ENABLED:
+                observe("persistence", "compact", time.perf_counter() - started, error=True)
+            logger.exception("Failed to compact state: %s", e)
+
+def flush_state_sync():
+    """Last-resort synchronous flush of buffered records (shutdown/atexit)."""
+    global _JOURNAL_BUFFER
+    if not _JOURNAL_BUFFER or STORE is None:
+        return
+    records, _JOURNAL_BUFFER = _JOURNAL_BUFFER, []
+    try:
+        STORE.write(records)
+        logger.info("Flushed %d records on exit", len(records))
+    except Exception as e:
+        logger.exception("Failed to flush state on exit: %s", e)
+
+async def persistence_loop():
+    """Flush at most once per PERSIST_INTERVAL, or sooner after PERSIST_MAX_PENDING mutations."""
+    global _PERSIST_WAKEUP
+    _PERSIST_WAKEUP = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(_PERSIST_WAKEUP.wait(), timeout=PERSIST_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _PERSIST_WAKEUP.clear()
+        # shielded so cancelling the loop at shutdown never abandons a
+        # half-done flush; the final flush then queues behind it on _FLUSH_LOCK
+        await asyncio.shield(flush_state())
+
+def save_state():
+    """Write everything queued and compact the store (synchronous)."""
+    try:
+        flush_state_sync()
+        STORE.compact(_serialize_state())
+        logger.info("State saved")
     except Exception as e:
         logger.exception("Failed to save state: %s", e)
 
 def load_state():
-    """Load state from disk if file exists."""
+    """Open the configured storage backend and load runtime state from it."""
+    global STORE
     try:
-        if not os.path.exists(DATA_FILE):
-            logger.info("No data file found at %s — starting fresh", DATA_FILE)
-            return
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        _deserialize_state(data)
-        logger.info("Loaded state from %s", DATA_FILE)
+        STORE = make_store()
+        STORE.load()
+        if not STORE.rollup_restored:
+            rebuild_income_rollup()
     except Exception as e:
         logger.exception("Failed to load state: %s", e)
 
+# Session persistence ---------------------------------------------------------
+# PTB hands over the user_data of every user an update touched, every
+# SESSION_FLUSH_INTERVAL seconds.  Only the payment-flow keys of users with
+# an open proof window are kept, and an entry is journaled only when it
+# differs from the stored one, so I/O follows changes rather than users.
+# Windows that close (or expired while the bot was down) are evicted.
+SESSION_KEYS = ("selected_plan", "waiting_for_proof", "payment_deadline", "window_expired")
+
+def session_state(user_data: dict, now: float = None):
+    """The part of `user_data` worth persisting, or None once its window has closed."""
+    deadline = user_data.get("payment_deadline")
+    if not deadline or deadline <= (now or time.time()):
+        return None
+    return {k: user_data[k] for k in SESSION_KEYS if user_data.get(k) is not None}
+
+class SessionPersistence(BasePersistence):
+    """BasePersistence for user_data only, stored through the journal."""
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=SESSION_FLUSH_INTERVAL,
+        )
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        now = time.time()
+        for user_id, session in list(USER_SESSIONS.items()):
+            if session_state(session, now) is None:
+                await self.drop_user_data(user_id)
+        return {user_id: dict(session) for user_id, session in USER_SESSIONS.items()}
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        session = session_state(data)
+        if session is None:
+            await self.drop_user_data(user_id)
+        elif session != USER_SESSIONS.get(user_id):
+            USER_SESSIONS[user_id] = session
+            journal_event("session_saved", user_id=user_id, session=session)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if USER_SESSIONS.pop(user_id, None) is not None:
+            journal_event("session_dropped", user_id=user_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # the journal itself is flushed by post_shutdown
+        pass
+
+# Income rollups --------------------------------------------------------------
+# Per-IST-day totals keyed by (currency, plan, method), updated on every
+# approval, so /income costs O(days) not O(purchases).  json-backend
+# snapshots carry a copy, so a restart only rebuilds it when they don't.
+INCOME_BY_DAY: Dict[date, Dict[tuple, list]] = {}
+
+def _rollup_add(day: date, currency, plan, method, count: int, amount):
+    row = INCOME_BY_DAY.setdefault(day, {}).setdefault((currency, plan, method), [0, 0])
+    row[0] += count
+    row[1] += amount
+
+def rollup_purchase(p: dict):
+    t = p.get("time")
+    if isinstance(t, datetime):
+        _rollup_add(t.astimezone(IST).date(), p.get("currency"), p.get("plan"), p.get("method"), 1, p.get("amount") or 0)
+
+def income_rollup_state() -> dict:
+    """INCOME_BY_DAY as {"YYYY-MM-DD": [[currency, plan, method, count, amount], ...]}."""
+    return {day.isoformat(): [[*key, *totals] for key, totals in groups.items()]
+            for day, groups in INCOME_BY_DAY.items()}
+
+def restore_income_rollup(data) -> bool:
+    """Load an income_rollup_state() dict; False if the snapshot had none."""
+    if data is None:
+        return False
+    INCOME_BY_DAY.clear()
+    for day, rows in data.items():
+        for currency, plan, method, count, amount in rows:
+            _rollup_add(date.fromisoformat(day), currency, plan, method, count, amount)
+    return True
+
+def rebuild_income_rollup():
+    INCOME_BY_DAY.clear()
+    for day, currency, plan, method, count, amount in STORE.iter_daily_totals():
+        _rollup_add(day, currency, plan, method, count, amount or 0)
+
+def income_totals(first: date, last: date, group_by: str = None) -> Dict[Any, Dict[str, Any]]:
+    """Sum the rollup over first..last (inclusive).
+
+    Returns {group: {"count", "INR", "USD"}}; group is the plan or method
+    when `group_by` is "plan"/"method", otherwise None.
+    """
+    result: Dict[Any, Dict[str, Any]] = {}
+    day = first
+    while day <= last:
+        for (currency, plan, method), (count, amount) in INCOME_BY_DAY.get(day, {}).items():
+            group = plan if group_by == "plan" else method if group_by == "method" else None
+            row = result.setdefault(group, {"count": 0, "INR": 0, "USD": 0})
+            row["count"] += count
+            if currency in ("INR", "USD"):
+                row[currency] += amount
+        day += timedelta(days=1)
+    return result
+
+# ----------------- RATE LIMITING -----------------
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, up to `capacity` banked."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+def retry_after_seconds(exc: RetryAfter) -> float:
+    ra = exc.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+# Outbound scheduler ---------------------------------------------------------
+# Every Bot API call that posts into a chat (send*, forward*, copy*, edit*)
+# waits for a turn from OUTBOUND before it goes out.  Turns are handed out
+# by priority class: interactive replies, then admin notifications, then
+# approval messages / invites, then broadcasts and other bulk sends.  Code
+# picks its class with outbound_priority() (or OUTBOUND_PRIORITY.set() at
+# the top of a background task); anything unmarked is interactive.  A 429
+# pauses every sender and the call is retried here, so handlers rarely see
+# RetryAfter.  Other calls (getUpdates, answerCallbackQuery,
+# createChatInviteLink, ...) bypass the queue.
+PRIORITY_INTERACTIVE, PRIORITY_ADMIN, PRIORITY_APPROVAL, PRIORITY_BULK = range(4)
+PRIORITY_NAMES = ("interactive", "admin", "approval", "bulk")
+OUTBOUND_PRIORITY = contextvars.ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+_SCHEDULED_PREFIXES = ("send", "forward", "copy", "edit")
+
+@contextlib.contextmanager
+def outbound_priority(priority: int):
+    token = OUTBOUND_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        OUTBOUND_PRIORITY.reset(token)
+
+class OutboundScheduler:
+    """Global token bucket plus one small bucket per chat, handing turns to
+    the highest-priority waiter first.
+
+    With nobody queued a call takes a token straight away; otherwise it joins
+    its class's FIFO and a single pump task hands out turns as tokens refill,
+    skipping waiters whose chat has no token yet.  Per-chat buckets live in
+    an LRU capped at `max_chats` so memory stays bounded.  pause() is used on
+    RetryAfter: Telegram's flood wait applies to the whole bot, so every
+    sender waits it out.
+    """
+
+    def __init__(self, rate: float, per_chat_rate: float, per_chat_burst: float = 1.0, max_chats: int = 10000):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_chats = max_chats
+        self.chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.paused_until = 0.0
+        self.queues = [deque() for _ in PRIORITY_NAMES]
+        self._pump_task = None
+        self._wakeup = None
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self.chats.get(chat_id)
+        if b is None:
+            b = self.chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            if len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        return b
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def waiting(self) -> list:
+        return [len(q) for q in self.queues]
+
+    async def acquire(self, chat_id, priority: int = PRIORITY_INTERACTIVE):
+        now = time.monotonic()
+        if not any(self.queues) and self.paused_until <= now and self.bucket.delay(now) <= 0:
+            chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            if chat_bucket is None or chat_bucket.delay(now) <= 0:
+                self.bucket.consume()
+                if chat_bucket is not None:
+                    chat_bucket.consume()
+                return
+        turn = asyncio.get_running_loop().create_future()
+        self.queues[priority].append((chat_id, turn))
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+        else:
+            self._wakeup.set()
+        await turn
+
+    async def _sleep(self, seconds: float):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def _next(self, now: float):
+        """Pop the first waiter (by class, then FIFO) whose chat may send now.
+
+        Returns ((chat_id, future), 0) or (None, seconds until some chat frees up).
+        """
+        soonest = float("inf")
+        for queue in self.queues:
+            for entry in list(queue):
+                chat_id, turn = entry
+                if turn.done():   # caller was cancelled
+                    queue.remove(entry)
+                    continue
+                wait = self._chat_bucket(chat_id).delay(now) if chat_id is not None else 0.0
+                if wait <= 0:
+                    queue.remove(entry)
+                    return entry, 0.0
+                soonest = min(soonest, wait)
+        return None, soonest
+
+    async def _pump(self):
+        while any(self.queues):
+            now = time.monotonic()
+            wait = max(self.paused_until - now, self.bucket.delay(now))
+            if wait > 0:
+                await self._sleep(wait)
+                continue
+            entry, wait = self._next(now)
+            if entry is None:
+                if wait != float("inf"):   # else only cancelled waiters were left
+                    await self._sleep(wait)
+                continue
+            chat_id, turn = entry
+            self.bucket.consume()
+            if chat_id is not None:
+                self._chat_bucket(chat_id).consume()
+            turn.set_result(None)
+
+OUTBOUND = OutboundScheduler(OUTBOUND_RATE or 1.0, OUTBOUND_PER_CHAT_RATE, OUTBOUND_PER_CHAT_BURST)
+
+def is_scheduled_call(endpoint: str) -> bool:
+    return OUTBOUND_RATE > 0 and endpoint.startswith(_SCHEDULED_PREFIXES)
+
+async def outbound_turn(endpoint: str, chat_id) -> None:
+    """Wait until a Bot API call may go out (returns at once for unscheduled calls)."""
+    if not is_scheduled_call(endpoint):
+        return
+    priority = OUTBOUND_PRIORITY.get()
+    started = time.perf_counter()
+    await OUTBOUND.acquire(chat_id, priority)
+    if METRICS_ENABLED:
+        observe("outbound_queue", PRIORITY_NAMES[priority], time.perf_counter() - started)
+
+class ScheduledRequest(InstrumentedRequest):
+    """Request backend that routes chat-bound calls through OUTBOUND."""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        chat_id = request_data.parameters.get("chat_id") if request_data is not None else None
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            await outbound_turn(endpoint, chat_id)
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            if code != 429 or attempt == OUTBOUND_MAX_RETRIES or not is_scheduled_call(endpoint):
+                return code, payload
+            try:
+                retry_after = json.loads(payload)["parameters"]["retry_after"]
+            except (ValueError, KeyError, TypeError):
+                retry_after = 1
+            logger.warning("Flood control on %s, pausing outbound sends for %ss", endpoint, retry_after)
+            OUTBOUND.pause(float(retry_after))
+        return code, payload
+
+# Anti-flood ------------------------------------------------------------------
+# Each throttled handler gets a UserThrottle: one token bucket per user in an
+# LRU ordered by last activity, so idle users fall off the front and memory
+# stays bounded.  An update over the limit is dropped; only the first drop
+# of a streak gets a reply, telling the user to slow down.
+THROTTLE_WARNING = "⏳ You're sending messages too fast. Please wait a minute — extra messages are ignored."
+
+class UserThrottle:
+    def __init__(self, name: str, limit: str, idle_seconds: float, max_users: int):
+        count, _, seconds = limit.partition("/")
+        self.name = name
+        self.limit = limit
+        self.capacity = float(count)
+        self.rate = self.capacity / float(seconds or 60)
+        self.idle_seconds = idle_seconds
+        self.max_users = max_users
+        self.users: "OrderedDict[int, list]" = OrderedDict()  # user_id -> [bucket, last_seen, dropped, warned]
+        self.allowed = 0
+        self.dropped = 0
+        self.warnings = 0
+        self.evicted = 0
+
+    def _expire(self, now: float):
+        while self.users:
+            entry = next(iter(self.users.values()))
+            if now - entry[1] < self.idle_seconds and len(self.users) <= self.max_users:
+                break
+            self.users.popitem(last=False)
+            self.evicted += 1
+
+    def check(self, user_id: int) -> str:
+        """Return "ok" (handle the update), "warn" (reply with a warning) or "drop"."""
+        now = time.monotonic()
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = self.users[user_id] = [TokenBucket(self.rate, self.capacity), now, 0, False]
+        else:
+            self.users.move_to_end(user_id)
+            entry[1] = now
+        self._expire(now)
+        if entry[0].delay(now) <= 0:
+            entry[0].consume()
+            entry[3] = False
+            self.allowed += 1
+            return "ok"
+        entry[2] += 1
+        self.dropped += 1
+        if entry[3]:
+            return "drop"
+        entry[3] = True
+        self.warnings += 1
+        return "warn"
+
+    def top_offenders(self, n: int = 5) -> list:
+        return sorted(((e[2], uid) for uid, e in self.users.items() if e[2]), reverse=True)[:n]
+
+THROTTLES: Dict[str, UserThrottle] = {
+    name: UserThrottle(name, limit, THROTTLE_IDLE_SECONDS, THROTTLE_MAX_USERS)
+    for name, limit in (("proof", THROTTLE_PROOF), ("text", THROTTLE_TEXT))
+    if limit.strip() and float(limit.partition("/")[0]) > 0
+}
+
+async def within_limit(name: str, update) -> bool:
+    """Count an update against the `name` anti-flood limit (admin exempt).
+
+    False means drop it; the first dropped update of a burst is answered
+    with THROTTLE_WARNING.
+    """
+    throttle = THROTTLES.get(name)
+    user = update.effective_user if isinstance(update, Update) else None
+    if throttle is None or user is None or is_admin(user.id):
+        return True
+    verdict = throttle.check(user.id)
+    if verdict == "warn" and update.effective_message:
+        await update.effective_message.reply_text(THROTTLE_WARNING)
+    return verdict == "ok"
+
+def throttle_summary() -> str:
+    if not THROTTLES:
+        return "Anti-flood throttling is disabled."
+    lines = ["🚦 Anti-flood"]
+    for t in THROTTLES.values():
+        lines.append(
+            f"\n{t.name} ({t.limit.replace('/', ' per ')}s): allowed={t.allowed} dropped={t.dropped} warned={t.warnings} "
+            f"| tracking {len(t.users)} users, {t.evicted} expired"
+        )
+        for dropped, uid in t.top_offenders():
+            lines.append(f"• {uid}: {dropped} dropped")
+    return "\n".join(lines)
+
+# Concurrency ----------------------------------------------------------------
+# With CONCURRENT_UPDATES > 1 PTB runs handlers side by side.  Everything a
+# single user does (their user_data flow, admin commands) is serialized on
+# USER_LOCKS; approve/decline take PAYMENT_LOCKS so exactly one click
+# resolves a payment; and INVITE_LOCKS stop two approvals for the same user
+# from minting the same channel link twice.
+class KeyedLocks:
+    """One asyncio.Lock per key, dropped once nobody holds or waits for it."""
+
+    def __init__(self):
+        self._locks: Dict[Any, list] = {}   # key -> [lock, holders + waiters]
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+USER_LOCKS = KeyedLocks()
+PAYMENT_LOCKS = KeyedLocks()
+INVITE_LOCKS = KeyedLocks()
+
+# payment_id -> "approve" / "decline" / "expired" for recently resolved
+# payments, so a late second click can say what already happened
+RESOLVED_PAYMENTS: "OrderedDict[str, str]" = OrderedDict()
+RESOLVED_PAYMENTS_MAX = 1000
+
+def remember_resolved(payment_id: str, outcome: str):
+    RESOLVED_PAYMENTS[payment_id] = outcome
+    RESOLVED_PAYMENTS.move_to_end(payment_id)
+    while len(RESOLVED_PAYMENTS) > RESOLVED_PAYMENTS_MAX:
+        RESOLVED_PAYMENTS.popitem(last=False)
+
+def per_user(callback):
+    """Run a handler while holding its user's lock (updates of one user stay ordered)."""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            return await callback(update, context)
+        async with USER_LOCKS(user.id):
+            return await callback(update, context)
+    return wrapper
+
+# Invite link pool -----------------------------------------------------------
+# A few single-use links per channel are created ahead of time by
+# invite_pool_loop, so approving a payment usually needs no Telegram round
+# trip before the user gets their links.  In multi-worker mode only the
+# worker running invite_pool_loop (the admin's) takes links from the pool;
+# the others create theirs directly, since a pooled link must never be
+# handed to two buyers.
+_INVITE_POOL_WAKEUP = None  # asyncio.Event, created by invite_pool_loop
+_INVITE_POOL_TASK = None
+INVITE_LABELS = {"vip": "🔑 VIP Channel", "dark": "🕶 Dark Channel"}
+
+def _plan_channels(plan: str) -> list:
+    """[(kind, channel_id)] the plan grants access to, skipping unset channels."""
+    channels = []
+    if plan in ("vip", "both") and VIP_CHANNEL_ID:
+        channels.append(("vip", VIP_CHANNEL_ID))
+    if plan in ("dark", "both") and DARK_CHANNEL_ID:
+        channels.append(("dark", DARK_CHANNEL_ID))
+    return channels
+
+def _wake_invite_pool():
+    if _INVITE_POOL_WAKEUP is not None:
+        _INVITE_POOL_WAKEUP.set()
+
+def discard_invite_pool(bot, channel_id: int):
+    """Forget pooled links for a channel we no longer hand out, revoking them in the background."""
+    links = INVITE_POOL.pop(channel_id, None)
+    if links is None:
+        return
+    journal_event("invite_pool_reset", channel_id=channel_id)
+    asyncio.create_task(_revoke_invite_links(bot, channel_id, links))
+    _wake_invite_pool()
+
+async def _revoke_invite_links(bot, channel_id: int, links: list):
+    for link in links:
+        try:
+            await bot.revoke_chat_invite_link(chat_id=channel_id, invite_link=link)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+        except Exception:
+            # channel gone or bot no longer admin there: nothing to revoke
+            logger.warning("Could not revoke pooled invite link for %s", channel_id)
+            return
+
+async def _get_invite_link(bot, channel_id: int, user_id: int, kind: str) -> str:
+    pool = INVITE_POOL.get(channel_id) if owns_user(ADMIN_CHAT_ID) else None
+    if pool:
+        link = pool.pop(0)
+        journal_event("invite_taken", channel_id=channel_id, link=link)
+        _wake_invite_pool()
+        return link
+    link_obj = await bot.create_chat_invite_link(
+        chat_id=channel_id, member_limit=1, name=f"user_{user_id}_{kind}"
+    )
+    return link_obj.invite_link
+
+async def invite_pool_loop(bot):
+    """Keep INVITE_POOL_SIZE unused links per configured channel."""
+    global _INVITE_POOL_WAKEUP
+    _INVITE_POOL_WAKEUP = asyncio.Event()
+    while True:
+        _INVITE_POOL_WAKEUP.clear()
+        channels = dict(_plan_channels("both"))
+        for channel_id in [c for c in INVITE_POOL if c not in channels.values()]:
+            discard_invite_pool(bot, channel_id)
+        for kind, channel_id in channels.items():
+            while len(INVITE_POOL.get(channel_id, [])) < INVITE_POOL_SIZE:
+                try:
+                    link_obj = await bot.create_chat_invite_link(
+                        chat_id=channel_id, member_limit=1, name=f"pool_{kind}"
+                    )
+                except RetryAfter as e:
+                    await asyncio.sleep(retry_after_seconds(e))
+                    continue
+                except Exception:
+                    logger.exception("Could not refill invite pool for %s", channel_id)
+                    break
+                if channel_id not in dict(_plan_channels("both")).values():
+                    # channel was changed while we were waiting on Telegram
+                    asyncio.create_task(_revoke_invite_links(bot, channel_id, [link_obj.invite_link]))
+                    break
+                INVITE_POOL.setdefault(channel_id, []).append(link_obj.invite_link)
+                journal_event("invite_pooled", channel_id=channel_id, link=link_obj.invite_link)
+        try:
+            await asyncio.wait_for(_INVITE_POOL_WAKEUP.wait(), timeout=INVITE_POOL_REFILL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+# Media cache ----------------------------------------------------------------
+# Telegram hands back a file_id for every photo we send; reusing it avoids
+# Telegram re-fetching the image from its original URL.  Entries are keyed
+# "url:<source url>".  The "upi_qr" slot holds a QR uploaded by the admin
+# with /set_qr and takes precedence over UPI_QR_URL.
+UPI_QR_SLOT = "upi_qr"
+
+def cache_media(key: str, file_id: str):
+    if MEDIA_CACHE.get(key) != file_id:
+        MEDIA_CACHE[key] = file_id
+        journal_event("media_cached", key=key, file_id=file_id)
+
+def drop_media(key: str):
+    if MEDIA_CACHE.pop(key, None) is not None:
+        journal_event("media_dropped", key=key)
+
+async def reply_cached_photo(message, url: str, slot: str = None, **kwargs):
+    """reply_photo() that sends a cached file_id when we have one.
+
+    `slot` names an admin-uploaded override that is used instead of `url`.
+    """
+    for key in filter(None, (slot, "url:" + url)):
+        file_id = MEDIA_CACHE.get(key)
+        if not file_id:
+            continue
+        try:
+            return await message.reply_photo(photo=file_id, **kwargs)
+        except BadRequest:
+            # file_id no longer valid (e.g. bot token changed); fall back
+            logger.warning("Cached media %s rejected by Telegram, dropping it", key)
+            drop_media(key)
+    sent = await message.reply_photo(photo=url, **kwargs)
+    if sent.photo:
+        cache_media("url:" + url, sent.photo[-1].file_id)
+    return sent
+
 # ----------------- Bot functionality (same as before) -----------------
 async def send_access_links(context: ContextTypes.DEFAULT_TYPE, user_id: int, plan: str):
     links_text = []
-    try:
-        user_links = SENT_INVITES.setdefault(user_id, {})
-        if plan in ("vip", "both") and VIP_CHANNEL_ID:
-            if "vip" in user_links:
-                vip_link = user_links["vip"]
-            else:
-                vip_link_obj = await context.bot.create_chat_invite_link(
-                    chat_id=VIP_CHANNEL_ID, member_limit=1, name=f"user_{user_id}_vip"
-                )
-                vip_link = vip_link_obj.invite_link
-                user_links["vip"] = vip_link
-                # save invites after creation
-                save_state()
-            links_text.append(f"🔑 VIP Channel:\n{vip_link}")
-
-        if plan in ("dark", "both") and DARK_CHANNEL_ID:
-            if "dark" in user_links:
-                dark_link = user_links["dark"]
-            else:
-                dark_link_obj = await context.bot.create_chat_invite_link(
-                    chat_id=DARK_CHANNEL_ID, member_limit=1, name=f"user_{user_id}_dark"
-                )
-                dark_link = dark_link_obj.invite_link
-                user_links["dark"] = dark_link
-                save_state()
-            links_text.append(f"🕶 Dark Channel:\n{dark_link}")
+    user_links = SENT_INVITES.setdefault(user_id, {})
+    channels = _plan_channels(plan)
+    # a concurrent approval for the same user waits here and then finds the
+    # links already recorded instead of minting its own
+    async with INVITE_LOCKS(user_id):
+        missing = [(kind, channel_id) for kind, channel_id in channels if kind not in user_links]
+        # pooled links come back immediately; any that must be created are created concurrently
+        results = await asyncio.gather(
+            *(_get_invite_link(context.bot, channel_id, user_id, kind) for kind, channel_id in missing),
+            return_exceptions=True,
+        )
+        for (kind, _), link in zip(missing, results):
+            if isinstance(link, Exception):
+                logger.error("Error creating %s invite link for user %s: %s", kind, user_id, link)
+                continue
+            user_links[kind] = link
+            journal_event("invite_created", user_id=user_id, kind=kind, link=link)
+    for kind, _ in channels:
+        if kind in user_links:
+            links_text.append(f"{INVITE_LABELS[kind]}:\n{user_links[kind]}")
+
+    if links_text:
+        text = "✅ Access granted!\n\n" + "\n\n".join(links_text)
+    else:
+        text = (
+            "✅ Payment approved.\n\n"
+            "But I couldn't generate channel links automatically. "
+            f"Please contact support: {HELP_BOT_USERNAME}"
+        )
+    await context.bot.send_message(chat_id=user_id, text=text)
+
+def get_price(plan: str, method: str):
+    cfg = PRICE_CONFIG.get(plan, {})
+    if method == "upi":
+        return cfg.get("upi_inr"), "INR"
+    if method == "crypto":
+        return cfg.get("crypto_usd"), "USD"
+    if method == "remitly":
+        return cfg.get("remit_inr"), "INR"
+    return None, ""
+
+# Expiry scheduler -----------------------------------------------------------
+# One heap of (when, kind, key) deadlines drives both proof windows
+# (kind "proof", key user_id) and unreviewed payments (kind "pending", key
+# payment_id), plus the hourly duplicate-index cleanup (kind "proof_index").
+# Entries are never removed early: when one comes due it is
+# checked against the live state and dropped if it no longer applies.
+_DEADLINES: list = []
+_DEADLINE_WAKEUP = None   # asyncio.Event, created by expiry_loop
+_EXPIRY_TASK = None
+
+def schedule_deadline(when: float, kind: str, key):
+    heapq.heappush(_DEADLINES, (when, kind, key))
+    if _DEADLINE_WAKEUP is not None and _DEADLINES[0][0] == when:
+        _DEADLINE_WAKEUP.set()
+
+def pending_expires_at(payment: dict) -> float:
+    return payment.get("created", 0) + PENDING_TTL_HOURS * 3600
+
+def track_pending(payment_id: str, payment: dict):
+    """Schedule expiry for a new pending payment and enforce PENDING_MAX."""
+    schedule_deadline(pending_expires_at(payment), "pending", payment_id)
+    if len(PENDING_PAYMENTS) > PENDING_MAX:
+        # the heap top is the oldest payment; let the loop age it out now
+        if _DEADLINE_WAKEUP is not None:
+            _DEADLINE_WAKEUP.set()
+
+def _expire_proof_window(app, user_id: int, when: float):
+    user_data = app.user_data.get(user_id)
+    if not user_data or user_data.get("payment_deadline") != when:
+        return
+    user_data["waiting_for_proof"] = None
+    user_data["payment_deadline"] = None
+    user_data["window_expired"] = True
+    # changed outside an update, so PTB would not hand it to the persistence
+    app.mark_data_for_update_persistence(user_ids=user_id)
+
+async def _expire_pending(bot, payment_id: str):
+    payment = PENDING_PAYMENTS.pop(payment_id, None)
+    if payment is None:
+        return
+    if MULTI_WORKER and not await claim_shared_pending(payment_id):
+        return
+    journal_event("payment_expired", payment_id=payment_id, payment=payment, expired_at=time.time())
+    remember_resolved(payment_id, "expired")
+    release_proof(payment_id, payment)
+    logger.info("Pending payment %s expired unreviewed", payment_id)
+    text = (
+        f"⌛ Your payment request (ID: {payment_id}) for {PLAN_LABELS.get(payment.get('plan'), payment.get('plan'))} "
+        "expired before it could be reviewed.\n"
+        f"If you already paid, please contact support: {HELP_BOT_USERNAME}"
+    )
+    for _ in range(2):
+        try:
+            await bot.send_message(chat_id=payment["user_id"], text=text)
+            return
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+        except Exception:
+            logger.warning("Could not notify user %s about expired payment %s", payment.get("user_id"), payment_id)
+            return
+
+async def expiry_loop(app):
+    """Fire due deadlines; sleeps until the earliest one (or a new earlier one)."""
+    global _DEADLINE_WAKEUP
+    OUTBOUND_PRIORITY.set(PRIORITY_BULK)   # expiry notices can wait
+    _DEADLINE_WAKEUP = asyncio.Event()
+    # pending payments survive restarts, proof windows do not
+    now = time.time()
+    for payment_id, payment in PENDING_PAYMENTS.items():
+        payment.setdefault("created", now)
+        if owns_user(payment.get("user_id", 0)):
+            schedule_deadline(pending_expires_at(payment), "pending", payment_id)
+    if owns_user(ADMIN_CHAT_ID):
+        schedule_deadline(now, "proof_index", None)
+    while True:
+        now = time.time()
+        deferred = []
+        while _DEADLINES and (_DEADLINES[0][0] <= now or len(PENDING_PAYMENTS) > PENDING_MAX):
+            when, kind, key = heapq.heappop(_DEADLINES)
+            if when > now and kind != "pending":
+                # only here to trim PENDING_MAX; not due yet
+                deferred.append((when, kind, key))
+                continue
+            try:
+                if kind == "proof":
+                    _expire_proof_window(app, key, when)
+                elif kind == "pending":
+                    await _expire_pending(app.bot, key)
+                elif kind == "proof_index":
+                    prune_proof_index(now)
+                    schedule_deadline(now + 3600, kind, key)
+            except Exception:
+                logger.exception("Expiry of %s %s failed", kind, key)
+        for item in deferred:
+            heapq.heappush(_DEADLINES, item)
+        _DEADLINE_WAKEUP.clear()
+        timeout = min(_DEADLINES[0][0] - time.time(), 3600) if _DEADLINES else 3600
+        try:
+            await asyncio.wait_for(_DEADLINE_WAKEUP.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+# Duplicate proofs -----------------------------------------------------------
+# PROOF_INDEX maps every proof file (by file_unique_id, which is stable across
+# re-sends and accounts) and every UTR/TXID found in its caption to the
+# payment it was first submitted for.  A proof matching any key is answered
+# without creating a payment; a proof re-used from another account is also
+# reported to the admin.  Keys are released when their payment is declined
+# or expires, so only proofs of pending or approved payments count as
+# duplicates.  File keys of resolved payments are dropped after
+# PROOF_FILE_KEY_DAYS (see prune_proof_index); references are kept.
+# /reconcile also records the statement credits it has used as "stmt:" keys.
+_BARE_UTR = re.compile(r"\b(\d{12})\b")         # UPI UTR / RRN
+_PROOF_REF_PATTERNS = (
+    re.compile(r"\b(?:0x)?([0-9a-f]{64})\b"),   # crypto TXID
+    _BARE_UTR,
+    # labelled references: "UTR: 4567XY8901", "Txn ID #AB12345678"
+    re.compile(r"\b(?:utr|rrn|txid|txn(?: id)?|transaction id|ref(?:erence)?(?: no)?)[\s:#.-]+((?=[a-z]*\d)[a-z0-9]{8,})\b"),
+)
+# an unlabelled 91 + 10-digit mobile number is a phone number (support
+# contacts end up in captions), not a UTR
+_PHONE_NUMBER = re.compile(r"91[6-9]\d{9}")
+
+def find_refs(text: str) -> list:
+    """UTR / TXID references in free text, normalised the way PROOF_INDEX keys them."""
+    refs = []
+    text = text.lower()
+    for pattern in _PROOF_REF_PATTERNS:
+        for ref in pattern.findall(text):
+            if pattern is _BARE_UTR and _PHONE_NUMBER.fullmatch(ref):
+                continue
+            if len(ref) == 66 and ref.startswith("0x"):
+                ref = ref[2:]
+            if ref not in refs:
+                refs.append(ref)
+    return refs
+
+def proof_keys(message) -> list:
+    """Index keys for a proof message: its file plus any references in the caption."""
+    keys = []
+    proof = message.photo[-1] if message.photo else message.document
+    if proof is not None and proof.file_unique_id:
+        keys.append("file:" + proof.file_unique_id)
+    keys.extend("ref:" + ref for ref in find_refs(message.caption or ""))
+    return keys
+
+def find_duplicate_proof(keys: list):
+    """The index entry of an earlier submission sharing any key, else None."""
+    for key in keys:
+        entry = PROOF_INDEX.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+def index_proof(keys: list, payment_id: str, user_id: int, declined: bool = False):
+    if not keys:
+        return
+    entry = {"payment_id": payment_id, "user_id": user_id, "time": time.time()}
+    if declined:
+        entry["declined"] = True
+    for key in keys:
+        PROOF_INDEX[key] = entry
+    journal_event("proof_indexed", keys=keys, entry=entry)
+
+def release_proof(payment_id: str, payment: dict, declined: bool = False):
+    """Forget a declined / expired payment's proof so it may be submitted again.
+
+    The TXIDs of a declined crypto payment stay, flagged "declined": anyone
+    can paste a public TXID, so it must never be auto-approved later.
+    """
+    keys = [k for k in payment.get("proof_keys", ()) if PROOF_INDEX.get(k, {}).get("payment_id") == payment_id]
+    if payment.get("method") == "crypto":
+        kept = [k for k in keys if k.startswith("ref:") and (declined or PROOF_INDEX[k].get("declined"))]
+        if kept:
+            entry = dict(PROOF_INDEX[kept[0]], declined=True)
+            for key in kept:
+                PROOF_INDEX[key] = entry
+            journal_event("proof_indexed", keys=kept, entry=entry)
+            keys = [k for k in keys if k not in kept]
+    if keys:
+        for key in keys:
+            del PROOF_INDEX[key]
+        journal_event("proof_released", keys=keys)
+
+def prune_proof_index(now: float):
+    """Forget the proof files of payments resolved more than PROOF_FILE_KEY_DAYS ago.
+
+    Used statement credits (stmt: keys, see /reconcile) go once they are
+    too old to fall in any pending payment's window.
+    """
+    cutoff = now - PROOF_FILE_KEY_DAYS * 86400
+    stmt_cutoff = now - (PENDING_TTL_HOURS + RECONCILE_WINDOW_HOURS + 24) * 3600
+    keys = [
+        key for key, entry in PROOF_INDEX.items()
+        if entry["payment_id"] not in PENDING_PAYMENTS and (
+            (key.startswith("file:") and entry["time"] < cutoff)
+            or (key.startswith("stmt:") and entry["time"] < stmt_cutoff)
+        )
+    ]
+    if keys:
+        for key in keys:
+            del PROOF_INDEX[key]
+        journal_event("proof_released", keys=keys)
+        logger.info("Dropped %d old proof files from the duplicate index", len(keys))
+
+async def reply_duplicate_proof(bot, message, user_id: int, entry: dict, contested: bool = False):
+    original = entry["payment_id"]
+    if entry["user_id"] != user_id:
+        logger.warning("User %s re-used the proof of payment %s (user %s)", user_id, original, entry["user_id"])
+        notice = (f"🚩 Re-used payment proof\nUser {user_id} sent the proof of payment {original} "
+                  f"(user {entry['user_id']}). No payment was created.")
+        if contested:
+            notice += f"\nPayment {original} will not be auto-approved; it is waiting for your review."
+        with outbound_priority(PRIORITY_ADMIN):
+            await _deliver(lambda: bot.send_message(chat_id=ADMIN_CHAT_ID, text=notice), ADMIN_CHAT_ID)
+        text = ("⚠️ This payment proof has already been submitted from another account.\n"
+                f"If this is a mistake, please contact support: {HELP_BOT_USERNAME}")
+    elif original in PENDING_PAYMENTS:
+        text = (f"⏳ We already have this proof (Payment ID: {original}) and it is waiting for review.\n"
+                "No need to send it again.")
+    else:
+        text = (f"✅ This proof was already used for an approved payment (ID: {original}).\n"
+                f"For a new purchase please send the proof of that payment. Support: {HELP_BOT_USERNAME}")
+    await message.reply_text(text)
+
+# Crypto verification --------------------------------------------------------
+# A crypto proof whose caption carries a TXID is checked against the chain in
+# a background task, retrying until the transfer has enough confirmations or
+# CRYPTO_VERIFY_TIMEOUT_MINUTES pass.  Verified payments are approved through
+# settle_payment() once claim_txid() has made sure the TXID is theirs alone;
+# failed checks stay pending and the admin is told why.  A payment whose
+# proof another user sends too is "contested" and left to the admin.
+# Chain access goes through a client from CHAIN_CLIENTS (anything with
+# `async transfer(txid)` and `async close()`), so another kind of node is
+# one class away.
+class ChainError(Exception):
+    """The node could not answer (network failure or JSON-RPC error)."""
+
+class TTLCache:
+    """LRU mapping whose entries also expire a while after being stored."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[Any, tuple]" = OrderedDict()   # key -> (expires, value)
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        if item[0] <= time.monotonic():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return item[1]
+
+    def put(self, key, value, ttl: float = None):
+        self._items[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+class EvmTokenClient:
+    """Token transfers read from an Ethereum-style JSON-RPC node (BSC, Ethereum, chain_stub.py).
+
+    transfer(txid) is None while the node has no mined receipt, else
+    {"ok", "paid": {recipient: token amount}, "confirmations", "time"}.
+    """
+    TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+    def __init__(self, url: str, token: str, decimals: int):
+        self.url = url
+        self.token = token.lower()
+        self.scale = 10 ** decimals
+        self._client = None
+        self._next_id = 0
+
+    async def _call(self, method: str, *params):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10)
+        self._next_id += 1
+        try:
+            response = await self._client.post(
+                self.url, json={"jsonrpc": "2.0", "id": self._next_id, "method": method, "params": list(params)}
+            )
+            response.raise_for_status()
+            reply = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise ChainError(f"{method}: {e}") from e
+        if reply.get("error"):
+            raise ChainError(f"{method}: {reply['error'].get('message', reply['error'])}")
+        return reply.get("result")
+
+    async def transfer(self, txid: str):
+        receipt = await self._call("eth_getTransactionReceipt", "0x" + txid)
+        if not receipt or not receipt.get("blockNumber"):
+            return None
+        head, block = await asyncio.gather(
+            self._call("eth_blockNumber"), self._call("eth_getBlockByNumber", receipt["blockNumber"], False)
+        )
+        paid = {}
+        for log in receipt.get("logs") or ():
+            topics = log.get("topics") or ()
+            if (log.get("address", "").lower() == self.token and len(topics) == 3
+                    and topics[0] == self.TRANSFER_TOPIC):
+                to = "0x" + topics[2][-40:].lower()
+                paid[to] = paid.get(to, 0) + int(log.get("data") or "0x0", 16) / self.scale
+        return {
+            "ok": receipt.get("status") == "0x1",
+            "paid": paid,
+            "confirmations": int(head, 16) - int(receipt["blockNumber"], 16) + 1,
+            "time": int(block["timestamp"], 16) if block else 0,
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+CHAIN_CLIENTS = {
+    "evm": lambda: EvmTokenClient(CRYPTO_RPC_URL, CRYPTO_TOKEN_CONTRACT, CRYPTO_TOKEN_DECIMALS),
+}
+
+_CACHE_MISS = object()
+_BLOCK_CLOCK_SLACK = 120    # seconds a block timestamp may lag our clock
+
+class CryptoVerifier:
+    """Checks crypto payments against the chain, caching lookups per TXID."""
+
+    def __init__(self, client):
+        self.client = client
+        self.cache = TTLCache(CRYPTO_CACHE_SIZE, CRYPTO_CACHE_TTL)
+
+    async def lookup(self, txid: str):
+        hit = self.cache.get(txid, _CACHE_MISS)
+        if hit is not _CACHE_MISS:
+            return hit
+        tx = await self.client.transfer(txid)
+        settled = tx is not None and (not tx["ok"] or tx["confirmations"] >= CRYPTO_MIN_CONFIRMATIONS)
+        self.cache.put(txid, tx, None if settled else CRYPTO_VERIFY_INTERVAL / 2)
+        return tx
+
+    async def check(self, txid: str, payment: dict):
+        """("verified" | "waiting" | "rejected", detail) for `payment` paid with `txid`."""
+        tx = await self.lookup(txid)
+        if tx is None:
+            return "waiting", "transaction not on chain yet"
+        if not tx["ok"]:
+            return "rejected", "transaction failed on chain"
+        paid = tx["paid"].get(CRYPTO_ADDRESS.lower(), 0)
+        expected = payment.get("amount") or 0
+        if paid <= 0:
+            return "rejected", f"no token transfer to {CRYPTO_ADDRESS}"
+        if paid < expected * (1 - CRYPTO_AMOUNT_TOLERANCE):
+            return "rejected", f"paid {paid:g}, expected {expected:g}"
+        # the payment window opened at most PROOF_WINDOW_MINUTES before the proof
+        if tx["time"] < payment.get("created", 0) - PROOF_WINDOW_MINUTES * 60 - _BLOCK_CLOCK_SLACK:
+            return "rejected", "transaction was made before this payment"
+        if tx["confirmations"] < CRYPTO_MIN_CONFIRMATIONS:
+            return "waiting", f"{tx['confirmations']}/{CRYPTO_MIN_CONFIRMATIONS} confirmations"
+        return "verified", f"{paid:g} paid, {tx['confirmations']} confirmations"
+
+    async def close(self):
+        await self.client.close()
+
+VERIFIER = None                                 # CryptoVerifier, created by post_init
+_VERIFY_TASKS: Dict[str, asyncio.Task] = {}     # payment_id -> running check
+
+def make_verifier():
+    if not CRYPTO_VERIFIER:
+        return None
+    factory = CHAIN_CLIENTS.get(CRYPTO_VERIFIER)
+    if factory is None:
+        logger.warning("Unknown CRYPTO_VERIFIER %r; crypto proofs stay manual", CRYPTO_VERIFIER)
+        return None
+    return CryptoVerifier(factory())
+
+def proof_txid(payment: dict):
+    """The first TXID-shaped reference in a payment's proof caption, or None."""
+    for key in payment.get("proof_keys", ()):
+        if key.startswith("ref:") and re.fullmatch(r"[0-9a-f]{64}", key[4:]):
+            return key[4:]
+    return None
+
+def start_crypto_verification(app, payment_id: str, payment: dict):
+    """Check a crypto payment in the background if it names a TXID (`app` needs only .bot)."""
+    if VERIFIER is None or payment.get("method") != "crypto" or payment_id in _VERIFY_TASKS:
+        return
+    if payment.get("declined_txid") or payment.get("contested"):
+        return      # the admin decides, see handle_payment_proof
+    txid = proof_txid(payment)
+    if txid is None:
+        return
+    task = asyncio.create_task(verify_crypto_payment(app, payment_id, txid))
+    _VERIFY_TASKS[payment_id] = task
+    task.add_done_callback(lambda _: _VERIFY_TASKS.pop(payment_id, None))
+
+def contest_crypto_payment(payment_id: str) -> bool:
+    """Leave a pending crypto payment to the admin because someone else sent its proof too.
+
+    Its verification is cancelled here; one running on another worker sees
+    the "contested" flag once the payment_contested record syncs.
+    """
+    payment = PENDING_PAYMENTS.get(payment_id)
+    if payment is None or payment.get("method") != "crypto" or payment.get("contested"):
+        return False
+    payment["contested"] = True
+    journal_event("payment_contested", payment_id=payment_id)
+    task = _VERIFY_TASKS.pop(payment_id, None)
+    if task is not None:
+        task.cancel()
+    logger.warning("Crypto payment %s is contested; auto-approval stopped", payment_id)
+    return True
+
+async def claim_txid(payment_id: str, txid: str):
+    """Why `payment_id` must not be auto-approved with `txid`, or None once it may.
+
+    The caller holds PAYMENT_LOCKS(payment_id).  In multi-worker mode the
+    TXID is claimed in the shared store, so it approves at most one payment
+    even if two workers each took a proof naming it.
+    """
+    payment = PENDING_PAYMENTS.get(payment_id)
+    if payment is None:
+        return None     # resolved meanwhile; settle_payment finds nothing to do
+    if payment.get("contested"):
+        return "another user sent the same TXID"
+    owner = PROOF_INDEX.get("ref:" + txid, {}).get("payment_id")
+    if owner != payment_id:
+        return f"the TXID belongs to payment {owner}"
+    if MULTI_WORKER:
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, STORE.claim_txid, txid):
+            return "the TXID was already used for another payment"
+    return None
+
+async def verify_crypto_payment(app, payment_id: str, txid: str):
+    OUTBOUND_PRIORITY.set(PRIORITY_ADMIN)   # runs as its own task
+    give_up = time.monotonic() + CRYPTO_VERIFY_TIMEOUT_MINUTES * 60
+    while True:
+        payment = PENDING_PAYMENTS.get(payment_id)
+        if payment is None or payment.get("contested"):
+            return      # the admin got there first, or has to decide
+        try:
+            status, detail = await VERIFIER.check(txid, payment)
+        except ChainError as e:
+            logger.warning("Checking TXID %s for payment %s failed: %s", txid, payment_id, e)
+            status, detail = "waiting", f"node unavailable ({e})"
+        if status != "waiting" or time.monotonic() >= give_up:
+            break
+        await asyncio.sleep(CRYPTO_VERIFY_INTERVAL)
+
+    if status == "verified":
+        # contesting the payment no longer cancels us; claim_txid checks instead
+        _VERIFY_TASKS.pop(payment_id, None)
+        async with PAYMENT_LOCKS(payment_id):
+            problem = await claim_txid(payment_id, txid)
+            if problem is None:
+                payment, _ = await settle_payment(app, "approve", payment_id)
+        if problem is not None:
+            status, detail = "rejected", problem
+        elif payment is None:
+            return
+    if status == "verified":
+        logger.info("Crypto payment %s verified on chain (%s)", payment_id, detail)
+        text = (f"🤖 Auto-approved crypto payment (ID: {payment_id}) for user {payment['user_id']} | "
+                f"{payment['amount']} {payment['currency']}\nTXID: {txid}\n{detail}")
+    else:
+        logger.info("Crypto payment %s not verified: %s", payment_id, detail)
+        text = (f"⚠️ Could not verify crypto payment (ID: {payment_id}): {detail}\n"
+                f"TXID: {txid}\nIt is waiting for your review.")
+    await _deliver(lambda: app.bot.send_message(chat_id=ADMIN_CHAT_ID, text=text), ADMIN_CHAT_ID)
+
+# Proof digest ---------------------------------------------------------------
+# In digest mode a proof costs no admin-chat call of its own: proofs wait in
+# _DIGEST_BUFFER until DIGEST_WINDOW has passed since the first one or
+# DIGEST_MAX_ITEMS have arrived, then go out as one send_media_group (photos
+# and documents cannot share an album, so mixed batches send two) followed
+# by one message with an approve/decline row per payment.
+_DIGEST_BUFFER: list = []
+_DIGEST_TIMER = None            # asyncio.Task flushing the buffer after the window
+_DIGEST_SENDS: set = set()      # digests being sent right now
+
+def queue_for_digest(bot, item: dict):
+    global _DIGEST_TIMER
+    _DIGEST_BUFFER.append(item)
+    if len(_DIGEST_BUFFER) >= DIGEST_MAX_ITEMS:
+        _spawn_digest(bot)
+    elif _DIGEST_TIMER is None:
+        _DIGEST_TIMER = asyncio.create_task(_digest_timer(bot))
+
+async def _digest_timer(bot):
+    await asyncio.sleep(DIGEST_WINDOW)
+    _spawn_digest(bot)
+
+def _take_digest() -> list:
+    global _DIGEST_TIMER
+    if _DIGEST_TIMER is not None and _DIGEST_TIMER is not asyncio.current_task():
+        _DIGEST_TIMER.cancel()
+    _DIGEST_TIMER = None
+    batch = _DIGEST_BUFFER[:]
+    _DIGEST_BUFFER.clear()
+    return batch
 
-    except Exception as e:
-        logger.exception("Error creating invite links for user %s: %s", user_id, e)
+def _spawn_digest(bot):
+    task = asyncio.create_task(send_digest(bot, _take_digest()))
+    _DIGEST_SENDS.add(task)
+    task.add_done_callback(_DIGEST_SENDS.discard)
 
-    if links_text:
-        text = "✅ Access granted!\n\n" + "\n\n".join(links_text)
-    else:
-        text = (
-            "✅ Payment approved.\n\n"
-            "But I couldn't generate channel links automatically. "
-            f"Please contact support: {HELP_BOT_USERNAME}"
+async def send_digest(bot, batch: list):
+    """Send one batch of proofs to the admin chat."""
+    OUTBOUND_PRIORITY.set(PRIORITY_ADMIN)   # runs as its own task
+    # anything resolved or expired while it waited is left out
+    batch = [item for item in batch if item["payment_id"] in PENDING_PAYMENTS]
+    if not batch:
+        return
+    numbered = list(enumerate(batch, 1))
+    captions = {n: f"#{n} {item['caption']}".strip()[:1024] for n, item in numbered}
+    for kind, media_cls, send_one in (
+        ("photo", InputMediaPhoto, bot.send_photo),
+        ("document", InputMediaDocument, bot.send_document),
+    ):
+        group = [(n, item) for n, item in numbered if item["kind"] == kind]
+        if len(group) == 1:
+            n, item = group[0]
+            await _deliver(lambda: send_one(ADMIN_CHAT_ID, item["file_id"], caption=captions[n]), ADMIN_CHAT_ID)
+        elif group:
+            media = [media_cls(item["file_id"], caption=captions[n]) for n, item in group]
+            await _deliver(lambda: bot.send_media_group(chat_id=ADMIN_CHAT_ID, media=media), ADMIN_CHAT_ID)
+
+    lines = [f"💰 {len(batch)} new payment request(s)"]
+    kb = []
+    for n, item in numbered:
+        p = PENDING_PAYMENTS.get(item["payment_id"])
+        if p is None:
+            continue
+        lines.append(
+            f"#{n} @{p['username'] or 'NoUsername'} (ID: {p['user_id']}) · {PLAN_LABELS.get(p['plan'], p['plan'])} · "
+            f"{p['method'].upper()} · {p['amount']} {p['currency']} · {item['payment_id']}"
+        )
+        kb.append([
+            InlineKeyboardButton(f"✅ #{n}", callback_data=f"approve:{item['payment_id']}"),
+            InlineKeyboardButton(f"❌ #{n}", callback_data=f"decline:{item['payment_id']}"),
+        ])
+    if kb:
+        await _deliver(
+            lambda: bot.send_message(chat_id=ADMIN_CHAT_ID, text="\n".join(lines), reply_markup=InlineKeyboardMarkup(kb)),
+            ADMIN_CHAT_ID,
         )
-    await context.bot.send_message(chat_id=user_id, text=text)
 
-def get_price(plan: str, method: str):
-    cfg = PRICE_CONFIG.get(plan, {})
-    if method == "upi":
-        return cfg.get("upi_inr"), "INR"
-    if method == "crypto":
-        return cfg.get("crypto_usd"), "USD"
-    if method == "remitly":
-        return cfg.get("remit_inr"), "INR"
-    return None, ""
+async def flush_digest(bot):
+    """Send whatever is buffered and wait for digests in flight (shutdown)."""
+    if _DIGEST_BUFFER:
+        _spawn_digest(bot)
+    elif _DIGEST_TIMER is not None:
+        _take_digest()
+    if _DIGEST_SENDS:
+        await asyncio.gather(*_DIGEST_SENDS, return_exceptions=True)
 
 # Handlers -----------------------------------------------------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    KNOWN_USERS.add(user.id)
-    # persist known users
-    save_state()
+    if user.id not in KNOWN_USERS:
+        KNOWN_USERS.add(user.id)
+        journal_event("user_seen", user_id=user.id)
 
     keyboard = [
         [InlineKeyboardButton("💎 VIP Channel (₹499)", callback_data="plan_vip")],
@@ -247,6 +2758,21 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     data = query.data
+    if data.startswith("pq:"):
+        await pending_buttons(update, context)
+        return
+    if data.startswith("approve:") or data.startswith("decline:"):
+        # admin review runs under the payment's lock, not the admin's user
+        # lock, so reviews of different payments proceed in parallel
+        action, payment_id = data.split(":", 1)
+        await resolve_payment(update, context, action, payment_id)
+        return
+    async with USER_LOCKS(query.from_user.id):
+        await _user_buttons(update, context)
+
+async def _user_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
     user = query.from_user
 
     if data in ("plan_vip", "plan_dark", "plan_both"):
@@ -254,6 +2780,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["selected_plan"] = plan
         context.user_data["waiting_for_proof"] = None
         context.user_data["payment_deadline"] = None
+        context.user_data["window_expired"] = False
 
         label = PLAN_LABELS.get(plan, plan.upper())
         upi_price, _ = get_price(plan, "upi")
@@ -304,8 +2831,10 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         amount, currency = get_price(user_plan, method)
         label = PLAN_LABELS.get(user_plan, user_plan.upper())
 
-        deadline = now_ist() + timedelta(minutes=30)
+        deadline = now_ist() + timedelta(minutes=PROOF_WINDOW_MINUTES)
         context.user_data["payment_deadline"] = deadline.timestamp()
+        context.user_data["window_expired"] = False
+        schedule_deadline(deadline.timestamp(), "proof", user.id)
         deadline_str = deadline.strftime("%d %b %Y, %I:%M %p IST")
 
         if method == "upi":
@@ -323,7 +2852,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "After payment send screenshot/photo here plus optional UTR."
             )
             await query.message.reply_text(msg, parse_mode="Markdown")
-            await query.message.reply_photo(photo=UPI_QR_URL, caption=f"📷 Scan this QR to pay.\nUPI ID: `{UPI_ID}`", parse_mode="Markdown")
+            await reply_cached_photo(query.message, UPI_QR_URL, slot=UPI_QR_SLOT, caption=f"📷 Scan this QR to pay.\nUPI ID: `{UPI_ID}`", parse_mode="Markdown")
         elif method == "crypto":
             msg = (
                 "🪙 *Crypto Payment Instructions*\n\n"
@@ -347,48 +2876,85 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text(msg, parse_mode="Markdown")
         return
 
-    if data.startswith("approve:") or data.startswith("decline:"):
-        action, payment_id = data.split(":", 1)
-        payment = PENDING_PAYMENTS.get(payment_id)
-        if query.from_user.id != ADMIN_CHAT_ID:
-            await query.answer("Only admin can use this.", show_alert=True)
-            return
+RESOLVED_LABELS = {"approve": "approved", "decline": "declined", "expired": "expired unreviewed"}
+DECLINE_TEXT = ("❌ Your payment could not be verified.\nIf this is a mistake, please send a clearer screenshot "
+                "or contact support: " + HELP_BOT_USERNAME)
+
+async def _deliver(send, chat_id: int, attempts: int = 3) -> bool:
+    """Await send(), waiting out flood control; False if it never got through."""
+    for _ in range(attempts):
+        try:
+            await send()
+            return True
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+        except Exception:
+            logger.exception("Could not notify user %s", chat_id)
+            return False
+    return False
+
+async def settle_payment(context: ContextTypes.DEFAULT_TYPE, action: str, payment_id: str):
+    """Approve or decline one pending payment and notify its user.
+
+    The caller holds PAYMENT_LOCKS(payment_id).  Returns (payment, notified),
+    or (None, False) if the payment was already resolved.
+    """
+    # claim it before the first await: a second click (or the expiry
+    # scheduler) now finds nothing to resolve
+    payment = PENDING_PAYMENTS.pop(payment_id, None)
+    if not payment and MULTI_WORKER:
+        # submitted on another worker moments ago?
+        await sync_shared_state()
+        payment = PENDING_PAYMENTS.pop(payment_id, None)
+    if not payment:
+        return None, False
+    if MULTI_WORKER and not await claim_shared_pending(payment_id):
+        return None, False
+    journal_event("payment_resolved", payment_id=payment_id)
+    remember_resolved(payment_id, action)
+    user_id = payment["user_id"]
+    consume_statement_row(payment_id, user_id, action)
+    if action == "approve":
+        add_purchase({
+            "time": now_ist(),
+            "user_id": user_id,
+            "username": payment["username"],
+            "plan": payment["plan"],
+            "method": payment["method"],
+            "amount": payment["amount"],
+            "currency": payment["currency"],
+            "payment_id": payment_id,
+        })
+        # links already recorded for the user are reused, so a retry never mints twice
+        send = lambda: send_access_links(context, user_id, payment["plan"])
+    else:
+        release_proof(payment_id, payment, declined=True)
+        send = lambda: context.bot.send_message(chat_id=user_id, text=DECLINE_TEXT)
+    with outbound_priority(PRIORITY_APPROVAL):
+        notified = await _deliver(send, user_id)
+    return payment, notified
+
+async def resolve_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, payment_id: str):
+    """Approve or decline a pending payment; of several clicks only the first acts."""
+    query = update.callback_query
+    if query.from_user.id != ADMIN_CHAT_ID:
+        await query.answer("Only admin can use this.", show_alert=True)
+        return
+    async with PAYMENT_LOCKS(payment_id):
+        payment, _ = await settle_payment(context, action, payment_id)
         if not payment:
-            await query.message.reply_text("⚠️ This payment request was not found or already processed.")
+            outcome = RESOLVED_PAYMENTS.get(payment_id)
+            if outcome:
+                await query.message.reply_text(f"⚠️ Payment {payment_id} was already {RESOLVED_LABELS[outcome]}.")
+            else:
+                await query.message.reply_text("⚠️ This payment request was not found or already processed.")
             return
-        user_id = payment["user_id"]
-        plan = payment["plan"]
-        method = payment["method"]
-        amount = payment["amount"]
-        currency = payment["currency"]
-        username = payment["username"]
         if action == "approve":
-            PURCHASE_LOG.append({
-                "time": now_ist(),
-                "user_id": user_id,
-                "username": username,
-                "plan": plan,
-                "method": method,
-                "amount": amount,
-                "currency": currency,
-            })
-            # persist purchase log
-            save_state()
-            try:
-                await send_access_links(context, user_id, plan)
-            except Exception:
-                logger.exception("Error sending access links")
-            await query.message.reply_text(f"✅ Approved payment (ID: {payment_id}) for user {user_id} | {amount} {currency}")
+            await query.message.reply_text(
+                f"✅ Approved payment (ID: {payment_id}) for user {payment['user_id']} | {payment['amount']} {payment['currency']}"
+            )
         else:
-            try:
-                await context.bot.send_message(chat_id=user_id, text=("❌ Your payment could not be verified.\nIf this is a mistake, please send a clearer screenshot or contact support: " + HELP_BOT_USERNAME))
-            except Exception:
-                logger.exception("Can't send decline message to user")
             await query.message.reply_text(f"❌ Declined payment (ID: {payment_id})")
-        # remove pending
-        PENDING_PAYMENTS.pop(payment_id, None)
-        save_state()
-        return
 
 async def handle_payment_proof(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -397,38 +2963,89 @@ async def handle_payment_proof(update: Update, context: ContextTypes.DEFAULT_TYP
 
     method = context.user_data.get("waiting_for_proof")
     plan = context.user_data.get("selected_plan")
+    deadline = context.user_data.get("payment_deadline")
+    if method and deadline and deadline < time.time():
+        # the scheduler has not got to this window yet
+        context.user_data["waiting_for_proof"] = method = None
+        context.user_data["payment_deadline"] = None
+        context.user_data["window_expired"] = True
     if not method or not plan:
+        if context.user_data.pop("window_expired", False):
+            await message.reply_text(
+                "⌛ Your payment time limit has expired.\n"
+                "Tap /start and choose your plan and payment method again, then send the proof. "
+                f"If you already paid, contact support: {HELP_BOT_USERNAME}"
+            )
+        return
+    # only proofs we would act on count against the limit
+    if not await within_limit("proof", update):
+        return
+    keys = proof_keys(message)
+    duplicate = find_duplicate_proof(keys)
+    # a TXID declined before is taken again, but only for the admin to review
+    declined_txid = (duplicate is not None and duplicate.get("declined")
+                     and duplicate["payment_id"] not in PENDING_PAYMENTS)
+    if duplicate is not None and not declined_txid:
+        contested = duplicate["user_id"] != user.id and contest_crypto_payment(duplicate["payment_id"])
+        await reply_duplicate_proof(context.bot, message, user.id, duplicate, contested)
         return
     amount, currency = get_price(plan, method)
     payment_id = str(message.message_id) + "_" + str(int(datetime.now().timestamp()))
-    PENDING_PAYMENTS[payment_id] = {
+    if payment_id in PENDING_PAYMENTS or MULTI_WORKER:
+        # message ids are per chat, so two users can collide within a second
+        # (and other workers' new ids are not visible here yet)
+        payment_id += f"_{user.id}"
+    payment = {
         "user_id": user.id,
         "username": user.username or "",
         "plan": plan,
         "method": method,
         "amount": amount,
         "currency": currency,
+        "created": time.time(),
+        "proof_keys": keys,
     }
-    # persist pending payments
-    save_state()
-    try:
-        await context.bot.forward_message(chat_id=ADMIN_CHAT_ID, from_chat_id=chat.id, message_id=message.message_id)
-    except Exception:
-        logger.exception("Forwarding failed")
-    kb = [[InlineKeyboardButton("✅ Approve", callback_data=f"approve:{payment_id}"), InlineKeyboardButton("❌ Decline", callback_data=f"decline:{payment_id}")]]
-    await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=(f"💰 New payment request\nFrom: @{user.username or 'NoUsername'} (ID: {user.id})\nPlan: {PLAN_LABELS.get(plan, plan)}\nMethod: {method.upper()}\nAmount: {amount} {currency}\nPayment ID: {payment_id}\n\nCheck forwarded message and choose:"), reply_markup=InlineKeyboardMarkup(kb))
+    note = ""
+    if declined_txid:
+        payment["declined_txid"] = duplicate["payment_id"]
+        note = f"⚠️ TXID already declined for payment {duplicate['payment_id']} (user {duplicate['user_id']})\n"
+    PENDING_PAYMENTS[payment_id] = payment
+    journal_event("payment_pending", payment_id=payment_id, payment=payment)
+    index_proof(keys, payment_id, user.id, declined=bool(declined_txid))
+    track_pending(payment_id, payment)
+    start_crypto_verification(context.application, payment_id, payment)
+    proof = message.photo[-1] if message.photo else message.document
+    if DIGEST_WINDOW > 0 and proof is not None:
+        queue_for_digest(context.bot, {
+            "payment_id": payment_id,
+            "file_id": proof.file_id,
+            "kind": "photo" if message.photo else "document",
+            "caption": note + (message.caption or ""),
+        })
+        await message.reply_text("✅ Payment proof received. We'll verify and send access after approval.")
+        return
+    with outbound_priority(PRIORITY_ADMIN):
+        try:
+            await context.bot.forward_message(chat_id=ADMIN_CHAT_ID, from_chat_id=chat.id, message_id=message.message_id)
+        except Exception:
+            logger.exception("Forwarding failed")
+        kb = [[InlineKeyboardButton("✅ Approve", callback_data=f"approve:{payment_id}"), InlineKeyboardButton("❌ Decline", callback_data=f"decline:{payment_id}")]]
+        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=(f"💰 New payment request\n{note}From: @{user.username or 'NoUsername'} (ID: {user.id})\nPlan: {PLAN_LABELS.get(plan, plan)}\nMethod: {method.upper()}\nAmount: {amount} {currency}\nPayment ID: {payment_id}\n\nCheck forwarded message and choose:"), reply_markup=InlineKeyboardMarkup(kb))
     await message.reply_text("✅ Payment proof received. We'll verify and send access after approval.")
 
 async def warn_text_not_allowed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     method = context.user_data.get("waiting_for_proof")
     plan = context.user_data.get("selected_plan")
-    if not method or not plan:
+    deadline = context.user_data.get("payment_deadline")
+    if not method or not plan or (deadline and deadline < time.time()):
+        return
+    # only users being answered count against the limit, so the rest never hear from it
+    if not await within_limit("text", update):
         return
     await update.message.reply_text("⚠️ Please send a screenshot/photo or document of your payment only. Plain text messages cannot be verified.", parse_mode="Markdown")
 
 # Admin commands (broadcast, income, set_price, set_upi, set_crypto, set_remitly)
 async def set_vip_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global VIP_CHANNEL_ID
     user = update.effective_user
     if not is_admin(user.id):
         return
@@ -436,13 +3053,15 @@ async def set_vip_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /set_vip <channel_id>")
         return
     try:
-        VIP_CHANNEL_ID = int(context.args[0])
+        old_channel = VIP_CHANNEL_ID
+        set_config("VIP_CHANNEL_ID", int(context.args[0]))
+        if old_channel != VIP_CHANNEL_ID:
+            discard_invite_pool(context.bot, old_channel)
         await update.message.reply_text(f"VIP_CHANNEL_ID updated to {VIP_CHANNEL_ID}")
     except ValueError:
         await update.message.reply_text("channel_id must be an integer (e.g. -1001234567890)")
 
 async def set_dark_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global DARK_CHANNEL_ID
     user = update.effective_user
     if not is_admin(user.id):
         return
@@ -450,11 +3069,127 @@ async def set_dark_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /set_dark <channel_id>")
         return
     try:
-        DARK_CHANNEL_ID = int(context.args[0])
+        old_channel = DARK_CHANNEL_ID
+        set_config("DARK_CHANNEL_ID", int(context.args[0]))
+        if old_channel != DARK_CHANNEL_ID:
+            discard_invite_pool(context.bot, old_channel)
         await update.message.reply_text(f"DARK_CHANNEL_ID updated to {DARK_CHANNEL_ID}")
     except ValueError:
         await update.message.reply_text("channel_id must be an integer (e.g. -1009876543210)")
 
+# Broadcast engine -----------------------------------------------------------
+# A broadcast is a job record in BROADCAST_JOBS, persisted through the
+# journal.  Users are messaged in ascending user_id order; `cursor` is the
+# highest user_id below which everybody has been handled and `done_ahead`
+# holds the finished ids above it (only those that overtook a slower send),
+# so a job resumed after a redeploy neither restarts nor double-sends.
+_BROADCAST_TASKS: Dict[str, asyncio.Task] = {}
+
+def _broadcast_status(job: dict, done: bool = False) -> str:
+    head = "Broadcast done." if done else "📣 Broadcasting…"
+    return (
+        f"{head}\n✅ Sent: {job['sent']}\n❌ Failed: {job['failed']}\n"
+        f"🧹 Removed (blocked the bot): {job['pruned']}"
+        + ("" if done else f"\n👥 Audience: {job['total']}")
+    )
+
+async def _broadcast_checkpoint(bot, job: dict, done: bool = False):
+    """Persist the job cursor and edit the admin's progress message."""
+    if done:
+        BROADCAST_JOBS.pop(job["id"], None)
+        journal_event("broadcast_finished", job_id=job["id"])
+    else:
+        journal_event("broadcast_saved", job=dict(job))
+    try:
+        await bot.edit_message_text(
+            chat_id=job["chat_id"], message_id=job["message_id"], text=_broadcast_status(job, done)
+        )
+    except BadRequest:
+        # "message is not modified" or the progress message is gone
+        pass
+    except Exception:
+        logger.exception("Could not update broadcast progress message")
+
+async def _broadcast_one(bot, job: dict, uid: int) -> str:
+    """Send the job's text to one user. Returns sent, failed or pruned."""
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        try:
+            await bot.send_message(chat_id=uid, text=job["text"])
+            return "sent"
+        except RetryAfter as e:
+            # the scheduler's own retries ran out; hold everybody back
+            OUTBOUND.pause(retry_after_seconds(e))
+        except Forbidden:
+            # blocked the bot or deactivated account
+            return "pruned"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "pruned"
+            return "failed"
+        except NetworkError:
+            await asyncio.sleep(2 ** attempt)
+        except Exception:
+            logger.exception("Broadcast to %s failed", uid)
+            return "failed"
+    return "failed"
+
+async def run_broadcast(bot, job: dict):
+    """Deliver a broadcast job with bounded concurrency at bulk priority."""
+    OUTBOUND_PRIORITY.set(PRIORITY_BULK)   # this task's own context
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    in_flight: set = set()
+    done_ahead = set(job["done_ahead"])
+    tasks: set = set()
+    last_report = time.monotonic()
+
+    def finished(uid: int, result: str):
+        nonlocal last_report
+        in_flight.discard(uid)
+        done_ahead.add(uid)
+        job[result] += 1
+        if result == "pruned" and uid in KNOWN_USERS:
+            KNOWN_USERS.discard(uid)
+            journal_event("user_removed", user_id=uid)
+        # advance the cursor over everything below the oldest send still running
+        low = min(in_flight) if in_flight else float("inf")
+        passed = [u for u in done_ahead if u < low]
+        if passed:
+            job["cursor"] = max(job["cursor"], max(passed))
+            done_ahead.difference_update(passed)
+        job["done_ahead"] = sorted(done_ahead)
+        sem.release()
+
+    async def send(uid: int):
+        # a cancelled send is deliberately not marked finished
+        finished(uid, await _broadcast_one(bot, job, uid))
+
+    try:
+        targets = sorted(u for u in KNOWN_USERS if u > job["cursor"] and u not in done_ahead)
+        for uid in targets:
+            await sem.acquire()
+            in_flight.add(uid)
+            task = asyncio.create_task(send(uid))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await _broadcast_checkpoint(bot, job)
+        if tasks:
+            await asyncio.gather(*tasks)
+        await _broadcast_checkpoint(bot, job, done=True)
+    except asyncio.CancelledError:
+        # shutting down: sends still in flight are not marked done and will be
+        # retried on resume; everything else is skipped
+        for task in list(tasks):
+            task.cancel()
+        journal_event("broadcast_saved", job=dict(job))
+        raise
+    finally:
+        _BROADCAST_TASKS.pop(job["id"], None)
+
+def start_broadcast_task(bot, job: dict):
+    _BROADCAST_TASKS[job["id"]] = asyncio.create_task(run_broadcast(bot, job))
+
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not is_admin(user.id):
@@ -462,55 +3197,731 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("Usage: /broadcast your message text\n\nThis will send the text to all users who started the bot.")
         return
+    if _BROADCAST_TASKS:
+        await update.message.reply_text("A broadcast is already running. Wait for it to finish.")
+        return
     text = " ".join(context.args)
-    sent = 0
-    failed = 0
-    for uid in KNOWN_USERS:
-        try:
-            await context.bot.send_message(chat_id=uid, text=text)
-            sent += 1
-        except Exception:
-            failed += 1
-    await update.message.reply_text(f"Broadcast done.\n✅ Sent: {sent}\n❌ Failed: {failed}")
+    job = {
+        "id": secrets.token_hex(4),
+        "text": text,
+        "cursor": 0,  # user ids are positive
+        "done_ahead": [],
+        "sent": 0,
+        "failed": 0,
+        "pruned": 0,
+        "total": len(KNOWN_USERS),
+    }
+    progress = await update.message.reply_text(_broadcast_status(job))
+    job["chat_id"] = progress.chat_id
+    job["message_id"] = progress.message_id
+    BROADCAST_JOBS[job["id"]] = job
+    journal_event("broadcast_saved", job=dict(job))
+    start_broadcast_task(context.bot, job)
 
-async def income(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Pending queue --------------------------------------------------------------
+# /pending shows PENDING_PAYMENTS oldest first, one page at a time, in a
+# single message that the inline buttons edit in place.  The view (filters,
+# page, selection, pending confirmation) lives in the admin's user_data.
+# Bulk approve/decline fans out through settle_payment() under the payment
+# locks (its messages queue at approval priority), then posts one summary.
+PENDING_USAGE = (
+    "Usage: /pending [filters]\n"
+    "       /pending decline_older <age> [filters]\n\n"
+    "Filters: vip, dark, both · upi, crypto, remitly ·\n"
+    "age>2h, age<30m · amount>500, amount<2000\n"
+    "Ages take m, h or d.  Example: /pending upi age>1h"
+)
+_AGE_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+def _parse_pending_filters(args: list):
+    """Return a filter dict for /pending args, or None if any arg is invalid."""
+    f = {}
+    for arg in args:
+        arg = arg.lower()
+        if arg in PRICE_CONFIG:
+            f["plan"] = arg
+        elif arg in ("upi", "crypto", "remitly"):
+            f["method"] = arg
+        elif m := re.fullmatch(r"age([<>])(\d+)([mhd])", arg):
+            f["min_age" if m.group(1) == ">" else "max_age"] = int(m.group(2)) * _AGE_UNITS[m.group(3)]
+        elif m := re.fullmatch(r"amount([<>])(\d+(?:\.\d+)?)", arg):
+            f["min_amount" if m.group(1) == ">" else "max_amount"] = float(m.group(2))
+        else:
+            return None
+    return f
+
+def _pending_matches(payment: dict, f: dict, now: float) -> bool:
+    age = now - payment.get("created", 0)
+    amount = payment.get("amount") or 0
+    return (
+        f.get("plan") in (None, payment.get("plan"))
+        and f.get("method") in (None, payment.get("method"))
+        and age >= f.get("min_age", 0)
+        and age <= f.get("max_age", float("inf"))
+        and amount >= f.get("min_amount", float("-inf"))
+        and amount <= f.get("max_amount", float("inf"))
+    )
+
+def filter_pending(f: dict) -> list:
+    """payment_ids matching the filters, oldest first."""
+    now = time.time()
+    matches = [(p.get("created", 0), pid) for pid, p in PENDING_PAYMENTS.items() if _pending_matches(p, f, now)]
+    return [pid for _, pid in sorted(matches)]
+
+def _fmt_age(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes}m"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours}h {minutes}m" if minutes else f"{hours}h"
+    days, hours = divmod(hours, 24)
+    return f"{days}d {hours}h" if hours else f"{days}d"
+
+def _fmt_filters(f: dict) -> str:
+    parts = [f[k] for k in ("plan", "method") if k in f]
+    for key, op in (("min_age", ">"), ("max_age", "<")):
+        if key in f:
+            parts.append(f"age{op}{_fmt_age(f[key])}")
+    for key, op in (("min_amount", ">"), ("max_amount", "<")):
+        if key in f:
+            parts.append(f"amount{op}{f[key]:g}")
+    return " ".join(parts) or "none"
+
+def render_pending_view(view: dict):
+    """Text and keyboard for the current page of a /pending view."""
+    ids = filter_pending(view["filters"])
+    # drop selections that were resolved elsewhere
+    view["selected"] = [pid for pid in view["selected"] if pid in PENDING_PAYMENTS]
+    selected = set(view["selected"])
+    pages = max(1, -(-len(ids) // PENDING_PAGE_SIZE))
+    view["page"] = min(max(view["page"], 0), pages - 1)
+    first = view["page"] * PENDING_PAGE_SIZE
+    page_ids = ids[first:first + PENDING_PAGE_SIZE]
+    now = time.time()
+
+    lines = [f"🧾 Pending payments — {len(ids)} of {len(PENDING_PAYMENTS)} (filters: {_fmt_filters(view['filters'])})"]
+    if not ids:
+        lines.append("\nNothing to review.")
+    for n, pid in enumerate(page_ids, first + 1):
+        p = PENDING_PAYMENTS[pid]
+        mark = "☑" if pid in selected else "☐"
+        lines.append(
+            f"{mark} {n}. {pid} · @{p.get('username') or p.get('user_id')} · "
+            f"{PLAN_LABELS.get(p.get('plan'), p.get('plan'))} · {str(p.get('method')).upper()} · "
+            f"{p.get('amount')} {p.get('currency')} · {_fmt_age(now - p.get('created', 0))}"
+        )
+
+    toggles = [
+        InlineKeyboardButton(f"{'☑' if pid in selected else '☐'} {n}", callback_data=f"pq:t:{pid}")
+        for n, pid in enumerate(page_ids, first + 1)
+    ]
+    kb = [toggles[i:i + 4] for i in range(0, len(toggles), 4)]
+    kb.append([
+        InlineKeyboardButton("◀", callback_data=f"pq:p:{view['page'] - 1}"),
+        InlineKeyboardButton(f"{view['page'] + 1}/{pages} ⟳", callback_data="pq:r"),
+        InlineKeyboardButton("▶", callback_data=f"pq:p:{view['page'] + 1}"),
+    ])
+    kb.append([
+        InlineKeyboardButton("Select page", callback_data="pq:sp"),
+        InlineKeyboardButton("Clear", callback_data="pq:c"),
+    ])
+    if view.get("confirm"):
+        verb = "approve" if view["confirm"] == "approve" else "decline"
+        lines.append(f"\nReally {verb} {len(selected)} selected payment(s)?")
+        kb.append([
+            InlineKeyboardButton(f"Yes, {verb} {len(selected)}", callback_data="pq:y"),
+            InlineKeyboardButton("Cancel", callback_data="pq:n"),
+        ])
+    elif selected:
+        kb.append([
+            InlineKeyboardButton(f"✅ Approve {len(selected)}", callback_data="pq:a"),
+            InlineKeyboardButton(f"❌ Decline {len(selected)}", callback_data="pq:d"),
+        ])
+    return "\n".join(lines), InlineKeyboardMarkup(kb)
+
+async def bulk_resolve(context: ContextTypes.DEFAULT_TYPE, action: str, payment_ids: list) -> str:
+    """Approve or decline many payments concurrently; returns a summary line."""
+    sem = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def one(payment_id):
+        async with sem, PAYMENT_LOCKS(payment_id):
+            return await settle_payment(context, action, payment_id)
+
+    results = await asyncio.gather(*(one(pid) for pid in payment_ids), return_exceptions=True)
+    done = unreached = gone = errors = 0
+    totals: Dict[str, float] = {}
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Bulk %s failed: %s", action, result)
+            errors += 1
+            continue
+        payment, notified = result
+        if payment is None:
+            gone += 1
+            continue
+        done += 1
+        unreached += not notified
+        totals[payment["currency"]] = totals.get(payment["currency"], 0) + (payment["amount"] or 0)
+    verb = "Approved" if action == "approve" else "Declined"
+    summary = f"{'✅' if action == 'approve' else '❌'} {verb} {done} payment(s)"
+    if totals and action == "approve":
+        summary += " | " + ", ".join(f"{amount:g} {currency}" for currency, amount in sorted(totals.items()))
+    for count, what in ((unreached, "user(s) could not be notified"), (gone, "already resolved"), (errors, "failed")):
+        if count:
+            summary += f"\n• {count} {what}"
+    return summary
+
+async def _show_pending_view(query, view: dict):
+    text, markup = render_pending_view(view)
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+async def pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not is_admin(user.id):
         return
-    mode = "today"
-    if context.args:
-        mode = context.args[0].lower()
-    now = now_ist()
+    args = context.args or []
+    if args and args[0].lower() == "decline_older":
+        m = re.fullmatch(r"(\d+)([mhd])", args[1].lower()) if len(args) > 1 else None
+        f = _parse_pending_filters(args[2:]) if m else None
+        if f is None:
+            await update.message.reply_text(PENDING_USAGE)
+            return
+        f["min_age"] = int(m.group(1)) * _AGE_UNITS[m.group(2)]
+        ids = filter_pending(f)
+        if not ids:
+            await update.message.reply_text(f"No pending payments match ({_fmt_filters(f)}).")
+            return
+        await update.message.reply_text(f"Declining {len(ids)} payment(s) ({_fmt_filters(f)})…")
+        # outside the admin's lock so other admin commands keep working meanwhile
+        await update.message.reply_text(await bulk_resolve(context, "decline", ids))
+        return
+    f = _parse_pending_filters(args)
+    if f is None:
+        await update.message.reply_text(PENDING_USAGE)
+        return
+    async with USER_LOCKS(user.id):
+        view = {"filters": f, "page": 0, "selected": [], "confirm": None}
+        context.user_data["pending_view"] = view
+        text, markup = render_pending_view(view)
+        await update.message.reply_text(text, reply_markup=markup)
+
+async def pending_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Inline buttons of the /pending view (callback data "pq:<op>[:<arg>]")."""
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        return
+    _, op, arg = (query.data.split(":", 2) + [""])[:3]
+    async with USER_LOCKS(query.from_user.id):
+        view = context.user_data.get("pending_view")
+        if view is None:
+            await query.message.reply_text("This view has expired. Send /pending again.")
+            return
+        action = ids = None
+        if op == "t":
+            if arg in view["selected"]:
+                view["selected"].remove(arg)
+            elif arg in PENDING_PAYMENTS:
+                view["selected"].append(arg)
+            view["confirm"] = None
+        elif op == "p" and arg.lstrip("-").isdigit():
+            view["page"] = int(arg)
+        elif op == "sp":
+            first = view["page"] * PENDING_PAGE_SIZE
+            page_ids = filter_pending(view["filters"])[first:first + PENDING_PAGE_SIZE]
+            view["selected"] += [pid for pid in page_ids if pid not in view["selected"]]
+        elif op == "c":
+            view["selected"] = []
+            view["confirm"] = None
+        elif op in ("a", "d"):
+            view["confirm"] = "approve" if op == "a" else "decline"
+        elif op == "n":
+            view["confirm"] = None
+        elif op == "y" and view.get("confirm"):
+            action, ids = view["confirm"], list(view["selected"])
+            view["selected"] = []
+            view["confirm"] = None
+        await _show_pending_view(query, view)
+    if ids:
+        # outside the admin's lock so other admin commands keep working meanwhile
+        summary = await bulk_resolve(context, action, ids)
+        await query.message.reply_text(summary)
+        async with USER_LOCKS(query.from_user.id):
+            if context.user_data.get("pending_view") is view:
+                await _show_pending_view(query, view)
+
+INCOME_USAGE = (
+    "Usage: /income [range] [plan|method]\n\n"
+    "Ranges: today, yesterday, 7d, 30d (any Nd), month, lastmonth, all,\n"
+    "YYYY-MM-DD or YYYY-MM-DD..YYYY-MM-DD\n"
+    "Example: /income 2025-12-01..2025-12-15 plan"
+)
+
+def _parse_income_range(args: list, today: date):
+    """Return (first_day, last_day, label) for /income args, or None if invalid."""
+    if not args or args[0] == "today":
+        return today, today, "Today"
+    mode = args[0]
     if mode == "yesterday":
-        start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        end = start + timedelta(days=1)
-        label = "Yesterday"
-    elif mode in ("7d", "7days", "last7"):
-        end = now
-        start = now - timedelta(days=7)
-        label = "Last 7 days"
-    else:
-        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = start + timedelta(days=1)
-        label = "Today"
-    total_inr = 0
-    total_usd = 0
-    count = 0
-    for p in PURCHASE_LOG:
-        t = p["time"]
-        if start <= t < end:
-            count += 1
-            if p["currency"] == "INR":
-                total_inr += p["amount"] or 0
-            elif p["currency"] == "USD":
-                total_usd += p["amount"] or 0
+        day = today - timedelta(days=1)
+        return day, day, "Yesterday"
+    if mode in ("7days", "last7"):
+        mode = "7d"
+    m = re.fullmatch(r"(\d+)d", mode)
+    if m and int(m.group(1)) > 0:
+        n = int(m.group(1))
+        return today - timedelta(days=n - 1), today, f"Last {n} days"
+    if mode in ("month", "thismonth"):
+        return today.replace(day=1), today, "This month"
+    if mode == "lastmonth":
+        last = today.replace(day=1) - timedelta(days=1)
+        return last.replace(day=1), last, "Last month"
+    if mode == "all":
+        return (min(INCOME_BY_DAY) if INCOME_BY_DAY else today), today, "All time"
+    parts = mode.split("..") if ".." in mode else args[:2] if len(args) > 1 and args[1] not in ("plan", "method") else [mode]
+    try:
+        first = date.fromisoformat(parts[0])
+        last = date.fromisoformat(parts[-1])
+    except ValueError:
+        return None
+    if last < first:
+        return None
+    label = first.isoformat() if first == last else f"{first.isoformat()} → {last.isoformat()}"
+    return first, last, label
+
+async def income(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        return
+    args = [a.lower() for a in (context.args or [])]
+    group_by = next((a for a in args if a in ("plan", "method")), None)
+    args = [a for a in args if a not in ("plan", "method")]
+    parsed = _parse_income_range(args, now_ist().date())
+    if parsed is None:
+        await update.message.reply_text(INCOME_USAGE)
+        return
+    first, last, label = parsed
+    totals = income_totals(first, last)
+    overall = totals.get(None, {"count": 0, "INR": 0, "USD": 0})
     msg = (f"📊 *Income Insights – {label}*\n\n"
-           f"Total orders: *{count}*\n"
-           f"INR collected: *₹{total_inr}*\n"
-           f"USD collected (crypto): *${total_usd}*\n\n"
-           "_Note: stats reset if the bot restarts or redeploys._")
+           f"Total orders: *{overall['count']}*\n"
+           f"INR collected: *₹{overall['INR']}*\n"
+           f"USD collected (crypto): *${overall['USD']}*")
+    if group_by:
+        lines = []
+        for key, row in sorted(income_totals(first, last, group_by).items(), key=lambda kv: -kv[1]["count"]):
+            name = PLAN_LABELS.get(key, key) if group_by == "plan" else str(key).upper()
+            lines.append(f"• {name}: {row['count']} orders · ₹{row['INR']} · ${row['USD']}")
+        msg += f"\n\n*By {group_by}:*\n" + ("\n".join(lines) if lines else "—")
     await update.message.reply_text(msg, parse_mode="Markdown")
 
+EXPORT_USAGE = (
+    "Usage: /export [range] [csv|jsonl] [vip|dark|both] [upi|crypto|remitly]\n\n"
+    "Ranges are the same as /income (default: this month).\n"
+    "Example: /export 2025-12-01..2025-12-31 csv vip upi"
+)
+EXPORT_FIELDS = ("time", "payment_id", "user_id", "username", "plan", "method", "amount", "currency")
+EXPORT_CHUNK_ROWS = 1000
+
+def write_purchase_export(path: str, rows, fmt: str, plans: set, methods: set) -> int:
+    """Stream `rows` into a gzipped CSV/JSONL file at `path`; returns rows written.
+
+    Runs in a worker thread.  Rows are formatted EXPORT_CHUNK_ROWS at a time,
+    so memory stays flat however much history matches.
+    """
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if fmt == "csv":
+            writer.writerow(EXPORT_FIELDS)
+        for p in rows:
+            if (plans and p["plan"] not in plans) or (methods and p["method"] not in methods):
+                continue
+            record = dict(p, time=p["time"].isoformat() if isinstance(p["time"], datetime) else p["time"])
+            if fmt == "csv":
+                writer.writerow([record.get(k) for k in EXPORT_FIELDS])
+            else:
+                buf.write(json.dumps({k: record.get(k) for k in EXPORT_FIELDS}, ensure_ascii=False) + "\n")
+            count += 1
+            if count % EXPORT_CHUNK_ROWS == 0:
+                f.write(buf.getvalue())
+                buf.seek(0)
+                buf.truncate()
+        f.write(buf.getvalue())
+    return count
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        return
+    args = [a.lower() for a in (context.args or [])]
+    fmt = "jsonl" if "jsonl" in args else "csv"
+    plans = {a for a in args if a in PRICE_CONFIG}
+    methods = {a for a in args if a in ("upi", "crypto", "remitly")}
+    args = [a for a in args if a not in ("csv", "jsonl") and a not in plans and a not in methods]
+    parsed = _parse_income_range(args or ["month"], now_ist().date())
+    if parsed is None:
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+    first, last, label = parsed
+    start = end = None
+    if label != "All time":
+        start = datetime(first.year, first.month, first.day, tzinfo=IST)
+        end = datetime(last.year, last.month, last.day, tzinfo=IST) + timedelta(days=1)
+    await update.message.reply_text(f"⏳ Exporting purchases ({label})…")
+    rows = STORE.iter_purchases_threaded(start, end)
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        loop = asyncio.get_running_loop()
+        count = await loop.run_in_executor(None, write_purchase_export, path, rows, fmt, plans, methods)
+        filters_text = " ".join(sorted(plans) + sorted(methods))
+        name = f"purchases_{first.isoformat()}_{last.isoformat()}.{fmt}.gz"
+        with open(path, "rb") as f:
+            await context.bot.send_document(
+                chat_id=user.id,
+                document=f,
+                filename=name,
+                caption=f"📦 {count} purchases · {label}" + (f" · {filters_text}" if filters_text else ""),
+            )
+    except Exception as e:
+        logger.exception("Export failed: %s", e)
+        await update.message.reply_text(f"❌ Export failed: {e}")
+    finally:
+        os.remove(path)
+
+# Statement reconciliation ---------------------------------------------------
+# The admin uploads a bank / UPI statement export (CSV) with caption
+# /reconcile.  It is read one row at a time in a worker thread into credit
+# rows of (start, end, paise, refs) -- a date without a time spans the whole
+# day -- indexed by reference (UTR/RRN, as find_refs() extracts them) and by
+# amount, sorted by time.  Pending payments are then matched on the UTRs in
+# their proof captions, the expected amount and the proof time; confident
+# matches go through bulk_resolve() and the rest are listed for review.
+RECONCILE_USAGE = (
+    "Usage: send a bank / UPI statement export (.csv) with caption /reconcile, "
+    "or reply /reconcile to one.\n\n"
+    "Credits are matched to pending UPI and Remitly payments by the UTR in the proof caption, "
+    "the plan price and the time the proof was sent."
+)
+RECONCILE_METHODS = ("upi", "remitly")
+RECONCILE_REVIEW_MAX = 20
+# statement header keywords per column, most specific first; the first
+# header containing a keyword wins
+_STATEMENT_HEADERS = (
+    ("credit", ("credit", "deposit", "cr amount")),
+    ("amount", ("amount", "amt")),
+    ("kind", ("dr/cr", "cr/dr", "dr cr", "type")),
+    ("date", ("txn date", "transaction date", "date")),
+    ("time", ("time",)),
+    ("ref", ("utr", "rrn", "reference", "ref no", "ref", "transaction id", "txn id", "chq", "cheque")),
+    ("narration", ("narration", "description", "remarks", "particulars", "details")),
+)
+_STATEMENT_DATE_FORMATS = (
+    "%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d", "%d.%m.%Y", "%d/%m/%y", "%d-%m-%y",
+    "%d %b %Y", "%d-%b-%Y", "%d %b %y", "%d-%b-%y", "%d %B %Y",
+)
+_STATEMENT_TIME_FORMATS = ("%H:%M:%S", "%H:%M", "%I:%M:%S %p", "%I:%M %p")
+_STATEMENT_HEADER_SEARCH_ROWS = 50
+
+def _statement_columns(cells: list):
+    """Column index per role if `cells` is a statement header row, else None."""
+    headers = [re.sub(r"[^a-z0-9/]+", " ", cell.lower()).strip() for cell in cells]
+    cols = {}
+    for role, keywords in _STATEMENT_HEADERS:
+        for keyword in keywords:
+            i = next((i for i, h in enumerate(headers) if keyword in h and i not in cols.values()), None)
+            if i is not None:
+                cols[role] = i
+                break
+    if "date" in cols and ("credit" in cols or "amount" in cols):
+        return cols
+    return None
+
+def _parse_amount(text: str):
+    text = re.sub(r"[^\d.\-]", "", text)
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def _parse_statement_time(text: str, formats: list):
+    """(start, end) in epoch seconds for a statement date, or None.
+
+    `formats` is tried in order and the one that worked is moved to the
+    front, so a file in one format costs one strptime per row.
+    """
+    text = " ".join(re.sub(r"(?<=\d)T(?=\d)", " ", text).split())
+    for n, fmt in enumerate(formats):
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if n:
+            formats.insert(0, formats.pop(n))
+        start = parsed.replace(tzinfo=IST).timestamp()
+        # a bare date could be any time that day
+        return start, start + (86400 if fmt in _STATEMENT_DATE_FORMATS else 60)
+    return None
+
+def build_statement_index(path: str) -> dict:
+    """Read the credits of a statement CSV at `path` (runs in a worker thread).
+
+    Raises ValueError when no header row with a date and an amount column
+    is found near the top of the file.
+    """
+    formats = [d + " " + t for d in _STATEMENT_DATE_FORMATS for t in _STATEMENT_TIME_FORMATS]
+    formats += _STATEMENT_DATE_FORMATS
+    rows, by_ref, by_amount = [], {}, {}
+    seen: Dict[str, int] = {}
+    skipped = span = 0
+    cols = None
+    with open(path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        reader = csv.reader(f)
+        for cells in reader:
+            if cols is None:
+                cols = _statement_columns(cells)
+                if cols is None and reader.line_num >= _STATEMENT_HEADER_SEARCH_ROWS:
+                    break
+                continue
+            if not any(cell.strip() for cell in cells):
+                continue
+
+            def cell(role):
+                i = cols.get(role)
+                return cells[i].strip() if i is not None and i < len(cells) else ""
+
+            if "credit" in cols:
+                amount = _parse_amount(cell("credit"))
+            else:
+                amount = _parse_amount(cell("amount"))
+                if re.match(r"d(r|ebit)?\b", cell("kind").lower()):
+                    amount = None
+            when = _parse_statement_time(f"{cell('date')} {cell('time')}", formats)
+            if not amount or amount <= 0 or when is None:
+                # debits, balances, totals and anything unreadable
+                skipped += 1
+                continue
+            refs = find_refs(f"{cell('ref')} {cell('narration')}")
+            # a bare reference column ("AB12345678") has no label to find it by
+            bare = re.sub(r"[^a-z0-9]", "", cell("ref").lower())
+            if len(bare) >= 8 and bare not in refs:
+                refs.append(bare)
+            # the same credit gets the same key in any later or overlapping
+            # export; identical rows are told apart by their position
+            ident = f"{when[0]:.0f}|{round(amount * 100)}|{' '.join(cell('narration').lower().split())}|{cell('ref')}"
+            seen[ident] = seen.get(ident, 0) + 1
+            key = hashlib.sha1(f"{ident}|{seen[ident]}".encode()).hexdigest()[:20]
+            i = len(rows)
+            rows.append((when[0], when[1], round(amount * 100), tuple(refs), key))
+            span = max(span, when[1] - when[0])
+            for ref in refs:
+                by_ref.setdefault(ref, []).append(i)
+            by_amount.setdefault(rows[i][2], []).append((when[0], i))
+    if cols is None:
+        raise ValueError("no header row with a date and an amount column")
+    for bucket in by_amount.values():
+        bucket.sort()
+    # "span" is the longest row (a day if any row is date-only), which
+    # bounds how far before a window a matching row can start
+    return {"rows": rows, "by_ref": by_ref, "by_amount": by_amount, "skipped": skipped, "span": span}
+
+# credit keys matched to payments by the last /reconcile, consumed (as
+# "stmt:<key>" PROOF_INDEX entries) if the payment is approved
+_STATEMENT_MATCHES: Dict[str, str] = {}
+
+def _used_statement_rows(rows: list, by_ref: dict) -> set:
+    """Credits that already paid for an approved payment, or carry the UTR of a resolved one."""
+    used = {i for i, row in enumerate(rows) if "stmt:" + row[4] in PROOF_INDEX}
+    for key, entry in PROOF_INDEX.items():
+        if key.startswith("ref:") and entry["payment_id"] not in PENDING_PAYMENTS:
+            used.update(by_ref.get(key[4:], ()))
+    return used
+
+def consume_statement_row(payment_id: str, user_id: int, action: str):
+    """Mark the credit a resolved payment was matched to as used, if it was approved."""
+    key = _STATEMENT_MATCHES.pop(payment_id, None)
+    if key is not None and action == "approve":
+        index_proof(["stmt:" + key], payment_id, user_id)
+
+def match_statement(index: dict) -> dict:
+    """Match pending UPI/Remitly payments to the credits of a statement index.
+
+    A credit carrying a UTR from the proof caption and the expected amount
+    is a confident match.  A payment without a UTR hit is matched on amount
+    within its time window, and counts as confident only with
+    RECONCILE_TRUST_AMOUNT and when that one credit falls in no other
+    payment's window.  Credits already used for an approved payment never
+    match again.  Returns {"approve": [payment_id], "review": [(payment_id,
+    reason)], "rows": {payment_id: credit key}, "checked": n}; "rows" covers
+    the approvals and the reviews that have exactly one candidate credit.
+    """
+    rows, by_ref, by_amount = index["rows"], index["by_ref"], index["by_amount"]
+    window = RECONCILE_WINDOW_HOURS * 3600
+    slack = RECONCILE_SLACK_MINUTES * 60
+    payments = sorted(
+        (p.get("created", 0), pid, p) for pid, p in PENDING_PAYMENTS.items() if p.get("method") in RECONCILE_METHODS
+    )
+    approve, review, matched = [], {}, {}
+    used = _used_statement_rows(rows, by_ref)
+    utr_claims: Dict[int, list] = {}
+    unresolved = []  # (payment_id, paise, created, had_refs, expected) without a UTR hit
+    for created, pid, p in payments:
+        expected = p.get("amount")
+        if expected is None:
+            expected, _ = get_price(p.get("plan"), p.get("method"))
+        if expected is None:
+            continue
+        paise = round(float(expected) * 100)
+        refs = [key[4:] for key in p.get("proof_keys", ()) if key.startswith("ref:")]
+        hits = sorted({i for ref in refs for i in by_ref.get(ref, ())})
+        exact = [i for i in hits if rows[i][2] == paise]
+        fresh = [i for i in exact if i not in used]
+        if exact and not fresh:
+            review[pid] = "the credit was already used for another payment"
+        elif len(fresh) == 1:
+            utr_claims.setdefault(fresh[0], []).append(pid)
+        elif fresh:
+            review[pid] = f"UTR appears on {len(exact)} credits"
+        elif hits:
+            review[pid] = f"UTR credited {rows[hits[0]][2] / 100:g}, expected {expected:g}"
+        else:
+            unresolved.append((pid, paise, created, bool(refs), expected))
+    for i, pids in utr_claims.items():
+        for pid in pids:
+            if len(pids) > 1:
+                review[pid] = f"the credit also fits {len(pids) - 1} other payment(s)"
+            else:
+                approve.append(pid)
+                matched[pid] = rows[i][4]
+
+    # amount + time: a credit is a candidate for every payment of that amount
+    # whose window it falls in, so it is unambiguous only if exactly one
+    # payment's window holds it and that window holds no other credit
+    used |= set(utr_claims)
+    created_by_amount: Dict[int, list] = {}
+    for pid, paise, created, had_refs, expected in unresolved:
+        created_by_amount.setdefault(paise, []).append(created)
+    for times in created_by_amount.values():
+        times.sort()
+    for pid, paise, created, had_refs, expected in unresolved:
+        bucket = by_amount.get(paise, [])
+        found = []
+        for k in range(bisect_left(bucket, (created - window - index["span"],)), len(bucket)):
+            start, i = bucket[k]
+            if start > created + slack or len(found) > 1:
+                break
+            if rows[i][1] >= created - window and i not in used:
+                found.append(i)
+        if not found:
+            continue
+        if had_refs:
+            review[pid] = "UTR not on the statement, but the amount matches"
+        elif len(found) > 1:
+            review[pid] = f"several credits of {expected:g} in the time window"
+        else:
+            start, end = rows[found[0]][:2]
+            times = created_by_amount[paise]
+            others = bisect_right(times, end + window) - bisect_left(times, start - slack) - 1
+            if others > 0:
+                review[pid] = f"the credit also fits {others} other payment(s)"
+                continue
+            matched[pid] = rows[found[0]][4]
+            if RECONCILE_TRUST_AMOUNT:
+                approve.append(pid)
+            else:
+                review[pid] = "amount and time match, no UTR"
+
+    order = {pid: n for n, (_, pid, _) in enumerate(payments)}
+    approve.sort(key=order.get)
+    return {
+        "approve": approve,
+        "review": sorted(review.items(), key=lambda item: order[item[0]]),
+        "rows": matched,
+        "checked": len(payments),
+    }
+
+async def reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        return
+    message = update.effective_message
+    doc = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if doc is None:
+        await message.reply_text(RECONCILE_USAGE)
+        return
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        tg_file = await context.bot.get_file(doc.file_id)
+        await tg_file.download_to_drive(path)
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, build_statement_index, path)
+    except Exception as e:
+        logger.exception("Reading statement %s failed", doc.file_name)
+        await message.reply_text(f"❌ Could not read the statement: {e}\n\n{RECONCILE_USAGE}")
+        return
+    finally:
+        os.remove(path)
+
+    if MULTI_WORKER:
+        # proofs sent to other workers in the last moments
+        await sync_shared_state()
+    result = match_statement(index)
+    # approving one of these, here or from the review list, uses up its credit
+    _STATEMENT_MATCHES.update(result["rows"])
+    lines = [
+        f"🏦 Statement: {len(index['rows'])} credits ({index['skipped']} other rows skipped)",
+        f"Pending UPI/Remitly payments checked: {result['checked']}",
+    ]
+    if result["approve"]:
+        lines.append(await bulk_resolve(context, "approve", result["approve"]))
+    else:
+        lines.append("No confident matches.")
+    unmatched = result["checked"] - len(result["approve"]) - len(result["review"])
+    if unmatched:
+        lines.append(f"• {unmatched} payment(s) have no credit on this statement")
+    await message.reply_text("\n".join(lines))
+
+    review = [(pid, reason) for pid, reason in result["review"] if pid in PENDING_PAYMENTS]
+    if not review:
+        return
+    lines = [f"🔎 {len(review)} payment(s) need a look"]
+    kb = []
+    for n, (pid, reason) in enumerate(review[:RECONCILE_REVIEW_MAX], 1):
+        p = PENDING_PAYMENTS[pid]
+        lines.append(
+            f"#{n} @{p['username'] or 'NoUsername'} (ID: {p['user_id']}) · {p['method'].upper()} · "
+            f"{p['amount']} {p['currency']} · {pid}\n    {reason}"
+        )
+        kb.append([
+            InlineKeyboardButton(f"✅ #{n}", callback_data=f"approve:{pid}"),
+            InlineKeyboardButton(f"❌ #{n}", callback_data=f"decline:{pid}"),
+        ])
+    if len(review) > RECONCILE_REVIEW_MAX:
+        lines.append(f"… and {len(review) - RECONCILE_REVIEW_MAX} more (see /pending)")
+    await message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb))
+
+async def metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        return
+    if not METRICS_ENABLED:
+        await update.message.reply_text("Metrics are disabled (METRICS_ENABLED=0).")
+        return
+    await update.message.reply_text(metrics_summary())
+
+async def throttle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        return
+    await update.message.reply_text(throttle_summary())
+
 async def set_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not is_admin(user.id):
@@ -535,42 +3946,386 @@ async def set_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
         PRICE_CONFIG[plan]["crypto_usd"] = amount
     else:
         PRICE_CONFIG[plan]["remit_inr"] = amount
+    set_config("PRICE_CONFIG", PRICE_CONFIG)
     await update.message.reply_text(f"Updated price for {PLAN_LABELS.get(plan, plan)} [{method}] to {amount}.")
 
 async def set_upi(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global UPI_ID
     user = update.effective_user
     if not is_admin(user.id):
         return
     if not context.args:
         await update.message.reply_text("Usage: /set_upi <upi_id>")
         return
-    UPI_ID = context.args[0]
+    set_config("UPI_ID", context.args[0])
     await update.message.reply_text(f"UPI ID updated to: {UPI_ID}")
 
+async def set_qr(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Replace the UPI QR: send a photo with caption /set_qr, or reply /set_qr to one."""
+    user = update.effective_user
+    if not is_admin(user.id):
+        return
+    message = update.effective_message
+    if context.args and context.args[0].lower() == "reset":
+        drop_media(UPI_QR_SLOT)
+        await message.reply_text(f"UPI QR reset to the default image:\n{UPI_QR_URL}")
+        return
+    photo = message.photo or (message.reply_to_message.photo if message.reply_to_message else None)
+    if not photo:
+        await message.reply_text(
+            "Usage: send the new QR as a photo with caption /set_qr, or reply /set_qr to a photo.\n"
+            "/set_qr reset goes back to the default image."
+        )
+        return
+    cache_media(UPI_QR_SLOT, photo[-1].file_id)
+    await message.reply_text("UPI QR updated. Users choosing UPI will now get this image.")
+
 async def set_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global CRYPTO_ADDRESS
     user = update.effective_user
     if not is_admin(user.id):
         return
     if not context.args:
         await update.message.reply_text("Usage: /set_crypto <address>")
         return
-    CRYPTO_ADDRESS = context.args[0]
+    set_config("CRYPTO_ADDRESS", context.args[0])
     await update.message.reply_text(f"Crypto address updated to: {CRYPTO_ADDRESS}")
 
 async def set_remitly(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global REMITLY_INFO
     user = update.effective_user
     if not is_admin(user.id):
         return
     if not context.args:
         await update.message.reply_text("Usage: /set_remitly <short description>")
         return
-    REMITLY_INFO = " ".join(context.args)
+    set_config("REMITLY_INFO", " ".join(context.args))
     await update.message.reply_text(f"Remitly info updated to:\n{REMITLY_INFO}")
 
+# ----------------- WEBHOOK SERVER -----------------
+# Runs PTB's Application on its own tornado server instead of run_webhook()
+# so we can add a health check and drain cleanly: on SIGTERM the health check
+# flips to 503, the listener closes, in-flight requests finish and every
+# queued update is processed before shutdown.  Telegram keeps the webhook
+# registered across redeploys and retries whatever it could not deliver.
+_DRAINING = False
+
+def _make_metrics_handler():
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(metrics_text())
+
+    return MetricsHandler
+
+def start_metrics_server():
+    """Serve METRICS_PATH on METRICS_PORT (used in polling mode)."""
+    import tornado.httpserver
+    import tornado.web
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(METRICS_PATH, _make_metrics_handler())]))
+    server.listen(METRICS_PORT, address=WEBHOOK_LISTEN)
+    logger.info("Metrics endpoint on %s:%s%s", WEBHOOK_LISTEN, METRICS_PORT, METRICS_PATH)
+    return server
+
+def _make_webhook_app(app):
+    import tornado.web
+    MetricsHandler = _make_metrics_handler()
+
+    class TelegramUpdateHandler(tornado.web.RequestHandler):
+        async def post(self):
+            if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                self.set_status(403)
+                return
+            try:
+                update = Update.de_json(json.loads(self.request.body), app.bot)
+            except Exception:
+                logger.warning("Rejected malformed webhook payload")
+                self.set_status(400)
+                return
+            await app.update_queue.put(update)
+            self.set_status(200)
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            ok = app.running and not _DRAINING
+            self.set_status(200 if ok else 503)
+            self.write({
+                "status": "ok" if ok else "draining",
+                "queued_updates": app.update_queue.qsize(),
+                "pending_payments": len(PENDING_PAYMENTS),
+            })
+
+    routes = [
+        (WEBHOOK_PATH, TelegramUpdateHandler),
+        (HEALTH_PATH, HealthHandler),
+    ]
+    if METRICS_ENABLED:
+        routes.append((METRICS_PATH, MetricsHandler))
+    return tornado.web.Application(routes)
+
+async def serve_webhook(app):
+    """Serve updates over HTTP until SIGINT/SIGTERM, then drain and shut down."""
+    global _DRAINING
+    import tornado.httpserver
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    if WEBHOOK_URL and RUN_MODE == "webhook":
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    await app.start()
+
+    ssl_options = None
+    address, port = WEBHOOK_LISTEN, WEBHOOK_PORT
+    if RUN_MODE == "worker":
+        # only the front process talks to us
+        address, port = "127.0.0.1", WORKER_BASE_PORT + WORKER_ID
+    elif WEBHOOK_CERT and WEBHOOK_KEY:
+        ssl_options = {"certfile": WEBHOOK_CERT, "keyfile": WEBHOOK_KEY}
+    server = tornado.httpserver.HTTPServer(_make_webhook_app(app), ssl_options=ssl_options)
+    server.listen(port, address=address)
+    logger.info("Webhook server listening on %s:%s%s", address, port, WEBHOOK_PATH)
+
+    await stop.wait()
+    logger.info("Draining webhook server")
+    _DRAINING = True
+    server.stop()
+    await server.close_all_connections()
+    # Application.stop() processes everything still in update_queue
+    await app.stop()
+    if app.post_stop:
+        await app.post_stop(app)
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+# ----------------- MULTI-WORKER MODE -----------------
+# With WORKERS > 1 the webhook process is only a router: each update goes to
+# worker user_id % WORKERS, so a user's updates (and all of the admin's) land
+# in one process and the per-user locks keep working.  Workers share the
+# SQLite store; a write reaches the other workers through its changes table
+# within PERSIST_INTERVAL + SYNC_INTERVAL, or just SYNC_INTERVAL for
+# SHARED_URGENT_EVENTS.  Approving and expiring a payment both claim its
+# row, so only one worker ever resolves it; an auto-approved TXID is
+# claimed the same way, so it pays for one payment only.  Jobs that must run once (the
+# invite pool, resumed broadcasts) run on the admin's worker, and pending
+# payments expire on their user's worker.
+SHARED_URGENT_EVENTS = ("payment_pending", "payment_resolved", "payment_contested", "proof_indexed", "config_set")
+CHANGE_RETENTION_SECONDS = 3600
+_SYNC_TASK = None
+_SYNC_LOCK = asyncio.Lock()     # one read-and-apply of the changes feed at a time
+
+def worker_for(user_id: int) -> int:
+    return user_id % WORKERS
+
+def owns_user(user_id: int) -> bool:
+    """Whether this process handles `user_id`'s updates (always, outside multi-worker mode)."""
+    return RUN_MODE != "worker" or worker_for(user_id) == WORKER_ID
+
+def _update_user_id(data: dict) -> int:
+    """Sender of a raw update: the "from" (or "user"/"chat") of its payload object."""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return 0
+
+async def sync_shared_state() -> int:
+    """Apply what other workers committed since the last call; returns records applied.
+
+    The rows are read in an executor thread and applied on the event loop,
+    in feed order even when two syncs overlap.
+    """
+    loop = asyncio.get_running_loop()
+    applied = 0
+    async with _SYNC_LOCK:
+        for rec in await loop.run_in_executor(None, STORE.changes):
+            if rec["event"] == "purchase":
+                # purchase history stays in SQLite; only the rollup lives in memory
+                rollup_purchase(_deserialize_purchase(rec["purchase"]))
+            else:
+                _apply_event(rec)
+            applied += 1
+    return applied
+
+async def claim_shared_pending(payment_id: str) -> bool:
+    loop = asyncio.get_running_loop()
+    claimed = await loop.run_in_executor(None, STORE.claim_pending, payment_id)
+    if not claimed:
+        logger.info("Payment %s was already resolved by another worker", payment_id)
+    return claimed
+
+async def sync_loop():
+    loop = asyncio.get_running_loop()
+    pruned = time.monotonic()
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL)
+        try:
+            await sync_shared_state()
+            if owns_user(ADMIN_CHAT_ID) and time.monotonic() - pruned > 60:
+                pruned = time.monotonic()
+                await loop.run_in_executor(None, STORE.prune_changes, time.time() - CHANGE_RETENTION_SECONDS)
+        except Exception:
+            logger.exception("Syncing shared state failed")
+
+def _spawn_worker(n: int) -> subprocess.Popen:
+    env = dict(os.environ, RUN_MODE="worker", WORKER_ID=str(n), WORKERS=str(WORKERS), STORAGE_BACKEND="sqlite")
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+    logger.info("Started worker %d (pid %d) on port %d", n, proc.pid, WORKER_BASE_PORT + n)
+    return proc
+
+def _make_front_app(workers: list):
+    import tornado.httpclient
+    import tornado.web
+    client = tornado.httpclient.AsyncHTTPClient()
+    headers = {"Content-Type": "application/json"}
+    if WEBHOOK_SECRET:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET
+
+    class FrontUpdateHandler(tornado.web.RequestHandler):
+        async def post(self):
+            if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                self.set_status(403)
+                return
+            try:
+                data = json.loads(self.request.body)
+            except ValueError:
+                logger.warning("Rejected malformed webhook payload")
+                self.set_status(400)
+                return
+            n = worker_for(_update_user_id(data))
+            try:
+                await client.fetch(
+                    f"http://127.0.0.1:{WORKER_BASE_PORT + n}{WEBHOOK_PATH}",
+                    method="POST", body=self.request.body, headers=headers, request_timeout=10,
+                )
+                self.set_status(200)
+            except Exception as e:
+                # Telegram redelivers anything not acknowledged with a 200
+                logger.warning("Worker %d did not take update %s: %s", n, data.get("update_id"), e)
+                self.set_status(503)
+
+    class FrontHealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            alive = sum(proc.poll() is None for proc in workers)
+            ok = alive == len(workers) and not _DRAINING
+            self.set_status(200 if ok else 503)
+            self.write({"status": "ok" if ok else "draining" if _DRAINING else "degraded",
+                        "workers": alive, "of": len(workers)})
+
+    return tornado.web.Application([(WEBHOOK_PATH, FrontUpdateHandler), (HEALTH_PATH, FrontHealthHandler)])
+
+async def serve_front():
+    """Run WORKERS worker processes and route webhook updates to them until SIGINT/SIGTERM."""
+    global _DRAINING
+    import tornado.httpserver
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    workers = [_spawn_worker(n) for n in range(WORKERS)]
+    if WEBHOOK_URL:
+        kwargs = {}
+        if TELEGRAM_BASE_URL:
+            base = TELEGRAM_BASE_URL.rstrip("/")
+            kwargs = {"base_url": base + "/bot", "base_file_url": base + "/file/bot"}
+        async with Bot(BOT_TOKEN, **kwargs) as bot:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+    ssl_options = None
+    if WEBHOOK_CERT and WEBHOOK_KEY:
+        ssl_options = {"certfile": WEBHOOK_CERT, "keyfile": WEBHOOK_KEY}
+    server = tornado.httpserver.HTTPServer(_make_front_app(workers), ssl_options=ssl_options)
+    server.listen(WEBHOOK_PORT, address=WEBHOOK_LISTEN)
+    logger.info("Webhook front listening on %s:%s%s for %d workers", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WORKERS)
+
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+        for n, proc in enumerate(workers):
+            if proc.poll() is not None and not stop.is_set():
+                logger.error("Worker %d exited with status %s; restarting it", n, proc.returncode)
+                workers[n] = _spawn_worker(n)
+
+    logger.info("Draining webhook front")
+    _DRAINING = True
+    server.stop()
+    await server.close_all_connections()
+    # each worker drains its own queue on SIGTERM
+    for proc in workers:
+        proc.terminate()
+    for n, proc in enumerate(workers):
+        try:
+            await loop.run_in_executor(None, proc.wait, 60)
+        except subprocess.TimeoutExpired:
+            logger.error("Worker %d did not stop in time; killing it", n)
+            proc.kill()
+
 # ----------------- MAIN -----------------
+async def post_init(app):
+    global _PERSIST_TASK, _EXPIRY_TASK, _INVITE_POOL_TASK, _SYNC_TASK, VERIFIER
+    _PERSIST_TASK = asyncio.create_task(persistence_loop())
+    # proof windows restored by SessionPersistence still need their timers
+    for user_id, user_data in app.user_data.items():
+        if user_data.get("payment_deadline"):
+            schedule_deadline(user_data["payment_deadline"], "proof", user_id)
+    _EXPIRY_TASK = asyncio.create_task(expiry_loop(app))
+    if RUN_MODE == "worker":
+        _SYNC_TASK = asyncio.create_task(sync_loop())
+    if INVITE_POOL_SIZE > 0 and owns_user(ADMIN_CHAT_ID):
+        _INVITE_POOL_TASK = asyncio.create_task(invite_pool_loop(app.bot))
+    if METRICS_ENABLED and METRICS_PORT and RUN_MODE == "polling":
+        start_metrics_server()
+    VERIFIER = make_verifier()
+    # re-check crypto proofs that were waiting for confirmations at shutdown
+    for payment_id, payment in list(PENDING_PAYMENTS.items()):
+        if owns_user(payment.get("user_id", 0)):
+            start_crypto_verification(app, payment_id, payment)
+    # pick up broadcasts interrupted by a restart (they belong to the admin's worker)
+    for job in list(BROADCAST_JOBS.values() if owns_user(ADMIN_CHAT_ID) else ()):
+        logger.info("Resuming broadcast %s after user_id %s", job["id"], job["cursor"])
+        start_broadcast_task(app.bot, job)
+
+async def post_shutdown(app):
+    # PTB stops on SIGINT/SIGTERM/SIGABRT and then runs this hook, so this is
+    # the guaranteed final flush
+    await flush_digest(app.bot)
+    for task in (_EXPIRY_TASK, _INVITE_POOL_TASK, _SYNC_TASK, *_VERIFY_TASKS.values()):
+        if task is not None:
+            task.cancel()
+    if VERIFIER is not None:
+        await VERIFIER.close()
+    for task in list(_BROADCAST_TASKS.values()):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    if _PERSIST_TASK is not None:
+        _PERSIST_TASK.cancel()
+        try:
+            await _PERSIST_TASK
+        except asyncio.CancelledError:
+            pass
+    await flush_state()
+    STORE.close()
+
 def main():
     # Ensure data dir exists & load existing state
     _ensure_data_dir()
@@ -581,26 +4336,67 @@ def main():
     if not ADMIN_CHAT_ID:
         raise RuntimeError("ADMIN_CHAT_ID is not set properly.")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    if RUN_MODE == "webhook" and WORKERS > 1:
+        # this process only routes updates; state belongs to the workers
+        STORE.close()
+        asyncio.run(serve_front())
+        return
+
+    atexit.register(flush_state_sync)
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .persistence(SessionPersistence())
+    )
+    if OUTBOUND_RATE > 0:
+        builder = builder.request(ScheduledRequest(connection_pool_size=256))
+    elif METRICS_ENABLED:
+        builder = builder.request(InstrumentedRequest(connection_pool_size=256))
+    if TELEGRAM_BASE_URL:
+        base = TELEGRAM_BASE_URL.rstrip("/")
+        builder = builder.base_url(base + "/bot").base_file_url(base + "/file/bot")
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    app = builder.build()
 
-    # user handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(handle_buttons))
-    app.add_handler(MessageHandler((filters.PHOTO | filters.Document.ALL) & ~filters.COMMAND, handle_payment_proof))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, warn_text_not_allowed))
+    # user handlers (callback queries lock per user or per payment themselves)
+    app.add_handler(CommandHandler("start", timed(per_user(start))))
+    app.add_handler(CallbackQueryHandler(timed(handle_buttons)))
+    # admin QR upload (photo captioned /set_qr) must be checked before proofs
+    app.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(r"^/set_qr\b") & filters.User(ADMIN_CHAT_ID), timed(per_user(set_qr))))
+    # ... and so must statement uploads (a document captioned /reconcile)
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/reconcile\b") & filters.User(ADMIN_CHAT_ID), timed(reconcile)))
+    # the proof and text anti-flood limits are applied inside the handlers,
+    # which stay silent for users not in proof mode
+    app.add_handler(MessageHandler((filters.PHOTO | filters.Document.ALL) & ~filters.COMMAND, timed(per_user(handle_payment_proof))))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(per_user(warn_text_not_allowed))))
 
     # admin handlers
-    app.add_handler(CommandHandler("broadcast", broadcast))
-    app.add_handler(CommandHandler("income", income))
-    app.add_handler(CommandHandler("set_price", set_price))
-    app.add_handler(CommandHandler("set_upi", set_upi))
-    app.add_handler(CommandHandler("set_crypto", set_crypto))
-    app.add_handler(CommandHandler("set_remitly", set_remitly))
-    app.add_handler(CommandHandler("set_vip", set_vip_channel))
-    app.add_handler(CommandHandler("set_dark", set_dark_channel))
+    app.add_handler(CommandHandler("broadcast", timed(per_user(broadcast))))
+    # /pending takes the admin's lock itself, and not around bulk declines
+    app.add_handler(CommandHandler("pending", timed(pending)))
+    app.add_handler(CommandHandler("income", timed(per_user(income))))
+    # exports run in a worker thread; no user lock, so other admin commands keep working
+    app.add_handler(CommandHandler("export", timed(export)))
+    # /reconcile's bulk approvals must not hold the admin's lock either
+    app.add_handler(CommandHandler("reconcile", timed(reconcile)))
+    app.add_handler(CommandHandler("metrics", timed(per_user(metrics))))
+    app.add_handler(CommandHandler("throttle", timed(per_user(throttle_stats))))
+    app.add_handler(CommandHandler("set_price", timed(per_user(set_price))))
+    app.add_handler(CommandHandler("set_upi", timed(per_user(set_upi))))
+    app.add_handler(CommandHandler("set_qr", timed(per_user(set_qr))))
+    app.add_handler(CommandHandler("set_crypto", timed(per_user(set_crypto))))
+    app.add_handler(CommandHandler("set_remitly", timed(per_user(set_remitly))))
+    app.add_handler(CommandHandler("set_vip", timed(per_user(set_vip_channel))))
+    app.add_handler(CommandHandler("set_dark", timed(per_user(set_dark_channel))))
 
     # start
-    app.run_polling()
+    if RUN_MODE in ("webhook", "worker"):
+        asyncio.run(serve_webhook(app))
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
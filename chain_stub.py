@@ -0,0 +1,187 @@
+# chain_stub.py
+# Local stand-in for an EVM JSON-RPC node, so the crypto verifier in bot.py
+# (CRYPTO_VERIFIER=evm) can be exercised end to end without a real chain.
+#
+# It answers the calls the verifier makes -- eth_blockNumber,
+# eth_getTransactionReceipt and eth_getBlockByNumber -- for token transfers
+# created through the stub_transfer method, and mines a block every
+# --block-time seconds (stub_mine mines some at once).  Receipts carry a
+# standard ERC-20 Transfer log from --token, so the same client code reads
+# a real BSC/Ethereum node.
+#
+#   python chain_stub.py serve --port 8545 --block-time 3
+#   python chain_stub.py pay 0xfc14846229f375124d8fed5cd9a789a271a303f5 6
+#   python chain_stub.py pay 0xfc14... 6 --failed        # reverted transaction
+#   python chain_stub.py mine 15
+#
+# then run the bot with CRYPTO_VERIFIER=evm CRYPTO_RPC_URL=http://127.0.0.1:8545
+# and send the printed TXID as the caption of a crypto proof.
+import argparse
+import json
+import secrets
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+DEFAULT_TOKEN = "0x55d398326f99059ff775485246999027b3197955"   # USDT on BSC
+DEFAULT_SENDER = "0x" + "11" * 20
+
+class Chain:
+    """Blocks and token-transfer receipts, all in memory."""
+
+    def __init__(self, token: str, decimals: int):
+        self.token = token.lower()
+        self.scale = 10 ** decimals
+        self.lock = threading.Lock()
+        self.blocks = [{"number": 0, "timestamp": int(time.time()), "txs": []}]
+        self.pending = []           # txids waiting for the next block
+        self.receipts = {}          # txid -> receipt (once mined)
+
+    def mine(self, count: int = 1) -> int:
+        with self.lock:
+            for _ in range(count):
+                number = len(self.blocks)
+                block = {"number": number, "timestamp": int(time.time()), "txs": self.pending}
+                for txid in self.pending:
+                    self.receipts[txid]["blockNumber"] = hex(number)
+                    self.receipts[txid]["blockHash"] = "0x" + secrets.token_hex(32)
+                self.blocks.append(block)
+                self.pending = []
+            return len(self.blocks) - 1
+
+    def transfer(self, to: str, amount: float, sender: str = DEFAULT_SENDER, failed: bool = False) -> str:
+        """Queue a token transfer for the next block; returns its TXID."""
+        txid = "0x" + secrets.token_hex(32)
+        value = int(round(amount * self.scale))
+        with self.lock:
+            self.receipts[txid] = {
+                "transactionHash": txid,
+                "status": "0x0" if failed else "0x1",
+                "blockNumber": None,
+                "from": sender,
+                "to": self.token,
+                # a reverted transfer emits no logs
+                "logs": [] if failed else [{
+                    "address": self.token,
+                    "topics": [TRANSFER_TOPIC, _topic(sender), _topic(to)],
+                    "data": hex(value),
+                }],
+            }
+            self.pending.append(txid)
+        return txid
+
+    def call(self, method: str, params: list):
+        if method == "eth_blockNumber":
+            return hex(len(self.blocks) - 1)
+        if method == "eth_getTransactionReceipt":
+            receipt = self.receipts.get(str(params[0]).lower())
+            return dict(receipt) if receipt and receipt["blockNumber"] else None
+        if method == "eth_getBlockByNumber":
+            number = int(params[0], 16) if params[0] != "latest" else len(self.blocks) - 1
+            if not 0 <= number < len(self.blocks):
+                return None
+            block = self.blocks[number]
+            return {"number": hex(number), "timestamp": hex(block["timestamp"]), "transactions": block["txs"]}
+        if method == "eth_chainId":
+            return "0x539"
+        if method == "stub_transfer":
+            to, amount, *rest = params
+            opts = rest[0] if rest else {}
+            return self.transfer(to, float(amount), opts.get("from", DEFAULT_SENDER), bool(opts.get("failed")))
+        if method == "stub_mine":
+            return hex(self.mine(int(params[0]) if params else 1))
+        raise KeyError(method)
+
+def _topic(address: str) -> str:
+    return "0x" + address.lower().removeprefix("0x").rjust(64, "0")
+
+def make_handler(chain: Chain):
+    class RpcHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except ValueError:
+                self._reply({"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": "parse error"}})
+                return
+            reply = {"jsonrpc": "2.0", "id": request.get("id")}
+            try:
+                reply["result"] = chain.call(request.get("method"), request.get("params") or [])
+            except KeyError:
+                reply["error"] = {"code": -32601, "message": f"method not found: {request.get('method')}"}
+            except (TypeError, ValueError) as e:
+                reply["error"] = {"code": -32602, "message": f"invalid params: {e}"}
+            self._reply(reply)
+
+        def _reply(self, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return RpcHandler
+
+def serve(args):
+    chain = Chain(args.token, args.decimals)
+
+    def miner():
+        while True:
+            time.sleep(args.block_time)
+            chain.mine()
+
+    if args.block_time > 0:
+        threading.Thread(target=miner, daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(chain))
+    print(f"chain stub on http://{args.host}:{args.port} (token {chain.token}, block every {args.block_time}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def rpc(url: str, method: str, *params):
+    body = json.dumps({"jsonrpc": "2.0", "id": 1, "method": method, "params": list(params)}).encode()
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        reply = json.loads(response.read())
+    if reply.get("error"):
+        sys.exit(reply["error"]["message"])
+    return reply["result"]
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Local EVM JSON-RPC stand-in for testing crypto verification.")
+    sub = p.add_subparsers(dest="command", required=True)
+    s = sub.add_parser("serve", help="run the stub node")
+    s.add_argument("--host", default="127.0.0.1")
+    s.add_argument("--port", type=int, default=8545)
+    s.add_argument("--block-time", type=float, default=3.0, help="seconds per block (0 mines only on stub_mine)")
+    s.add_argument("--token", default=DEFAULT_TOKEN, help="token contract emitting the Transfer logs")
+    s.add_argument("--decimals", type=int, default=18)
+    t = sub.add_parser("pay", help="send a token transfer to a running stub and print its TXID")
+    t.add_argument("to")
+    t.add_argument("amount", type=float)
+    t.add_argument("--sender", default=DEFAULT_SENDER)
+    t.add_argument("--failed", action="store_true", help="make the transaction revert")
+    m = sub.add_parser("mine", help="mine blocks on a running stub")
+    m.add_argument("count", type=int, nargs="?", default=1)
+    for q in (t, m):
+        q.add_argument("--url", default="http://127.0.0.1:8545")
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "pay":
+        print(rpc(args.url, "stub_transfer", args.to, args.amount, {"from": args.sender, "failed": args.failed}))
+    else:
+        print(int(rpc(args.url, "stub_mine", args.count), 16))
+
+if __name__ == "__main__":
+    main()